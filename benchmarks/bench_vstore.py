@@ -0,0 +1,299 @@
+"""
+Micro-benchmarks of the client side of the Virtuoso store.
+
+They exercise SPASQL decoding, result iteration, query rewriting and
+write batching against the offline stand-in of
+:mod:`virtuoso.offline`, so no Virtuoso server is needed (the patched
+pyodbc is, for its SPASQL constants). The traffic of each benchmark is
+recorded once on the stand-in and replayed by
+:class:`virtuoso.trace.ReplayConnection`, so that rdflib's evaluation
+of the queries is not measured. Run as::
+
+    python benchmarks/bench_vstore.py
+    python benchmarks/bench_vstore.py --save baseline.json
+    python benchmarks/bench_vstore.py --compare baseline.json
+
+With ``--compare``, the exit status is 1 if any benchmark is slower
+than the saved run by more than ``--tolerance``.
+"""
+from __future__ import print_function
+import argparse
+import gc
+import io
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rdflib.graph import Graph
+from rdflib.namespace import XSD, RDFS
+from rdflib.term import URIRef, BNode, Literal
+
+from virtuoso.offline import OfflineServer, encode_term
+from virtuoso.trace import TraceRecorder, ReplayConnection, load_trace
+from virtuoso.vstore import (
+    Virtuoso, VirtuosoResult, resolve, _query_bindings,
+    _bnode_to_nodeid, _nodeid_to_bnode)
+
+EX = "http://example.org/resource/"
+GRAPH = URIRef("http://example.org/graph")
+SELECT_ALL = "SELECT ?s ?p ?o ?g WHERE { GRAPH ?g { ?s ?p ?o } }"
+
+
+def sample_terms():
+    """
+    One rdflib term for each kind of value Virtuoso returns.
+    """
+    return [
+        URIRef(EX + "s1"),
+        BNode("b10007"),
+        Literal(u"a plain literal"),
+        Literal(u"un littéral", lang="fr"),
+        Literal(u"1970", datatype=XSD.gYear),
+        Literal(42),
+        Literal(0.5, datatype=XSD.float),
+        Literal(0.25, datatype=XSD.double),
+        Literal(u"12.3", datatype=XSD.decimal),
+        Literal(u"2014-10-20T12:34:56", datatype=XSD.dateTime),
+    ]
+
+
+def make_server(n=0):
+    """
+    An offline server holding ``n`` triples in :data:`GRAPH`, whose
+    objects cycle through :func:`sample_terms`.
+    """
+    server = OfflineServer()
+    terms = sample_terms()
+    graph = server.graph.get_context(GRAPH)
+    with server.lock:
+        for i in range(n):
+            graph.add((URIRef(EX + str(i)), RDFS.label, terms[i % len(terms)]))
+    return server
+
+
+def record(server, run, repeat=1):
+    """
+    Call ``run`` with a store of ``server`` and return the records of
+    the traffic it caused, for :func:`replay_store`. The traffic of
+    ``run`` is repeated ``repeat`` times, for a store replaying it as
+    many times.
+    """
+    trace = io.StringIO()
+    recorder = TraceRecorder(trace)
+    store = Virtuoso(connection=server.connect(), recorder=recorder)
+    setup = recorder.statements
+    run(store)
+    recorder.close()
+    trace.seek(0)
+    records = load_trace(trace)
+    return records[:setup] + records[setup:] * repeat
+
+
+def replay_store(records, **kwargs):
+    """
+    A store replaying recorded traffic.
+    """
+    return Virtuoso(connection=ReplayConnection(records, strict=True), **kwargs)
+
+
+def make_store(**kwargs):
+    return Virtuoso(connection=make_server().connect(), **kwargs)
+
+
+# Each benchmark returns (function, operations per call of the function).
+
+def bench_resolve():
+    server = make_server()
+    # the SPASQL tuples the driver returns, and an IRI_ID needing a lookup
+    cells = [encode_term(t) for t in sample_terms()]
+    cells.append(encode_term(URIRef(EX + "from_iri_id"), server.iri_id))
+    cursor = server.connect().cursor()
+
+    def run():
+        for cell in cells:
+            resolve(cursor, cell)
+    return run, len(cells)
+
+
+def bench_result_iteration(n=2000):
+    records = record(make_server(n), lambda store: list(store.query(SELECT_ALL)))
+
+    def run():
+        for row in replay_store(records).query(SELECT_ALL):
+            pass
+    return run, n
+
+
+def bench_result_bindings(n=2000):
+    records = record(make_server(n), lambda store: store.query(SELECT_ALL).bindings)
+
+    def run():
+        replay_store(records).query(SELECT_ALL).bindings
+    return run, n
+
+
+def bench_triples(n=2000):
+    records = record(make_server(n),
+                     lambda store: list(store.triples((None, None, None))))
+
+    def run():
+        for triple, contexts in replay_store(records).triples((None, None, None)):
+            pass
+    return run, n
+
+
+def _bench_decode(n, workers):
+    records = record(make_server(n), lambda store: list(store.query(SELECT_ALL)),
+                     repeat=100)
+    # a single store, so that its pool of decoding processes is reused
+    store = replay_store(records, decode_workers=workers)
+
+    def run():
+        for row in store.query(SELECT_ALL):
+            pass
+    return run, n
+
+
+def bench_decode_serial(n=20000):
+    return _bench_decode(n, None)
+
+
+def bench_decode_workers(n=20000, workers=4):
+    """
+    As ``decode_serial``, with the rows decoded in ``workers`` processes;
+    the speedup needs as many idle cores.
+    """
+    return _bench_decode(n, workers)
+
+
+def bench_query_rewrite():
+    store = make_store(long_iri=True, inference=URIRef("http://example.org/rules"),
+                       quad_storage=URIRef("http://example.org/storage"))
+    q = "SELECT ?s ?o WHERE { ?s ex:p ?o . ?o rdfs:label ?l }"
+    init_ns = {"ex": "http://example.org/", "rdfs": str(RDFS)}
+    init_bindings = {"s": URIRef(EX + "s1"), "l": Literal("label", lang="en")}
+    graph = URIRef("http://example.org/graph")
+
+    def run():
+        store._add_defines(store._prepare_query(
+            q, init_ns, init_bindings, graph, "http://example.org/base/"))
+    return run, 1
+
+
+def bench_query_bindings():
+    triples = [(URIRef(EX + "s"), RDFS.label, Literal("label")),
+               (BNode(), RDFS.label, Literal(3)),
+               (URIRef(EX + "s"), None, None),
+               (None, RDFS.label, BNode())]
+    graph = Graph(identifier=URIRef("http://example.org/graph"))
+
+    def run():
+        for triple in triples:
+            _query_bindings(triple, graph)
+    return run, len(triples)
+
+
+def bench_bnode_roundtrip():
+    bnodes = [BNode() for i in range(100)]
+
+    def run():
+        for bnode in bnodes:
+            _nodeid_to_bnode(_bnode_to_nodeid(bnode))
+    return run, len(bnodes)
+
+
+def bench_addN(n=5000):
+    def quads(store):
+        graphs = [Graph(store, identifier=URIRef("http://example.org/g%d" % i))
+                  for i in range(3)]
+        return [(URIRef(EX + str(i)), RDFS.label, Literal("label %d" % i),
+                 graphs[i // 2000 % len(graphs)])
+                for i in range(n)]
+    records = record(make_server(), lambda store: store.addN(quads(store)))
+
+    def run():
+        store = replay_store(records)
+        store.addN(quads(store))
+    return run, n
+
+
+BENCHMARKS = [
+    ("resolve", bench_resolve),
+    ("result_iteration", bench_result_iteration),
+    ("result_bindings", bench_result_bindings),
+    ("triples", bench_triples),
+    ("decode_serial", bench_decode_serial),
+    ("decode_workers", bench_decode_workers),
+    ("query_rewrite", bench_query_rewrite),
+    ("query_bindings", bench_query_bindings),
+    ("bnode_roundtrip", bench_bnode_roundtrip),
+    ("addN", bench_addN),
+]
+
+
+def measure(setup, min_time=0.2, repeat=5):
+    """
+    Return operations per second (best of ``repeat``) and the peak
+    memory traced during one call, in bytes per operation.
+    """
+    run, ops = setup()
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange() if hasattr(timer, "autorange") else (10, None)
+    number = max(1, int(number * min_time / 0.2))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(ops_per_sec=ops / best, usec_per_op=1e6 * best / ops,
+                peak_bytes_per_op=float(peak) / ops)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="save the results as JSON")
+    parser.add_argument("--compare", help="compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown tolerated by --compare (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    selected = [(n, b) for (n, b) in BENCHMARKS if not args.names or n in args.names]
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results, regressions = {}, []
+    print("%-18s %12s %10s %14s %9s" % ("benchmark", "ops/s", "usec/op", "peak B/op", "vs base"))
+    for name, setup in selected:
+        result = results[name] = measure(setup, repeat=args.repeat)
+        change = ""
+        if name in baseline:
+            ratio = result["usec_per_op"] / baseline[name]["usec_per_op"]
+            change = "%+.1f%%" % (100 * (ratio - 1))
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+        print("%-18s %12.0f %10.2f %14.1f %9s" % (
+            name, result["ops_per_sec"], result["usec_per_op"],
+            result["peak_bytes_per_op"], change))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print("slower than %s: %s" % (args.compare, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+"""
+Concurrent load generator for the Virtuoso store.
+
+Runs a weighted mix of SELECT, ASK, ``triples()``, ``add``, ``addN``
+and ``remove`` operations from several threads (and optionally several
+processes, each with its own threads), every thread using its own store,
+against a scratch graph. Reports the throughput, the p50/p95/p99
+latencies of each operation and the error and deadlock rates::
+
+    python benchmarks/loadtest.py --dsn "DSN=VOS;UID=dba;PWD=dba" \\
+        --threads 8 --duration 30 --mix select=5,ask=2,triples=2,addN=1
+
+The scratch graph is ``--graph`` (cleared at the end with ``--cleanup``).
+With ``--offline`` instead of ``--dsn``, the stores run on the in-process
+stand-in of :mod:`virtuoso.offline`, to try out a mix or the harness
+itself without a server (the patched pyodbc is still needed).
+"""
+from __future__ import print_function
+from collections import defaultdict
+from random import Random
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rdflib.graph import Graph
+from rdflib.namespace import Namespace, RDFS
+from rdflib.term import URIRef, Literal
+
+from virtuoso.metrics import clock, percentile
+from virtuoso.pool import StoreFactory
+from virtuoso.retry import RetryPolicy, is_deadlock
+
+EX = Namespace("http://example.org/loadtest/")
+
+OPERATIONS = ("select", "ask", "triples", "add", "addN", "remove")
+
+DEFAULT_MIX = "select=5,ask=2,triples=2,add=1,addN=1,remove=1"
+
+
+class Workload(object):
+    """
+    The operations of the load test, on ``keyspace`` subjects of a
+    scratch graph.
+    """
+
+    def __init__(self, graph_uri, keyspace=1000, batch=100):
+        self.graph_uri = URIRef(graph_uri)
+        self.keyspace = keyspace
+        self.batch = batch
+
+    def subject(self, rnd):
+        return EX["s%d" % rnd.randrange(self.keyspace)]
+
+    def select(self, store, graph, rnd):
+        q = "SELECT ?p ?o WHERE { GRAPH %s { %s ?p ?o } }" % (
+            self.graph_uri.n3(), self.subject(rnd).n3())
+        for row in store.query(q):
+            pass
+
+    def ask(self, store, graph, rnd):
+        q = "ASK WHERE { GRAPH %s { %s ?p ?o } }" % (
+            self.graph_uri.n3(), self.subject(rnd).n3())
+        bool(store.query(q))
+
+    def triples(self, store, graph, rnd):
+        for triple in graph.triples((self.subject(rnd), None, None)):
+            pass
+
+    def add(self, store, graph, rnd):
+        graph.add((self.subject(rnd), EX.value, Literal(rnd.randrange(1000))))
+
+    def addN(self, store, graph, rnd):
+        store.addN((self.subject(rnd), EX.value, Literal(rnd.randrange(1000)), graph)
+                   for i in range(self.batch))
+
+    def remove(self, store, graph, rnd):
+        graph.remove((self.subject(rnd), EX.value, None))
+
+    def populate(self, store):
+        graph = Graph(store, identifier=self.graph_uri)
+        store.addN((EX["s%d" % i], RDFS.label, Literal("subject %d" % i), graph)
+                   for i in range(self.keyspace))
+
+
+def parse_mix(mix):
+    weights = []
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation: %s" % name)
+        weights.append((name, float(weight)))
+    return weights
+
+
+def _pick(weights, total, rnd):
+    x = rnd.uniform(0, total)
+    for name, weight in weights:
+        x -= weight
+        if x <= 0:
+            return name
+    return weights[-1][0]
+
+
+def _worker(store_factory, workload, weights, deadline, max_ops, seed, samples):
+    rnd = Random(seed)
+    total = sum(w for _, w in weights)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    deadlocks = defaultdict(int)
+    try:
+        store = store_factory()
+    except Exception:
+        # a worker without a store still counts in the report
+        samples.append(({}, {"connect": 1}, {}))
+        return
+    graph = Graph(store, identifier=workload.graph_uri)
+    try:
+        ops = 0
+        while clock() < deadline and (max_ops is None or ops < max_ops):
+            name = _pick(weights, total, rnd)
+            start = clock()
+            try:
+                getattr(workload, name)(store, graph, rnd)
+            except Exception as e:
+                if is_deadlock(e):
+                    deadlocks[name] += 1
+                else:
+                    errors[name] += 1
+            else:
+                latencies[name].append(clock() - start)
+            ops += 1
+    finally:
+        store.close()
+    samples.append((dict(latencies), dict(errors), dict(deadlocks)))
+
+
+def run_threads(store_factory, workload, weights, threads, duration,
+                max_ops=None, seed=0):
+    """
+    Run the workload from ``threads`` threads of this process, and
+    return the samples of each thread.
+    """
+    deadline = clock() + duration
+    samples = []
+    workers = [threading.Thread(
+        target=_worker, args=(store_factory, workload, weights, deadline,
+                              max_ops, seed * 1000 + i, samples))
+        for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return samples
+
+
+def _run_process(args):
+    return run_threads(*args)
+
+
+def run(store_factory, workload, weights, threads=4, processes=1,
+        duration=10.0, max_ops=None):
+    """
+    Run the workload and return a report: a dict keyed by operation
+    name, plus ``"total"``, of dicts with ``ops``, ``ops_per_sec``,
+    ``p50``, ``p95``, ``p99`` and ``max`` latencies (seconds),
+    ``errors``, ``deadlocks`` and their rates. Workers that could not
+    get a store are counted as errors of a ``"connect"`` operation.
+    """
+    start = clock()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            per_process = pool.map(_run_process, [
+                (store_factory, workload, weights, threads, duration, max_ops, p)
+                for p in range(processes)])
+        finally:
+            pool.close()
+            pool.join()
+        samples = [s for process_samples in per_process for s in process_samples]
+    else:
+        samples = run_threads(store_factory, workload, weights, threads,
+                              duration, max_ops)
+    elapsed = clock() - start
+
+    latencies, errors, deadlocks = defaultdict(list), defaultdict(int), defaultdict(int)
+    for worker_latencies, worker_errors, worker_deadlocks in samples:
+        for name, values in worker_latencies.items():
+            latencies[name].extend(values)
+            latencies["total"].extend(values)
+        for name, count in worker_errors.items():
+            errors[name] += count
+            errors["total"] += count
+        for name, count in worker_deadlocks.items():
+            deadlocks[name] += count
+            deadlocks["total"] += count
+
+    report = {}
+    for name in set(latencies) | set(errors) | set(deadlocks):
+        values = sorted(latencies[name])
+        attempts = len(values) + errors[name] + deadlocks[name]
+        report[name] = dict(
+            ops=len(values), ops_per_sec=len(values) / elapsed,
+            p50=percentile(values, 0.5), p95=percentile(values, 0.95),
+            p99=percentile(values, 0.99), max=values[-1] if values else None,
+            errors=errors[name], deadlocks=deadlocks[name],
+            error_rate=float(errors[name]) / attempts if attempts else 0.0,
+            deadlock_rate=float(deadlocks[name]) / attempts if attempts else 0.0)
+    return report
+
+
+def _ms(seconds):
+    return "%9.2f" % (1000 * seconds) if seconds is not None else "%9s" % "-"
+
+
+def print_report(report, out=sys.stdout):
+    print("%-8s %8s %9s %9s %9s %9s %9s %8s %8s" % (
+        "op", "ops", "ops/s", "p50 ms", "p95 ms", "p99 ms", "max ms",
+        "err %", "dlk %"), file=out)
+    for name in sorted(report, key=lambda n: (n == "total", n)):
+        r = report[name]
+        print("%-8s %8d %9.1f %s %s %s %s %8.2f %8.2f" % (
+            name, r["ops"], r["ops_per_sec"], _ms(r["p50"]), _ms(r["p95"]),
+            _ms(r["p99"]), _ms(r["max"]), 100 * r["error_rate"],
+            100 * r["deadlock_rate"]), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--dsn")
+    target.add_argument("--offline", action="store_true",
+                        help="run on an in-process stand-in of Virtuoso")
+    parser.add_argument("--graph", default=str(EX.graph))
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="weighted operations (default: %s)" % DEFAULT_MIX)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--keyspace", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=100, help="addN batch size")
+    parser.add_argument("--populate", action="store_true",
+                        help="add one triple per subject before the run")
+    parser.add_argument("--cleanup", action="store_true",
+                        help="clear the scratch graph after the run")
+    parser.add_argument("--retry", type=int, default=0, metavar="ATTEMPTS",
+                        help="retry deadlocked writes up to ATTEMPTS times")
+    args = parser.parse_args(argv)
+    if args.offline and args.processes > 1:
+        parser.error("--offline runs in a single process")
+
+    store_kwargs = {}
+    if args.retry:
+        store_kwargs["retry"] = RetryPolicy(max_attempts=args.retry)
+    if args.offline:
+        from virtuoso.offline import OfflineServer
+        store_kwargs["connect"] = OfflineServer().connect
+        factory = StoreFactory("offline", **store_kwargs)
+    else:
+        factory = StoreFactory(args.dsn, **store_kwargs)
+    workload = Workload(args.graph, args.keyspace, args.batch)
+    if args.populate:
+        store = factory()
+        workload.populate(store)
+        store.close()
+    try:
+        report = run(factory, workload, parse_mix(args.mix), args.threads,
+                     args.processes, args.duration)
+    finally:
+        if args.cleanup:
+            store = factory()
+            Graph(store, identifier=workload.graph_uri).remove((None, None, None))
+            store.close()
+    print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
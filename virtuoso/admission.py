@@ -0,0 +1,233 @@
+"""
+Admission control of the statements of a store.
+
+An :class:`AdmissionController` given to a store as
+``Virtuoso(dsn, admission=AdmissionController())`` limits the number of
+statements in flight for each priority class: ``interactive`` queries
+(the default for queries), ``batch`` queries (``store.query(q,
+priority="batch")``) and ``write`` statements. Statements over the
+limit of their class wait in a queue, served by priority and then in
+order of arrival, for at most ``timeout`` seconds. A SELECT holds its
+slot until its result is exhausted or closed.
+
+Slots are re-entrant per thread and class: the statements of a thread
+already holding a slot of their class, e.g. queries run while iterating
+over a SELECT, are admitted at once, riding on that slot, rather than
+waiting for slots the thread itself may be holding. A statement of
+another class takes a slot of its own class, within the limit of that
+class, but is not held back by the ``total`` the thread already counts
+in.
+
+The controller can be shared by several stores, e.g. by a pool, to
+protect a whole server.
+"""
+from builtins import object
+from collections import deque
+from contextlib import contextmanager
+import threading
+
+try:
+    from threading import get_ident
+except ImportError:  # python 2
+    from thread import get_ident
+
+from virtuoso.metrics import MetricsRegistry, clock
+
+__all__ = ['AdmissionController', 'AdmissionTimeout', 'Slot',
+           'INTERACTIVE', 'BATCH', 'WRITE']
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+WRITE = 'write'
+
+#: Lower values are admitted first.
+DEFAULT_PRIORITIES = {INTERACTIVE: 0, WRITE: 1, BATCH: 2}
+DEFAULT_LIMITS = {INTERACTIVE: 16, WRITE: 4, BATCH: 4}
+
+
+class AdmissionTimeout(Exception):
+    """
+    Raised when a statement waited longer than the timeout for a slot.
+    """
+
+
+class _Waiter(object):
+    __slots__ = ('klass', 'priority', 'seq', 'nested')
+
+    def __init__(self, klass, priority, seq, nested=False):
+        self.klass = klass
+        self.priority = priority
+        self.seq = seq
+        # whether the thread holds a slot of another class
+        self.nested = nested
+
+
+class AdmissionController(object):
+    """
+    Admits statements by priority class. ``limits`` maps each class to
+    its maximum number of statements in flight; ``total``, if given,
+    caps the statements in flight across classes, e.g. to the number of
+    server threads given to this client. ``priorities`` order the
+    classes when they compete for the total.
+
+    ``registry`` (by default a new :class:`~virtuoso.metrics.MetricsRegistry`)
+    receives the ``admission.<class>.wait_time`` and
+    ``admission.<class>.queue_depth`` histograms, the latter observed
+    when a statement has to wait, and the ``admission.<class>.timeouts``
+    counters.
+    """
+
+    def __init__(self, limits=None, total=None, timeout=None,
+                 priorities=None, registry=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        if priorities:
+            self.priorities.update(priorities)
+        self.total = total
+        self.timeout = timeout
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.in_flight = dict((k, 0) for k in self.limits)
+        # the (thread, class) pairs holding a slot
+        self._holders = set()
+        self._waiting = deque()
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def _can_admit(self, waiter):
+        klass = waiter.klass
+        if self.in_flight[klass] >= self.limits[klass]:
+            return False
+        if (self.total is not None and not waiter.nested
+                and sum(self.in_flight.values()) >= self.total):
+            return False
+        for other in self._waiting:
+            if other is waiter:
+                continue
+            if other.klass == klass:
+                if other.seq < waiter.seq:
+                    return False
+            elif (self.total is not None and not waiter.nested
+                  and other.priority < waiter.priority
+                  and self.in_flight[other.klass] < self.limits[other.klass]):
+                # a more urgent statement would take the last slots
+                return False
+        return True
+
+    def acquire(self, klass, timeout=None):
+        """
+        Wait for a slot of ``klass``, at most ``timeout`` seconds (by
+        default that of the controller). Returns True once the slot is
+        taken, or False at once if the current thread already holds a
+        slot of ``klass``; only a taken slot is to be released.
+        """
+        if klass not in self.limits:
+            raise ValueError("Unknown admission class: %s" % klass)
+        if timeout is None:
+            timeout = self.timeout
+        thread = get_ident()
+        start = clock()
+        with self._cond:
+            if (thread, klass) in self._holders:
+                return False
+            self._seq += 1
+            waiter = _Waiter(klass, self.priorities.get(klass, 0), self._seq,
+                             any(t == thread for t, k in self._holders))
+            if self._can_admit(waiter):
+                self._take(klass, thread)
+                return True
+            self._waiting.append(waiter)
+            self.registry.histogram('admission.%s.queue_depth' % klass).observe(
+                sum(1 for w in self._waiting if w.klass == klass))
+            try:
+                while not self._can_admit(waiter):
+                    if timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = start + timeout - clock()
+                    if remaining <= 0:
+                        self.registry.counter(
+                            'admission.%s.timeouts' % klass).inc()
+                        raise AdmissionTimeout(
+                            "No %s slot after %ss" % (klass, timeout))
+                    self._cond.wait(remaining)
+                self._take(klass, thread)
+            finally:
+                self._waiting.remove(waiter)
+                # others may now be first in line
+                self._cond.notify_all()
+        self.registry.histogram('admission.%s.wait_time' % klass).observe(
+            clock() - start)
+        return True
+
+    def _take(self, klass, thread):
+        self.in_flight[klass] += 1
+        self._holders.add((thread, klass))
+
+    def release(self, klass, thread=None):
+        """
+        Release a slot of ``klass`` taken by ``thread`` (an identifier
+        as given by ``threading.get_ident``), by default the current
+        thread.
+        """
+        if thread is None:
+            thread = get_ident()
+        with self._cond:
+            self.in_flight[klass] -= 1
+            self._holders.discard((thread, klass))
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, klass, timeout=None):
+        """
+        Context manager holding a slot of ``klass``.
+        """
+        taken = self.acquire(klass, timeout)
+        try:
+            yield
+        finally:
+            if taken:
+                self.release(klass)
+
+    def slot(self, klass):
+        """
+        Return a :class:`Slot` of ``klass``, not yet acquired.
+        """
+        return Slot(self, klass)
+
+    def snapshot(self):
+        """
+        Return the statements in flight and waiting, by class.
+        """
+        with self._cond:
+            return dict((k, dict(in_flight=self.in_flight[k],
+                                 waiting=sum(1 for w in self._waiting
+                                             if w.klass == k)))
+                        for k in self.limits)
+
+
+class Slot(object):
+    """
+    The slot of a statement, which can be released and acquired again,
+    e.g. to give it back while the statement waits to be retried, and
+    released from another thread than the one that acquired it, e.g. at
+    the end of the rows of a SELECT.
+    """
+
+    def __init__(self, controller, klass):
+        self.controller = controller
+        self.klass = klass
+        # whether a slot of the controller is taken, rather than ridden on
+        self.taken = False
+        self._thread = None
+
+    def acquire(self, timeout=None):
+        if not self.taken:
+            self._thread = get_ident()
+            self.taken = self.controller.acquire(self.klass, timeout)
+
+    def release(self):
+        if self.taken:
+            self.taken = False
+            self.controller.release(self.klass, self._thread)
@@ -0,0 +1,330 @@
+"""
+An asyncio front end for the Virtuoso store (python 3 only).
+
+:class:`AsyncVirtuoso` runs the store methods in a bounded thread pool,
+each call on a store taken from a :class:`~virtuoso.pool.StorePool`, so
+that the event loop never waits on the database::
+
+    astore = AsyncVirtuoso("DSN=VOS;UID=dba;PWD=dba", pool_size=16)
+    result = await astore.query("SELECT ?s WHERE { ?s a ?t }")
+    async for row in result:
+        ...
+    async with astore.transaction() as tx:
+        await tx.addN(quads)
+        await tx.commit()
+    await astore.close()
+
+SELECT results and :meth:`AsyncVirtuoso.triples` are fetched in blocks
+of ``block_size`` rows, the next block being fetched while the current
+one is consumed. The store of a SELECT stays out of the pool until its
+result is exhausted or closed, so results that are not consumed should
+be closed with ``await result.aclose()`` or ``async with result``.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import asyncio
+import logging
+
+from virtuoso.pool import StorePool
+from virtuoso.vstore import Virtuoso
+
+__all__ = ['AsyncVirtuoso', 'AsyncResult', 'AsyncTransaction']
+
+log = logging.getLogger(__name__)
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:
+    # python < 3.7
+    _running_loop = asyncio.get_event_loop
+
+
+def _close_iterator(iterator):
+    # the generator under an EagerIterator closes the cursor
+    close = getattr(getattr(iterator, "g", iterator), "close", None)
+    if close is not None:
+        close()
+
+
+class AsyncResult(object):
+    """
+    The result of :meth:`AsyncVirtuoso.query`. For SELECT queries, an
+    asynchronous iterator over the result rows, with the ``vars`` of
+    the query; otherwise ``askAnswer`` or ``graph`` hold the answer.
+    """
+
+    def __init__(self, owner, result, iterator=None, first_block=(),
+                 release=None):
+        self.type = result.type if result is not None else None
+        self.vars = getattr(result, "vars", None)
+        self.askAnswer = getattr(result, "askAnswer", None)
+        self.graph = getattr(result, "graph", None)
+        self._owner = owner
+        self._iterator = iterator
+        self._release = release
+        self._buffer = deque(first_block)
+        self._next = None
+        if len(first_block) < owner.block_size:
+            self._finish()
+
+    def __bool__(self):
+        if self.type == "ASK":
+            return bool(self.askAnswer)
+        return True
+
+    def _fetch(self):
+        # runs in the thread pool
+        try:
+            block = list(islice(self._iterator, self._owner.block_size))
+        except:
+            self._finish(discard=True)
+            raise
+        if len(block) < self._owner.block_size:
+            self._finish()
+        return block
+
+    def _prefetch(self):
+        # in the event loop
+        if self._release is not None:
+            self._next = self._owner._run(self._fetch)
+
+    def _finish(self, discard=False):
+        release, self._release = self._release, None
+        if release is not None:
+            _close_iterator(self._iterator)
+            release(discard)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._buffer:
+            if self._next is None:
+                raise StopAsyncIteration
+            next_block, self._next = self._next, None
+            block = await next_block
+            self._prefetch()
+            self._buffer.extend(block)
+        return self._buffer.popleft()
+
+    async def fetchall(self):
+        """
+        Return the remaining rows as a list.
+        """
+        return [row async for row in self]
+
+    async def aclose(self):
+        """
+        Stop the iteration and give the store back to the pool.
+        """
+        self._buffer.clear()
+        if self._next is not None:
+            next_block, self._next = self._next, None
+            try:
+                await next_block
+            except Exception:
+                pass
+        if self._release is not None:
+            await self._owner._run(self._finish)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class AsyncVirtuoso(object):
+    """
+    Asynchronous access to a Virtuoso store. ``dsn`` and
+    ``store_kwargs`` are given to each :class:`~virtuoso.vstore.Virtuoso`
+    of the pool; alternatively, ``factory`` creates the stores, e.g.
+    ``store.clone``. At most ``pool_size`` statements run at once, the
+    others wait for a store at most ``timeout`` seconds if given.
+
+    Writes are committed one call at a time; use :meth:`transaction`
+    to group them.
+    """
+
+    def __init__(self, dsn=None, pool_size=8, block_size=100, timeout=None,
+                 factory=None, **store_kwargs):
+        if factory is None:
+            if dsn is None:
+                raise ValueError("A DSN or a store factory is required")
+            factory = lambda: Virtuoso(dsn, **store_kwargs)
+        self.pool = StorePool(factory, pool_size)
+        self.block_size = block_size
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(pool_size)
+
+    @classmethod
+    def from_store(cls, store, pool_size=8, **kwargs):
+        """
+        Front end pooling clones of ``store``.
+        """
+        return cls(factory=store.clone, pool_size=pool_size, **kwargs)
+
+    def _run(self, function, *args):
+        return _running_loop().run_in_executor(
+            self._executor, function, *args)
+
+    def _call(self, method, *args, **kwargs):
+        def call():
+            with self.pool.store(self.timeout) as store:
+                return getattr(store, method)(*args, **kwargs)
+        return self._run(call)
+
+    def _stream(self, open_iterator):
+        """
+        In the thread pool: take a store, open an iterator with it and
+        fetch the first block, keeping the store while rows remain.
+        """
+        store = self.pool.acquire(self.timeout)
+        try:
+            result, iterator = open_iterator(store)
+            if iterator is None:
+                self.pool.release(store)
+                return AsyncResult(self, result)
+            first_block = list(islice(iterator, self.block_size))
+        except:
+            self.pool.release(store)
+            raise
+        return AsyncResult(self, result, iterator, first_block,
+                           lambda discard: self.pool.release(store, discard))
+
+    async def query(self, q, initNs={}, initBindings={}, queryGraph=None,
+                    **kwargs):
+        """
+        Run a SPARQL query, see :meth:`virtuoso.vstore.Virtuoso.query`.
+        Returns an :class:`AsyncResult`.
+        """
+        def open_iterator(store):
+            result = store.query(q, initNs, initBindings, queryGraph, **kwargs)
+            if result.type != "SELECT":
+                return result, None
+            return result, result._eagerIterator
+        result = await self._run(self._stream, open_iterator)
+        result._prefetch()
+        return result
+
+    async def triples(self, statement, context=None):
+        """
+        An asynchronous iterator over the ``(triple, contexts)`` pairs
+        of :meth:`virtuoso.vstore.Virtuoso.triples`.
+        """
+        def open_iterator(store):
+            return None, store.triples(statement, context)
+        result = await self._run(self._stream, open_iterator)
+        result._prefetch()
+        return result
+
+    async def add(self, statement, context=None):
+        return await self._call("add", statement, context)
+
+    async def addN(self, quads):
+        # consumed here, not in the event loop
+        return await self._call("addN", list(quads))
+
+    async def remove(self, statement, context=None):
+        return await self._call("remove", statement, context)
+
+    def transaction(self):
+        """
+        Return an :class:`AsyncTransaction`, to be used as an
+        asynchronous context manager.
+        """
+        return AsyncTransaction(self)
+
+    async def close(self):
+        """
+        Wait for the running calls and close the pooled stores.
+        """
+        await _running_loop().run_in_executor(
+            None, self._executor.shutdown)
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class AsyncTransaction(object):
+    """
+    A transaction holding one store of the pool of an
+    :class:`AsyncVirtuoso` until it is committed or rolled back. Leaving
+    the ``async with`` block rolls back uncommitted work.
+    """
+
+    def __init__(self, owner):
+        self._owner = owner
+        self._store = None
+
+    async def begin(self):
+        owner = self._owner
+
+        def begin():
+            store = owner.pool.acquire(owner.timeout)
+            try:
+                store.transaction()
+            except:
+                owner.pool.release(store)
+                raise
+            return store
+        self._store = await owner._run(begin)
+        return self
+
+    def _call(self, method, *args):
+        if self._store is None:
+            raise ValueError("The transaction is not active")
+        return self._owner._run(getattr(self._store, method), *args)
+
+    async def query(self, q, initNs={}, initBindings={}, queryGraph=None,
+                    **kwargs):
+        """
+        Run a query in the transaction. The rows of a SELECT are all
+        fetched before returning.
+        """
+        store = self._store
+
+        def query():
+            result = store.query(q, initNs, initBindings, queryGraph,
+                                 cursor=store._transaction, **kwargs)
+            if result.type != "SELECT":
+                return AsyncResult(self._owner, result)
+            return AsyncResult(self._owner, result, iter(()),
+                               list(result._eagerIterator),
+                               lambda discard: None)
+        if store is None:
+            raise ValueError("The transaction is not active")
+        return await self._owner._run(query)
+
+    async def add(self, statement, context=None):
+        return await self._call("add", statement, context)
+
+    async def addN(self, quads):
+        return await self._call("addN", list(quads))
+
+    async def remove(self, statement, context=None):
+        return await self._call("remove", statement, context)
+
+    async def commit(self):
+        await self._call("commit")
+        self._done()
+
+    async def rollback(self):
+        await self._call("rollback")
+        self._done()
+
+    def _done(self):
+        store, self._store = self._store, None
+        self._owner.pool.release(store)
+
+    async def __aenter__(self):
+        return await self.begin()
+
+    async def __aexit__(self, exc_type, *exc):
+        if self._store is not None:
+            await self.rollback()
@@ -722,6 +722,11 @@ class VirtuosoDialect(PyODBCConnector, default.DefaultDialect):
     supports_sequences = True
     postfetch_lastrowid = True
 
+    def __init__(self, trace_recorder=None, **kwargs):
+        super(VirtuosoDialect, self).__init__(**kwargs)
+        # a virtuoso.trace.TraceRecorder, given to create_engine
+        self.trace_recorder = trace_recorder
+
     def connect(self, *args, **kwargs):
         connection = super(VirtuosoDialect, self).connect(*args, **kwargs)
         if util.py2k:
@@ -736,6 +741,9 @@ class VirtuosoDialect(PyODBCConnector, default.DefaultDialect):
             connection.setdecoding(pyodbc.SQL_WMETADATA, 'utf-32LE', pyodbc.SQL_WCHAR)
             connection.setencoding('utf-32LE', pyodbc.SQL_WCHAR)
             connection.setencoding('utf-8', pyodbc.SQL_CHAR)
+        if self.trace_recorder is not None:
+            from virtuoso.trace import RecordingConnection
+            connection = RecordingConnection(connection, self.trace_recorder)
         return connection
 
     def _get_default_schema_name(self, connection):
@@ -0,0 +1,165 @@
+"""
+Bloom filters of the triples of graphs.
+
+A store given :class:`GraphFilters` as ``Virtuoso(dsn,
+bloom_filters=filters)`` consults the filter of a graph, if it has one,
+before going to the server:
+
+* a membership test (``triple in graph``) of a triple the filter has
+  never seen is answered False locally;
+* ``addN`` only inserts the triples the filter has never seen and, in
+  one query per batch, those of the others that are not in the graph.
+
+The filter of a graph is built by streaming the graph once, or loaded
+from a file saved earlier, and then updated by the writes through the
+stores sharing the filters. A filter only ever errs on the side of
+"maybe present", provided all the writes to its graph go through such
+stores: updates run by ``query()`` drop the filters of the graphs
+they write. Removing
+triples leaves them in the filter, and clearing a graph empties it.
+"""
+from builtins import object, range
+from hashlib import md5
+from math import ceil, log
+import struct
+
+from virtuoso.metrics import MetricsRegistry
+
+__all__ = ['BloomFilter', 'GraphFilters', 'triple_key']
+
+_header = struct.Struct('>QI')
+
+
+def triple_key(triple):
+    """
+    The key of a triple in a filter: the N3 forms of its terms.
+    """
+    return u' '.join(term.n3() for term in triple)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized for ``capacity`` keys with a false positive
+    rate of ``error_rate``; it still works, with more false positives,
+    beyond its capacity.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01, bits=None,
+                 hashes=None):
+        if bits is None:
+            bits = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+        if hashes is None:
+            hashes = max(1, int(round(float(bits) / capacity * log(2))))
+        self.num_bits = max(8, bits)
+        self.num_hashes = hashes
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = md5(key.encode('utf-8')).digest()
+        h1, h2 = struct.unpack('>QQ', digest)
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def save(self, f):
+        """
+        Write the filter to the binary file ``f``.
+        """
+        f.write(_header.pack(self.num_bits, self.num_hashes))
+        f.write(bytes(self.bits))
+
+    @classmethod
+    def load(cls, f):
+        """
+        Read a filter written by :meth:`save` from the binary file ``f``.
+        """
+        num_bits, num_hashes = _header.unpack(f.read(_header.size))
+        bloom = cls(bits=num_bits, hashes=num_hashes)
+        bloom.bits = bytearray(f.read())
+        if len(bloom.bits) != (num_bits + 7) // 8:
+            raise ValueError("Truncated Bloom filter")
+        return bloom
+
+
+class GraphFilters(object):
+    """
+    The Bloom filters of some graphs, by graph name, with a false
+    positive rate of ``error_rate``.
+
+    ``registry`` (by default a new :class:`~virtuoso.metrics.MetricsRegistry`)
+    receives the ``bloom.negatives`` counter, of membership tests
+    answered locally, and the ``bloom.skipped`` counter, of triples not
+    inserted as already present.
+    """
+
+    def __init__(self, error_rate=0.01, registry=None):
+        self.error_rate = error_rate
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.filters = {}
+
+    def get(self, context):
+        """
+        Return the filter of the graph ``context``, or None.
+        """
+        return self.filters.get(getattr(context, "identifier", context))
+
+    def build(self, store, context, capacity=None):
+        """
+        Build the filter of ``context`` from the triples ``store`` holds
+        in it, sized by default for twice as many triples.
+        """
+        if capacity is None:
+            capacity = max(1024, 2 * store.__len__(context))
+        bloom = BloomFilter(capacity, self.error_rate)
+        for triple in store.scan((None, None, None), "SPO", context):
+            bloom.add(triple_key(triple))
+        self.filters[getattr(context, "identifier", context)] = bloom
+        return bloom
+
+    def save(self, context, path):
+        with open(path, 'wb') as f:
+            self.get(context).save(f)
+
+    def load(self, context, path):
+        """
+        Load the filter of ``context`` saved in ``path``; it must have
+        seen all the writes made to the graph since it was saved.
+        """
+        with open(path, 'rb') as f:
+            bloom = BloomFilter.load(f)
+        self.filters[getattr(context, "identifier", context)] = bloom
+        return bloom
+
+    def added(self, triple, context):
+        """
+        Record a triple written to ``context``.
+        """
+        bloom = self.get(context)
+        if bloom is not None:
+            bloom.add(triple_key(triple))
+
+    def cleared(self, context):
+        """
+        Empty the filter of a cleared graph.
+        """
+        bloom = self.get(context)
+        if bloom is not None:
+            self.filters[getattr(context, "identifier", context)] = BloomFilter(
+                bits=bloom.num_bits, hashes=bloom.num_hashes)
+
+    def discard(self, context=None):
+        """
+        Drop the filter of ``context``, or all the filters.
+        """
+        if context is None:
+            self.filters.clear()
+        else:
+            self.filters.pop(getattr(context, "identifier", context), None)
@@ -0,0 +1,125 @@
+"""
+A cache of entities read through a store.
+
+A store given an :class:`EntityCache` as ``Virtuoso(dsn,
+entity_cache=EntityCache())`` keeps, for each ``(graph, subject)`` it
+reads, all the ``(predicate, object)`` pairs of the subject in the
+graph. ``triples()`` patterns with a bound subject and a context, such
+as those of ``graph.value(s, p)`` and ``graph.predicate_objects(s)``,
+are then answered from the cache, the first one fetching the whole
+entity in a single query.
+
+Writes through the store (``add``, ``addN``, ``remove``, ``removeN``
+and updates run by ``query()``) invalidate the entities they touch;
+writes by other clients are only seen when entries expire, after
+``ttl`` seconds if given. Reads within a transaction bypass the cache.
+The cache can be shared by several stores, as it is by clones.
+"""
+from builtins import object
+from collections import OrderedDict
+import threading
+
+from virtuoso.metrics import MetricsRegistry, clock
+
+__all__ = ['EntityCache']
+
+
+class EntityCache(object):
+    """
+    A least recently used cache of at most ``max_entries`` entities.
+
+    ``registry`` (by default a new :class:`~virtuoso.metrics.MetricsRegistry`)
+    receives the ``cache.hits``, ``cache.misses``, ``cache.evictions``
+    and ``cache.invalidations`` counters.
+    """
+
+    def __init__(self, max_entries=10000, ttl=None, registry=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.registry = registry if registry is not None else MetricsRegistry()
+        # (context, subject) -> (time, pairs)
+        self._entries = OrderedDict()
+        # subject -> contexts of its entries
+        self._contexts = {}
+        # changes on each invalidation, so that an entity read before
+        # an invalidation is not cached after it
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, context, subject):
+        """
+        Return the pairs of ``subject`` in ``context``, or None.
+        """
+        key = (context, subject)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and clock() - entry[0] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.registry.counter('cache.misses').inc()
+                return None
+            # the most recently used entries are last
+            self._entries[key] = self._entries.pop(key)
+        self.registry.counter('cache.hits').inc()
+        return entry[1]
+
+    def put(self, context, subject, pairs, version=None):
+        """
+        Cache the pairs of ``subject`` in ``context``, unless the cache
+        was invalidated since ``version`` was read.
+        """
+        key = (context, subject)
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (clock(), list(pairs))
+            self._contexts.setdefault(subject, set()).add(context)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.registry.counter('cache.evictions').inc()
+
+    def _drop(self, key):
+        del self._entries[key]
+        context, subject = key
+        contexts = self._contexts[subject]
+        contexts.discard(context)
+        if not contexts:
+            del self._contexts[subject]
+
+    def invalidate(self, subject=None, context=None):
+        """
+        Drop the entries of ``subject`` in ``context``; a None subject
+        or context stands for all of them.
+        """
+        with self._lock:
+            self.version += 1
+            if subject is not None:
+                contexts = self._contexts.get(subject, ())
+                keys = [(c, subject) for c in contexts
+                        if context is None or c == context]
+            elif context is not None:
+                keys = [k for k in self._entries if k[0] == context]
+            else:
+                keys = list(self._entries)
+            for key in keys:
+                self._drop(key)
+        if keys:
+            self.registry.counter('cache.invalidations').inc(len(keys))
+
+    def clear(self):
+        self.invalidate()
+
+    @property
+    def hit_rate(self):
+        """
+        The fraction of lookups answered by the cache.
+        """
+        hits = self.registry.counter('cache.hits').value
+        lookups = hits + self.registry.counter('cache.misses').value
+        return hits / float(lookups) if lookups else 0.0
@@ -0,0 +1,89 @@
+"""
+Structured access to the query plans reported by Virtuoso's
+``explain()`` and ``profile()`` procedures.
+"""
+from builtins import object
+import re
+
+__all__ = ['QueryPlan', 'parse_report']
+
+_timing_re = re.compile(
+    r'^\s*time\s+(?P<time>[-+.0-9e]+)%\s+fanout\s+(?P<fanout>[-+.0-9e]+)'
+    r'\s+input\s+(?P<input>[-+.0-9e]+)\s+rows?', re.IGNORECASE)
+_total_re = re.compile(r'^\s*(?P<msec>[0-9]+)\s+msec\b', re.IGNORECASE)
+
+
+def parse_report(lines):
+    """
+    Split the lines of a profile report into operators.
+
+    Virtuoso prints the timing of an operator on the line preceding its
+    description, as ``time 1.2% fanout 3 input 1 rows``; the summary
+    after the last operator, from the ``msec`` line on, is not part of
+    it. Returns a list of dicts with the keys ``operator`` (first line
+    of the description, None if it has none), ``detail`` (all the lines
+    of the description), ``time_pct``, ``fanout`` and ``input_rows``.
+    """
+    operators = []
+    current = None
+    for line in lines:
+        match = _timing_re.match(line)
+        if match is not None:
+            current = dict(
+                operator=None,
+                detail=[],
+                time_pct=float(match.group('time')),
+                fanout=float(match.group('fanout')),
+                input_rows=float(match.group('input')))
+            operators.append(current)
+            continue
+        if _total_re.match(line):
+            break
+        text = line.strip().strip('{}').strip()
+        if current is None or not text:
+            continue
+        if current['operator'] is None:
+            current['operator'] = text
+        current['detail'].append(line.rstrip())
+    return operators
+
+
+class QueryPlan(object):
+    """
+    The plan of a SPARQL query, as returned by
+    :meth:`virtuoso.vstore.Virtuoso.explain` and
+    :meth:`virtuoso.vstore.Virtuoso.profile`.
+
+    :ivar query: the SPASQL statement, with all rewriting applied
+    :ivar sql: the SQL Virtuoso generated for the query
+    :ivar lines: the report of the server, one string per line
+    :ivar operators: the operators of a profile, see :func:`parse_report`
+    :ivar total_msec: the execution time of a profile, in milliseconds
+    """
+
+    def __init__(self, query, sql, report, profiled=False):
+        self.query = query
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8')
+        self.sql = sql
+        self.profiled = profiled
+        self.lines = []
+        for chunk in report:
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode('utf-8')
+            self.lines.extend((chunk or '').splitlines())
+        self.operators = parse_report(self.lines) if profiled else []
+        self.total_msec = None
+        if profiled:
+            for line in reversed(self.lines):
+                match = _total_re.match(line)
+                if match is not None:
+                    self.total_msec = int(match.group('msec'))
+                    break
+
+    def __str__(self):
+        return "\n".join(self.lines)
+
+    def __repr__(self):
+        return "<QueryPlan %s, %d lines>" % (
+            "profile" if self.profiled else "explain", len(self.lines))
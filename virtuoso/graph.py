@@ -0,0 +1,166 @@
+"""
+Graphs using the projected scans of the Virtuoso store.
+
+rdflib implements :meth:`~rdflib.graph.Graph.subjects`,
+:meth:`~rdflib.graph.Graph.objects` and the like by reading whole
+triples, and deduplicates the terms in Python when ``unique`` is set.
+:class:`VirtuosoGraph` and :class:`VirtuosoConjunctiveGraph` fetch only
+the terms asked for, with a ``SELECT DISTINCT`` when ``unique`` is set,
+through :meth:`~virtuoso.vstore.Virtuoso.scan`::
+
+    graph = VirtuosoGraph(store, identifier=URIRef(ONTOLOGY))
+    classes = set(graph.subjects(RDF.type, OWL.Class, unique=True))
+
+Patterns with a property path as predicate, including those of
+:meth:`~rdflib.graph.Graph.transitive_objects` and
+:meth:`~rdflib.graph.Graph.transitive_subjects`, are evaluated by
+Virtuoso in a single query rather than by a query per hop::
+
+    ancestors = set(graph.objects(cls, RDFS.subClassOf * "+"))
+
+On other stores they behave as their rdflib base classes; with rdflib
+before 6, whose iterators have no ``unique`` argument, the terms are
+then deduplicated here.
+"""
+from builtins import object
+
+from rdflib.graph import Graph, ConjunctiveGraph
+from rdflib.paths import Path, OneOrMore
+
+__all__ = ['ProjectionMixin', 'VirtuosoGraph', 'VirtuosoConjunctiveGraph']
+
+try:
+    from inspect import signature
+    _base_unique = "unique" in signature(Graph.subjects).parameters
+except ImportError:  # python 2
+    from inspect import getargspec
+    _base_unique = "unique" in getargspec(Graph.subjects).args
+
+
+def _distinct(rows):
+    seen = set()
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield row
+
+
+class ProjectionMixin(object):
+    """
+    Projects the term iterators of a graph on the store, when the store
+    supports it.
+    """
+
+    def _scan_context(self):
+        return self
+
+    def _scan(self, statement, columns, unique):
+        """
+        Return the iterator of the projected scan, or None when the
+        store or the statement do not allow it.
+        """
+        scan = getattr(self.store, "scan", None)
+        if scan is None or any(isinstance(t, Path) for t in statement):
+            return None
+        return scan(statement, columns, self._scan_context(), unique)
+
+    def triples(self, triple, *args, **kwargs):
+        if (len(triple) == 3 and isinstance(triple[1], Path) and not args
+                and not kwargs and getattr(self.store, "scan", None) is not None):
+            # evaluated by the store rather than hop by hop
+            return (t for t, contexts in
+                    self.store.triples(triple, self._scan_context()))
+        return super(ProjectionMixin, self).triples(triple, *args, **kwargs)
+
+    def _base(self, name, unique, *args):
+        """
+        Call the iterator ``name`` of the rdflib base class, giving it
+        ``unique`` if it takes it.
+        """
+        method = getattr(super(ProjectionMixin, self), name)
+        if _base_unique:
+            return method(*args, unique=unique)
+        rows = method(*args)
+        return _distinct(rows) if unique else rows
+
+    def _transitive(self, start, predicate, column):
+        yield start
+        path = predicate * OneOrMore
+        if column == "O":
+            terms = (o for s, p, o in self.triples((start, path, None)))
+        else:
+            terms = (s for s, p, o in self.triples((None, path, start)))
+        for term in terms:
+            if term != start:
+                yield term
+
+    def _transitive_pushdown(self, start, predicate, remember):
+        return (remember is None and start is not None
+                and predicate is not None and not isinstance(predicate, Path)
+                and getattr(self.store, "scan", None) is not None)
+
+    def transitive_objects(self, subject, predicate, remember=None):
+        if not self._transitive_pushdown(subject, predicate, remember):
+            return super(ProjectionMixin, self).transitive_objects(
+                subject, predicate, remember)
+        return self._transitive(subject, predicate, "O")
+
+    def transitive_subjects(self, predicate, object, remember=None):
+        if not self._transitive_pushdown(object, predicate, remember):
+            return super(ProjectionMixin, self).transitive_subjects(
+                predicate, object, remember)
+        return self._transitive(object, predicate, "S")
+
+    def subjects(self, predicate=None, object=None, unique=False):
+        rows = self._scan((None, predicate, object), "S", unique)
+        if rows is None:
+            return self._base("subjects", unique, predicate, object)
+        return (s for (s,) in rows)
+
+    def predicates(self, subject=None, object=None, unique=False):
+        rows = self._scan((subject, None, object), "P", unique)
+        if rows is None:
+            return self._base("predicates", unique, subject, object)
+        return (p for (p,) in rows)
+
+    def objects(self, subject=None, predicate=None, unique=False):
+        rows = self._scan((subject, predicate, None), "O", unique)
+        if rows is None:
+            return self._base("objects", unique, subject, predicate)
+        return (o for (o,) in rows)
+
+    def subject_objects(self, predicate=None, unique=False):
+        rows = self._scan((None, predicate, None), "SO", unique)
+        if rows is None:
+            return self._base("subject_objects", unique, predicate)
+        return rows
+
+    def subject_predicates(self, object=None, unique=False):
+        rows = self._scan((None, None, object), "SP", unique)
+        if rows is None:
+            return self._base("subject_predicates", unique, object)
+        return rows
+
+    def predicate_objects(self, subject=None, unique=False):
+        rows = self._scan((subject, None, None), "PO", unique)
+        if rows is None:
+            return self._base("predicate_objects", unique, subject)
+        return rows
+
+
+class VirtuosoGraph(ProjectionMixin, Graph):
+    """
+    A :class:`~rdflib.graph.Graph` projecting its term iterators on the
+    store.
+    """
+
+
+class VirtuosoConjunctiveGraph(ProjectionMixin, ConjunctiveGraph):
+    """
+    A :class:`~rdflib.graph.ConjunctiveGraph` projecting its term
+    iterators on the store, over all graphs unless ``default_union`` is
+    unset.
+    """
+
+    def _scan_context(self):
+        return None if self.default_union else self.default_context
@@ -0,0 +1,226 @@
+"""
+Local replicas of hot graphs.
+
+A store given :class:`LocalGraphs` as ``Virtuoso(dsn,
+local_graphs=LocalGraphs())`` serves the reads of the graphs pinned in
+it (``triples()``, membership tests, ``len()`` and the projections of
+:class:`~virtuoso.graph.VirtuosoGraph`) from an in-memory rdflib graph
+rather than from Virtuoso.
+
+Every ``refresh`` seconds at most, the first read of a graph computes
+its fingerprint on the server, by default the number of its triples,
+and reloads the graph if the fingerprint changed. The number of
+triples misses the writes of other clients that keep it, e.g. the
+replacement of a value; give a fingerprint that changes on every
+write, such as a version the writers maintain, where they matter.
+Writes through the stores sharing the local graphs are applied to them
+as soon as they are done, and reload them at their next check, or, within a transaction, reload the graphs
+they touched after the commit or rollback; updates run by ``query()``
+reload the graphs they write. Reads within a transaction go to the
+server.
+
+Graphs are fingerprinted and loaded on the primary, as replicas may lag
+behind it, and without holding the lock of the local graphs, so that
+reads of the other graphs go on meanwhile.
+"""
+from builtins import object
+import threading
+
+from rdflib.graph import Graph
+
+from virtuoso.metrics import MetricsRegistry, clock
+from virtuoso.vstore import _term_n3
+
+__all__ = ['LocalGraphs', 'count_fingerprint']
+
+
+def _read(store, q):
+    """
+    Return the rows of the SELECT ``q`` run on the primary of
+    ``store``: queries given a cursor are not routed to replicas.
+    """
+    cursor = store.cursor()
+    try:
+        return list(store._query(q, cursor))
+    finally:
+        cursor.close()
+
+
+def count_fingerprint(store, context):
+    """
+    The number of triples of ``context``, counted by Virtuoso. It does
+    not change when a write keeps the number, e.g. replacing a value.
+    """
+    q = u'SELECT COUNT(*) WHERE { GRAPH %s { ?s ?p ?o } }' % _term_n3(context)
+    for count, in _read(store, q):
+        return int(count)
+    return 0
+
+
+class _Local(object):
+    def __init__(self):
+        self.graph = None
+        self.fingerprint = None
+        self.checked = None
+        # reload on the next read
+        self.stale = True
+        # changed by each write and expiry, which a graph loaded
+        # meanwhile may have missed
+        self.generation = 0
+
+
+class LocalGraphs(object):
+    """
+    In-memory copies of the graphs pinned with :meth:`pin`, checked
+    for changes every ``refresh`` seconds by comparing the result of
+    ``fingerprint(store, graph_name)`` (by default
+    :func:`count_fingerprint`) to that of the last check. A fingerprint
+    should read the primary, e.g. running its query with a cursor of
+    ``store``.
+
+    ``registry`` (by default a new :class:`~virtuoso.metrics.MetricsRegistry`)
+    receives the ``local.reads`` and ``local.reloads`` counters.
+    """
+
+    def __init__(self, refresh=1.0, fingerprint=None, registry=None):
+        self.refresh = refresh
+        self.fingerprint = fingerprint or count_fingerprint
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self._graphs = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, context):
+        return getattr(context, "identifier", context) in self._graphs
+
+    def pin(self, store, context):
+        """
+        Load ``context`` from ``store`` and serve its reads locally.
+        """
+        identifier = getattr(context, "identifier", context)
+        with self._lock:
+            local = self._graphs.setdefault(identifier, _Local())
+            local.stale = True
+            local.generation += 1
+        self._current(store, identifier)
+
+    def unpin(self, context):
+        with self._lock:
+            self._graphs.pop(getattr(context, "identifier", context), None)
+
+    def _load(self, store, identifier):
+        graph = Graph()
+        q = u'SELECT ?s ?p ?o WHERE { GRAPH %s { ?s ?p ?o } }' % _term_n3(
+            identifier)
+        for triple in _read(store, q):
+            graph.add(tuple(triple))
+        return graph
+
+    def _current(self, store, identifier):
+        """
+        Return the up-to-date local copy of a pinned graph, or None if
+        it is not pinned or was written while being reloaded. The server
+        is queried without holding the lock.
+        """
+        with self._lock:
+            local = self._graphs.get(identifier)
+            if local is None:
+                return None
+            if not local.stale and clock() - local.checked < self.refresh:
+                return local.graph
+        # fingerprinted first: a change made while loading shows later
+        fingerprint = self.fingerprint(store, identifier)
+        with self._lock:
+            # written through a store since the last check, the copy is
+            # reloaded, as the fingerprint may also hide others' writes
+            if not local.stale and local.fingerprint is not None:
+                if fingerprint == local.fingerprint:
+                    local.checked = clock()
+                    return local.graph
+            generation = local.generation
+        graph = self._load(store, identifier)
+        with self._lock:
+            if (self._graphs.get(identifier) is not local
+                    or local.generation != generation):
+                # read from the server, reloaded on the next read
+                return None
+            local.graph = graph
+            local.fingerprint = fingerprint
+            local.checked = clock()
+            local.stale = False
+        self.registry.counter('local.reloads').inc()
+        return graph
+
+    def triples(self, store, statement, context):
+        """
+        Return the list of the triples of ``context`` matching
+        ``statement``, or None if ``context`` is not pinned. The terms
+        of ``statement`` are compared with those read from Virtuoso:
+        those Virtuoso does not give back as they are, such as the
+        ``xsd:float`` literals it widens, do not match.
+        """
+        identifier = getattr(context, "identifier", context)
+        graph = self._current(store, identifier)
+        if graph is None:
+            return None
+        with self._lock:
+            triples = list(graph.triples(statement))
+        self.registry.counter('local.reads').inc()
+        return triples
+
+    def count(self, store, context):
+        """
+        Return the number of triples of ``context``, or None if it is
+        not pinned.
+        """
+        identifier = getattr(context, "identifier", context)
+        graph = self._current(store, identifier)
+        if graph is None:
+            return None
+        with self._lock:
+            count = len(graph)
+        self.registry.counter('local.reads').inc()
+        return count
+
+    def _write(self, quads, method):
+        with self._lock:
+            for s, p, o, context in quads:
+                identifier = getattr(context, "identifier", context)
+                if identifier is None:
+                    targets = list(self._graphs.values())
+                else:
+                    targets = [self._graphs.get(identifier)]
+                for local in targets:
+                    if local is None:
+                        continue
+                    local.generation += 1
+                    if not local.stale:
+                        getattr(local.graph, method)((s, p, o))
+                        local.fingerprint = None
+
+    def added(self, quads):
+        """
+        Apply the insertion of ``(s, p, o, context)`` quads.
+        """
+        self._write(quads, "add")
+
+    def removed(self, quads):
+        """
+        Apply the deletion of quads, the None terms matching any, as
+        does a None context.
+        """
+        self._write(quads, "remove")
+
+    def expire(self, context=None):
+        """
+        Reload ``context``, or all the graphs, on their next read.
+        """
+        with self._lock:
+            if context is None:
+                targets = list(self._graphs.values())
+            else:
+                targets = [self._graphs.get(
+                    getattr(context, "identifier", context))]
+            for local in targets:
+                if local is not None:
+                    local.stale = True
+                    local.generation += 1
@@ -0,0 +1,228 @@
+"""
+Instrumentation of the Virtuoso store.
+
+An :class:`Instrumentation` given to the store as
+``Virtuoso(..., instrumentation=Instrumentation())`` receives a
+:class:`QueryStats` for every statement the store runs. It aggregates
+them in a :class:`MetricsRegistry` and passes them on to any hooks,
+which can forward them to an external metrics system. A store without
+instrumentation does not measure anything.
+"""
+from builtins import object
+from collections import deque
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Counter', 'Histogram', 'MetricsRegistry', 'QueryStats',
+           'Instrumentation', 'clock', 'percentile']
+
+try:
+    #: The clock used for all measurements, in seconds.
+    from time import perf_counter as clock
+except ImportError:  # python 2
+    from time import time as clock
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted sequence.
+    """
+    if not sorted_values:
+        return None
+    rank = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+class Counter(object):
+    """
+    A monotonic counter.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    A distribution of observed values. Count, total, min and max are
+    exact; percentiles are computed on the last ``reservoir`` values.
+    """
+
+    def __init__(self, name, reservoir=1024):
+        self.name = name
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self._values = deque(maxlen=reservoir)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            self._values.append(value)
+
+    def percentile(self, fraction):
+        with self._lock:
+            values = sorted(self._values)
+        return percentile(values, fraction)
+
+    def snapshot(self):
+        with self._lock:
+            values = sorted(self._values)
+            return dict(count=self.count, total=self.total,
+                        min=self.min, max=self.max,
+                        p50=percentile(values, 0.5),
+                        p95=percentile(values, 0.95),
+                        p99=percentile(values, 0.99))
+
+
+class MetricsRegistry(object):
+    """
+    A named collection of counters and histograms.
+    """
+
+    def __init__(self, reservoir=1024):
+        self.reservoir = reservoir
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = factory()
+        return metric
+
+    def counter(self, name):
+        return self._get(name, lambda: Counter(name))
+
+    def histogram(self, name):
+        return self._get(name, lambda: Histogram(name, self.reservoir))
+
+    def snapshot(self):
+        """
+        Return the current value of every metric, as a dict keyed by
+        metric name. Histograms are summarized as dicts.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return dict((m.name, m.snapshot()) for m in metrics)
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+
+class QueryStats(object):
+    """
+    Measurements for a single statement. Times are in seconds.
+
+    ``kind`` is one of ``select``, ``ask``, ``construct``, ``update``,
+    ``commit``, ``batch``, ``explain`` and ``profile``. ``batch_size`` is the number of quads
+    written by an :meth:`~virtuoso.vstore.Virtuoso.addN` or
+    :meth:`~virtuoso.vstore.Virtuoso.removeN` batch, or of queries run
+    by a :meth:`~virtuoso.vstore.Virtuoso.query_batch`. ``retries`` is
+    the number of times an update was run again after a deadlock.
+    """
+    __slots__ = ('query', 'kind', 'rewrite_time', 'execute_time',
+                 'fetch_time', 'decode_time', 'commit_time', 'rows',
+                 'iri_lookups', 'bytes', 'batch_size', 'retries', 'error')
+
+    def __init__(self, query=None, kind=None, batch_size=None):
+        self.query = query
+        self.kind = kind
+        self.rewrite_time = 0.0
+        self.execute_time = 0.0
+        self.fetch_time = 0.0
+        self.decode_time = 0.0
+        self.commit_time = 0.0
+        self.rows = 0
+        self.iri_lookups = 0
+        self.bytes = 0
+        self.batch_size = batch_size
+        self.retries = 0
+        self.error = None
+
+    @property
+    def total_time(self):
+        return (self.rewrite_time + self.execute_time + self.fetch_time
+                + self.decode_time + self.commit_time)
+
+    def as_dict(self):
+        d = dict((k, getattr(self, k)) for k in self.__slots__)
+        d['total_time'] = self.total_time
+        return d
+
+
+class Instrumentation(object):
+    """
+    Collects the :class:`QueryStats` of a store into a
+    :class:`MetricsRegistry` and dispatches them to hooks.
+
+    A hook is a callable taking a :class:`QueryStats`; exceptions
+    raised by hooks are logged and otherwise ignored.
+    """
+
+    def __init__(self, registry=None, hooks=()):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.hooks = list(hooks)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def snapshot(self):
+        return self.registry.snapshot()
+
+    def query_done(self, stats):
+        """
+        Record the measurements of a finished statement.
+        """
+        registry = self.registry
+        kind = stats.kind or 'unknown'
+        registry.counter('queries.%s' % kind).inc()
+        if stats.error is not None:
+            registry.counter('queries.errors').inc()
+        if kind in ('update', 'commit'):
+            if stats.batch_size is not None:
+                registry.histogram('write.batch_size').observe(stats.batch_size)
+            registry.histogram('write.execute_time').observe(stats.execute_time)
+            registry.histogram('write.commit_time').observe(stats.commit_time)
+            if stats.retries:
+                registry.counter('write.retries').inc(stats.retries)
+                registry.counter('write.retried').inc()
+        else:
+            registry.histogram('query.rewrite_time').observe(stats.rewrite_time)
+            registry.histogram('query.execute_time').observe(stats.execute_time)
+            registry.histogram('query.fetch_time').observe(stats.fetch_time)
+            registry.histogram('query.decode_time').observe(stats.decode_time)
+            registry.histogram('query.rows').observe(stats.rows)
+            registry.histogram('query.iri_lookups').observe(stats.iri_lookups)
+            registry.histogram('query.bytes').observe(stats.bytes)
+        for hook in self.hooks:
+            try:
+                hook(stats)
+            except Exception:
+                log.exception("instrumentation hook %r failed", hook)
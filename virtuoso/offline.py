@@ -0,0 +1,506 @@
+"""
+An in-process stand-in for a Virtuoso server.
+
+:class:`OfflineServer` keeps its quads in an rdflib memory store and
+hands out connections that behave like pyodbc connections to Virtuoso
+for the statements this package emits: SPARQL queries and updates
+(including the Virtuoso ``DELETE FROM GRAPH`` form and the ``DEFINE``
+options), ``__ro2sq``, the namespace procedures, ``explain()``,
+``profile()``, the batch procedure of ``query_batch`` (created
+procedures are only recorded, for lookups in ``SYS_PROCEDURES``) and
+transaction control. Results come back as SPASQL
+6-tuples ``(value, dvtype, dttype, flag, lang, dtype)``, so the whole
+decoding path of the store is exercised::
+
+    server = OfflineServer()
+    store = Virtuoso(connection=server.connect())
+    # or, for code that connects by itself:
+    store = Virtuoso("offline", connect=server.connect)
+
+Each connection has its own transaction: writes are visible to the
+other connections at once, and undone by ``ROLLBACK WORK``. SPARQL is
+evaluated by rdflib, so performance figures obtained with the stand-in
+measure the client side only.
+"""
+from builtins import object
+from collections import deque
+from struct import pack, unpack
+import threading
+import logging
+import re
+
+import pyodbc
+from rdflib.graph import ConjunctiveGraph
+from rdflib.namespace import XSD
+from rdflib.plugins.sparql.processor import (
+    SPARQLProcessor, SPARQLResult, SPARQLUpdateProcessor)
+try:
+    from rdflib.plugins.stores.memory import Memory
+except ImportError:  # rdflib < 6
+    from rdflib.plugins.memory import IOMemory as Memory
+from rdflib.term import URIRef, BNode, Literal, Variable
+
+from virtuoso.metrics import clock
+
+__all__ = ['OfflineServer', 'OfflineConnection', 'OfflineCursor',
+           'encode_term']
+
+log = logging.getLogger(__name__)
+
+_define_re = re.compile(
+    r'^\s*DEFINE\s+(\S+)\s+("[^"]*"|<[^>]*>|[0-9]+)', re.IGNORECASE)
+_prologue_re = re.compile(
+    r'^(\s*#[^\n]*\n|\s+|BASE\s*<[^>]*>|PREFIX\s+[\w-]*:\s*<[^>]*>)*',
+    re.IGNORECASE)
+_query_form_re = re.compile(r'(SELECT|ASK|CONSTRUCT|DESCRIBE)\b', re.IGNORECASE)
+_from_re = re.compile(r'\bFROM\s+(NAMED\s+)?<([^>]*)>\s*', re.IGNORECASE)
+_count_re = re.compile(
+    r'\bSELECT\s+((?:DISTINCT\s+)?)(COUNT\s*\(\s*(?:DISTINCT\s+)?[^()]*\))\s*(?=WHERE\b|FROM\b|\{)',
+    re.IGNORECASE)
+_delete_from_re = re.compile(
+    r'^\s*DELETE\s+FROM\s+(?:GRAPH\s+)?(<[^>]*>)\s*\{(.*?)\}\s*FROM\s+<[^>]*>\s*WHERE\s*\{(.*)\}\s*$',
+    re.IGNORECASE | re.DOTALL)
+_insert_into_re = re.compile(
+    r'\b(INSERT|DELETE)\s+(?:DATA\s+)?(?:INTO|FROM)\s+(?:GRAPH\s+)?(<[^>]*>)\s*'
+    r'\{(.*?)\}\s*(WHERE\s*\{.*\})?\s*$',
+    re.IGNORECASE | re.DOTALL)
+_select_all_re = re.compile(r'\bSELECT\s+((DISTINCT|REDUCED)\s+)?\*', re.IGNORECASE)
+_variable_re = re.compile(r'[?$](\w+)')
+_batch_re = re.compile(r'^\s*(DB\.DBA\.)?VIRTUOSO_PYTHON_BATCH\s*\(', re.IGNORECASE)
+_order_by_re = re.compile(r'\bORDER\s+BY\b', re.IGNORECASE)
+_values_re = re.compile(r'\bVALUES\b', re.IGNORECASE)
+_create_procedure_re = re.compile(r'^\s*CREATE\s+PROCEDURE\s+([\w.]+)', re.IGNORECASE)
+_procedure_exists_re = re.compile(
+    r'^\s*SELECT\s+COUNT\s*\(\s*\*\s*\)\s+FROM\s+DB\.DBA\.SYS_PROCEDURES\s+'
+    r'WHERE\s+P_NAME\s*=\s*\?\s*$', re.IGNORECASE)
+_ro2sq_re = re.compile(r'^\s*SELECT\s+__ro2sq\s*\(\s*(\d+)\s*\)\s*$', re.IGNORECASE)
+_contexts_re = re.compile(
+    r'^\s*SELECT\s+DISTINCT\s+__ro2sq\s*\(\s*G\s*\)\s+FROM\s+(DB\.DBA\.)?RDF_QUAD\s*$',
+    re.IGNORECASE)
+_ns_decls_re = re.compile(r'^\s*(DB\.DBA\.)?XML_SELECT_ALL_NS_DECLS\s*\(\s*\)\s*$',
+                          re.IGNORECASE)
+_set_ns_re = re.compile(
+    r"^\s*(DB\.DBA\.)?XML_SET_NS_DECL\s*\(\s*'([^']*)'\s*,\s*'([^']*)'",
+    re.IGNORECASE)
+
+_integer_types = set(XSD[t] for t in (
+    "integer", "int", "long", "short", "byte", "nonNegativeInteger",
+    "nonPositiveInteger", "negativeInteger", "positiveInteger",
+    "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte"))
+
+
+def encode_term(term, iri_id=None):
+    """
+    Encode an rdflib term as the SPASQL tuple Virtuoso would return.
+    If ``iri_id`` is given, IRIs are returned as IRI_IDs obtained from it,
+    as with ``DEFINE output:valmode "LONG"``.
+    """
+    if term is None:
+        return (None, pyodbc.VIRTUOSO_DV_DB_NULL, 0, 0, None, None)
+    if isinstance(term, BNode):
+        term = URIRef("nodeID://%s" % term)
+    if isinstance(term, URIRef):
+        if iri_id is not None:
+            return (iri_id(term), pyodbc.VIRTUOSO_DV_IRI_ID, 0, 0, None, None)
+        return (str(term), pyodbc.VIRTUOSO_DV_STRING, 0, 1, None, None)
+    datatype = term.datatype
+    if datatype is None:
+        return (str(term), pyodbc.VIRTUOSO_DV_STRING, 0, 0,
+                term.language or None, None)
+    if datatype in _integer_types:
+        try:
+            return (int(term), pyodbc.VIRTUOSO_DV_LONG_INT, 0, 0, None, None)
+        except ValueError:
+            pass
+    elif datatype == XSD.float:
+        # stored in single precision, and widened by the driver
+        value = unpack('f', pack('f', float(term)))[0]
+        return (value, pyodbc.VIRTUOSO_DV_SINGLE_FLOAT, 0, 0, None, None)
+    elif datatype == XSD.double:
+        return (float(term), pyodbc.VIRTUOSO_DV_DOUBLE_FLOAT, 0, 0, None, None)
+    elif datatype == XSD.decimal:
+        return (str(term), pyodbc.VIRTUOSO_DV_NUMERIC, 0, 0, None, None)
+    elif datatype == XSD.dateTime:
+        return (str(term).replace("T", " "), pyodbc.VIRTUOSO_DV_DATETIME,
+                pyodbc.VIRTUOSO_DT_TYPE_DATETIME, 0, None, None)
+    elif datatype == XSD.date:
+        return (str(term), pyodbc.VIRTUOSO_DV_DATE, 0, 0, None, None)
+    elif datatype == XSD.time:
+        return (str(term), pyodbc.VIRTUOSO_DV_TIME, 0, 0, None, None)
+    elif datatype == XSD.string:
+        return (str(term), pyodbc.VIRTUOSO_DV_STRING, 0, 0, None, str(datatype))
+    return (str(term), pyodbc.VIRTUOSO_DV_RDF, 0, 0, None, str(datatype))
+
+
+def _term_order(term):
+    if term is None:
+        return (3, u'')
+    if isinstance(term, URIRef):
+        return (0, term)
+    if isinstance(term, BNode):
+        return (1, term)
+    return (2, term.n3())
+
+
+class _JournalingMemory(Memory):
+    """
+    A memory store recording the changes made while ``journal`` is set,
+    so that they can be rolled back.
+    """
+    journal = None
+
+    def add(self, triple, context, quoted=False):
+        journal = self.journal
+        if journal is not None and not any(
+                True for _ in Memory.triples(self, triple, context)):
+            journal.append((True, triple, context.identifier))
+        Memory.add(self, triple, context, quoted)
+
+    def remove(self, triple, context=None):
+        journal = self.journal
+        if journal is not None:
+            for t, contexts in list(Memory.triples(self, triple, context)):
+                for ctx in ([context] if context is not None else list(contexts)):
+                    journal.append((False, t, ctx.identifier))
+        Memory.remove(self, triple, context)
+
+
+_lock = threading.RLock()
+
+
+class OfflineServer(object):
+    """
+    The shared state of the stand-in: the quads, the IRI_ID table and
+    the namespace declarations.
+    """
+
+    def __init__(self):
+        self.graph = ConjunctiveGraph(_JournalingMemory())
+        self.namespaces = {}
+        self.procedures = set()
+        # rdflib's SPARQL parser is not thread-safe, so all the servers
+        # of a process run one statement at a time
+        self.lock = _lock
+        self._iri_ids = {}
+        self._iris = {}
+
+    def connect(self, dsn=None, **kwargs):
+        """
+        Return a new :class:`OfflineConnection`; the ``dsn`` is ignored.
+        """
+        return OfflineConnection(self)
+
+    def iri_id(self, iri):
+        iri = str(iri)
+        with self.lock:
+            i = self._iri_ids.get(iri)
+            if i is None:
+                i = self._iri_ids[iri] = 1000000 + len(self._iri_ids)
+                self._iris[i] = iri
+            return i
+
+    def iri(self, iri_id):
+        return self._iris[iri_id]
+
+    def load(self, data, format="nquads", **kwargs):
+        """
+        Parse RDF into the server, e.g. to set up fixtures.
+        """
+        with self.lock:
+            self.graph.parse(data=data, format=format, **kwargs)
+
+    def apply(self, journal):
+        """
+        Undo the changes recorded in a journal, latest first.
+        """
+        store = self.graph.store
+        with self.lock:
+            while journal:
+                added, triple, ctx_id = journal.pop()
+                context = self.graph.get_context(ctx_id)
+                if added:
+                    Memory.remove(store, triple, context)
+                else:
+                    Memory.add(store, triple, context)
+
+
+class OfflineConnection(object):
+    """
+    A pyodbc-like connection to an :class:`OfflineServer`.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.journal = []
+        self.closed = False
+
+    def cursor(self):
+        return OfflineCursor(self)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+    def commit(self):
+        del self.journal[:]
+
+    def rollback(self):
+        self.server.apply(self.journal)
+
+    def close(self):
+        self.rollback()
+        self.closed = True
+
+    def setdecoding(self, *args, **kwargs):
+        pass
+
+    def setencoding(self, *args, **kwargs):
+        pass
+
+    def getinfo(self, info_type):
+        return "OpenLink Virtuoso"
+
+
+class OfflineCursor(object):
+    """
+    A pyodbc-like cursor on an :class:`OfflineConnection`. Results are
+    computed when the statement is executed.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.server = connection.server
+        self.description = None
+        self.rowcount = -1
+        self._rows = deque()
+        self._sets = deque()
+
+    def _set_result(self, columns, rows):
+        self.description = [(c, None, None, None, None, None, True)
+                            for c in columns] if columns is not None else None
+        self._rows = deque(rows)
+        self.rowcount = len(self._rows) if columns is not None else -1
+        self._sets = deque()
+
+    def execute(self, sql, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = tuple(params[0])
+        statement = sql.strip()
+        keyword = statement.split(None, 1)[0].upper() if statement else ''
+        if keyword == 'SPARQL':
+            self._sparql(statement[len('SPARQL'):])
+        elif keyword == 'SET':
+            self._set_result(None, ())
+        elif statement.upper() == 'COMMIT WORK':
+            self.connection.commit()
+            self._set_result(None, ())
+        elif statement.upper() == 'ROLLBACK WORK':
+            self.connection.rollback()
+            self._set_result(None, ())
+        else:
+            self._sql(statement, params)
+        return self
+
+    def _sql(self, statement, params):
+        server = self.server
+        match = _ro2sq_re.match(statement)
+        if match is not None:
+            return self._set_result(["iri"], [(server.iri(int(match.group(1))),)])
+        if _contexts_re.match(statement):
+            with server.lock:
+                rows = [(str(c.identifier),) for c in server.graph.contexts()
+                        if not isinstance(c.identifier, BNode) and len(c)]
+            return self._set_result(["G"], rows)
+        if _ns_decls_re.match(statement):
+            return self._set_result(["PREFIX", "URI"],
+                                    sorted(server.namespaces.items()))
+        match = _set_ns_re.match(statement)
+        if match is not None:
+            server.namespaces[match.group(2)] = match.group(3)
+            return self._set_result(None, ())
+        match = _create_procedure_re.match(statement)
+        if match is not None:
+            server.procedures.add(match.group(1).upper())
+            return self._set_result(None, ())
+        if _procedure_exists_re.match(statement):
+            exists = params[0].upper() in server.procedures
+            return self._set_result(["COUNT"], [(int(exists),)])
+        lowered = statement.lower()
+        if _batch_re.match(statement):
+            return self._batch(params)
+        if lowered.startswith('select sparql_to_sql_text('):
+            return self._set_result(
+                ["sql"], [(u"-- offline stand-in, no SQL for:\n" + params[0],)])
+        if lowered.startswith('explain(') or lowered.startswith('profile('):
+            return self._plan(lowered.startswith('profile('), params[0])
+        raise pyodbc.Error('42000', 'Unsupported statement in offline '
+                           'stand-in: %s' % statement)
+
+    def _batch(self, statements):
+        # as the procedure of Virtuoso.query_batch: a result set per
+        # statement, or one describing its error
+        sets = []
+        for statement in statements:
+            try:
+                self.execute(statement)
+                columns = [col[0] for col in self.description]
+                sets.append((columns, list(self._rows)))
+            except pyodbc.Error as e:
+                sets.append((['__error_state', '__error_message'],
+                             [(e.args[0], e.args[1])]))
+        columns, rows = sets[0] if sets else (None, ())
+        self._set_result(columns, rows)
+        self._sets = deque(sets[1:])
+
+    def _plan(self, profile, q):
+        description = [u"offline rdflib evaluation of", q]
+        if profile:
+            start = clock()
+            self.execute(q)
+            elapsed = clock() - start
+            rows = len(self._rows)
+            # as Virtuoso, the timing of an operator comes first
+            report = [u"{", u"time 100%% fanout %d input 1 rows" % rows]
+            report += description + [u"}"]
+            report.append(u" %d msec 100%% cpu, %d rows" % (1000 * elapsed, rows))
+        else:
+            report = [u"{"] + description + [u"}"]
+        self._set_result(["REPORT"], [(line,) for line in report])
+
+    def _sparql(self, q):
+        defines = {}
+        while True:
+            match = _define_re.match(q)
+            if match is None:
+                break
+            name, value = match.group(1).lower(), match.group(2)
+            defines.setdefault(name, []).append(value.strip('"<>'))
+            q = q[match.end():]
+        prologue_end = _prologue_re.match(q).end()
+        form = _query_form_re.match(q, prologue_end)
+        long_iri = [v.upper() for v in defines.get('output:valmode', ())] == ['LONG']
+        iri_id = self.server.iri_id if long_iri else None
+        if form is None:
+            return self._update(q, prologue_end,
+                                defines.get('input:default-graph-uri'))
+        form = form.group(1).upper()
+        default_graphs = defines.get('input:default-graph-uri', [])
+        named_graphs = defines.get('input:named-graph-uri', [])
+        # Strip the top-level FROM clauses (after a CONSTRUCT template
+        # too), which rdflib would try to load from the web
+        parts, last = [], 0
+        for match in _from_re.finditer(q, prologue_end):
+            start = match.start()
+            if q.count('{', 0, start) != q.count('}', 0, start):
+                continue
+            (named_graphs if match.group(1) else default_graphs).append(match.group(2))
+            parts.append(q[last:start])
+            last = match.end()
+        q = ' '.join(parts + [q[last:]])
+        # Virtuoso allows aggregates without an alias
+        q = _count_re.sub(r'SELECT \1(\2 AS ?callret)', q)
+        with self.server.lock:
+            dataset = self._dataset(default_graphs, named_graphs)
+            try:
+                # not dataset.query, as virtuoso.vsparql overrides the plugin
+                result = SPARQLResult(SPARQLProcessor(dataset).query(q))
+            except Exception as e:
+                raise pyodbc.Error('37000', 'SPARQL compiler: %s' % e)
+            if form == 'ASK':
+                return self._set_result(["__ask_retval"], [(1,)] if result.askAnswer else [])
+            if form in ('CONSTRUCT', 'DESCRIBE'):
+                return self._set_result(
+                    ["S", "P", "O"],
+                    [tuple(encode_term(t, iri_id) for t in triple)
+                     for triple in result.graph])
+            columns = [str(v) for v in result.vars]
+            if _select_all_re.search(q):
+                # Virtuoso orders SELECT * by first appearance
+                order = _variable_re.findall(q)
+                columns.sort(key=lambda v: order.index(v) if v in order else len(order))
+                result.vars = [Variable(v) for v in columns]
+            result = list(result)
+            if not _order_by_re.search(q) and not _values_re.search(q):
+                # a stable order, IRIs before blank nodes as in Virtuoso's
+                # indexes, rather than that of the memory store (VALUES
+                # rows keep theirs)
+                result.sort(key=lambda row: [_term_order(t) for t in row])
+            rows = [tuple(encode_term(t, iri_id) for t in row) for row in result]
+        self._set_result(columns, rows)
+
+    def _dataset(self, default_graphs, named_graphs):
+        graph = self.server.graph
+        graphs = set(default_graphs) | set(named_graphs)
+        if not graphs:
+            return graph
+        # Restrict the dataset to a copy of the requested graphs
+        dataset = ConjunctiveGraph()
+        for uri in graphs:
+            dataset.get_context(URIRef(uri)).__iadd__(
+                graph.get_context(URIRef(uri)))
+        return dataset
+
+    def _update(self, q, prologue_end, default_graphs=None):
+        prologue, body = q[:prologue_end], q[prologue_end:]
+        match = _delete_from_re.match(body)
+        if match is not None:
+            g, template, pattern = match.groups()
+            body = u'DELETE { GRAPH %s { %s } } WHERE { GRAPH %s { %s } }' % (
+                g, template, g, pattern)
+        match = _insert_into_re.match(body)
+        if match is not None:
+            op, g, triples, where = match.groups()
+            if where is None:
+                body = u'%s DATA { GRAPH %s { %s } }' % (op.upper(), g, triples)
+            else:
+                body = u'%s { GRAPH %s { %s } } %s' % (op.upper(), g, triples, where)
+        server = self.server
+        with server.lock:
+            target = server.graph
+            if default_graphs:
+                # the graph the update reads and writes by default
+                target = ConjunctiveGraph(target.store,
+                                          identifier=URIRef(default_graphs[0]))
+                target.default_union = False
+            server.graph.store.journal = self.connection.journal
+            try:
+                SPARQLUpdateProcessor(target).update(prologue + body)
+            except Exception as e:
+                raise pyodbc.Error('37000', 'SPARQL compiler: %s' % e)
+            finally:
+                server.graph.store.journal = None
+        self._set_result(None, ())
+
+    def __iter__(self):
+        while self._rows:
+            yield self._rows.popleft()
+
+    def fetchone(self):
+        return self._rows.popleft() if self._rows else None
+
+    def fetchmany(self, size=1):
+        return [self._rows.popleft() for i in range(min(size, len(self._rows)))]
+
+    def fetchall(self):
+        rows, self._rows = list(self._rows), deque()
+        return rows
+
+    def nextset(self):
+        if not self._sets:
+            self._set_result(None, ())
+            return False
+        sets = self._sets
+        self._set_result(*sets.popleft())
+        self._sets = sets
+        return True
+
+    def close(self):
+        self._rows = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # like pyodbc, commit on a clean exit
+        if exc_type is None:
+            self.connection.commit()
+        self.close()
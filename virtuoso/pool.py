@@ -0,0 +1,249 @@
+"""
+Pools of Virtuoso stores.
+
+A pyodbc connection must not be used by several threads at once, so
+code running statements concurrently needs one store per thread.
+:class:`StorePool` keeps a bounded number of stores, each on its own
+connection, and lends them out::
+
+    pool = StorePool(store.clone, size=8)
+    with pool.store() as s:
+        s.query(...)
+
+:class:`ProcessStoreExecutor` runs tasks in a pool of processes, each
+with its own store, for CPU-bound work such as decoding large results
+or parsing data to load::
+
+    with ProcessStoreExecutor(StoreFactory(dsn), max_workers=8) as executor:
+        futures = [executor.query(q) for q in queries]
+"""
+from builtins import object
+from collections import deque
+from contextlib import contextmanager
+import threading
+import logging
+
+from virtuoso.metrics import clock
+
+__all__ = ['StorePool', 'PoolTimeout', 'StoreFactory', 'ProcessStoreExecutor']
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no store became available in time.
+    """
+
+
+class StorePool(object):
+    """
+    A bounded pool of stores. ``factory`` is called without arguments
+    to create a store, e.g. ``store.clone`` or
+    ``lambda: Virtuoso(dsn, long_iri=True)``; stores are created on
+    demand, up to ``size``.
+
+    A store is returned to the pool with any pending transaction rolled
+    back.
+    """
+
+    def __init__(self, factory, size=8):
+        if size < 1:
+            raise ValueError("The pool size must be positive")
+        self.factory = factory
+        self.size = size
+        self._idle = deque()
+        self._created = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Take a store from the pool, creating it if needed. Waits for a
+        store to be released when ``size`` stores are in use, at most
+        ``timeout`` seconds if given.
+        """
+        deadline = None if timeout is None else clock() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise ValueError("The pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self.size:
+                    self._created += 1
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            "No store available after %ss" % timeout)
+                    self._cond.wait(remaining)
+        try:
+            return self.factory()
+        except:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, store, discard=False):
+        """
+        Return a store to the pool. With ``discard``, e.g. after a
+        connection failure, the store is closed and a new one will be
+        created when needed.
+        """
+        if not discard and store._transaction is not None:
+            try:
+                store.rollback()
+            except Exception:
+                log.exception("rollback of a released store failed")
+                discard = True
+        with self._cond:
+            if discard or self._closed:
+                self._created -= 1
+            else:
+                self._idle.append(store)
+            self._cond.notify()
+        if discard or self._closed:
+            self._close_store(store)
+
+    @contextmanager
+    def store(self, timeout=None):
+        """
+        Context manager lending a store of the pool.
+        """
+        store = self.acquire(timeout)
+        try:
+            yield store
+        finally:
+            self.release(store)
+
+    @property
+    def in_use(self):
+        with self._cond:
+            return self._created - len(self._idle)
+
+    def close(self):
+        """
+        Close the idle stores; stores in use are closed when released.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._created -= len(idle)
+            self._cond.notify_all()
+        for store in idle:
+            self._close_store(store)
+
+    @staticmethod
+    def _close_store(store):
+        try:
+            store.close()
+        except Exception:
+            log.exception("closing a pooled store failed")
+
+
+class StoreFactory(object):
+    """
+    A picklable factory of :class:`~virtuoso.vstore.Virtuoso` stores, so
+    that other processes can build their own.
+    """
+
+    def __init__(self, dsn, **store_kwargs):
+        self.dsn = dsn
+        self.store_kwargs = store_kwargs
+
+    def __call__(self):
+        from virtuoso.vstore import Virtuoso
+        return Virtuoso(self.dsn, **self.store_kwargs)
+
+
+# the store of a worker process of a ProcessStoreExecutor
+_process_store = None
+
+
+def _run_task(factory, task, args, kwargs):
+    global _process_store
+    if _process_store is None:
+        _process_store = factory()
+    return task(_process_store, *args, **kwargs)
+
+
+def query_task(store, q, **kwargs):
+    """
+    Run a query and return a picklable result: a list of row tuples for
+    a SELECT, a bool for an ASK and a list of triples otherwise.
+    """
+    result = store.query(q, **kwargs)
+    if result.type == "SELECT":
+        return [tuple(row) for row in result]
+    if result.type == "ASK":
+        return bool(result)
+    return list(result.graph)
+
+
+def load_task(store, data, format="nt", context=None):
+    """
+    Parse ``data`` and add its triples to the graph named ``context``
+    (a URI). Returns the number of triples added.
+    """
+    from rdflib.graph import Graph
+    parsed = Graph().parse(data=data, format=format)
+    graph = Graph(store, identifier=context)
+    store.addN((s, p, o, graph) for (s, p, o) in parsed)
+    return len(parsed)
+
+
+class ProcessStoreExecutor(object):
+    """
+    Runs tasks in a pool of ``max_workers`` processes, each with a
+    store created by ``factory`` (which must be picklable, e.g. a
+    :class:`StoreFactory`) when it runs its first task.
+
+    A task is a module-level function taking the store of the process
+    as its first argument; its arguments and result must be picklable.
+    """
+
+    def __init__(self, factory, max_workers=None):
+        from concurrent.futures import ProcessPoolExecutor
+        self.factory = factory
+        self._executor = ProcessPoolExecutor(max_workers)
+
+    def submit(self, task, *args, **kwargs):
+        """
+        Schedule ``task(store, *args, **kwargs)``; returns a future.
+        """
+        return self._executor.submit(
+            _run_task, self.factory, task, args, kwargs)
+
+    def map(self, task, *iterables):
+        """
+        Like the builtin ``map``, calling ``task(store, *args)`` in the
+        pool; returns an iterator over the results, in order.
+        """
+        futures = [self.submit(task, *args) for args in zip(*iterables)]
+        return (f.result() for f in futures)
+
+    def query(self, q, **kwargs):
+        """
+        Run a query in the pool, see :func:`query_task`.
+        """
+        return self.submit(query_task, q, **kwargs)
+
+    def load(self, data, format="nt", context=None):
+        """
+        Parse and load data in the pool, see :func:`load_task`.
+        """
+        return self.submit(load_task, data, format, context)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,82 @@
+"""
+Routing of reads to replicas.
+
+A store given a :class:`ReplicaSet` as ``Virtuoso(primary_dsn,
+replicas=ReplicaSet([dsn1, dsn2]))`` runs its queries (SELECT, ASK,
+CONSTRUCT, hence ``triples()`` and ``len()``) and ``contexts()`` on a
+replica, and its updates and transactions on the primary. Each store
+has its own connection to each replica it uses; the replica set, with
+its load counters, can be shared by several stores, as it is by clones.
+
+After a write, the reads of the store go to the primary for
+``pin_after_write`` seconds (for ever if None), so that they see the
+write whatever the replication lag; so do the reads of a transaction.
+"""
+from builtins import object, range
+import threading
+
+from virtuoso.metrics import clock
+
+__all__ = ['ReplicaSet', 'ROUND_ROBIN', 'LEAST_LOADED']
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LOADED = 'least_loaded'
+
+
+class ReplicaSet(object):
+    """
+    The replica DSNs of a primary, and the routing of reads among them:
+    ``round_robin``, or ``least_loaded`` to pick the replica with the
+    fewest reads in flight (a SELECT being in flight until its rows are
+    read).
+
+    ``in_flight`` and ``reads`` count the reads in flight and routed,
+    by replica.
+    """
+
+    def __init__(self, dsns, routing=ROUND_ROBIN, pin_after_write=5.0):
+        self.dsns = list(dsns)
+        if not self.dsns:
+            raise ValueError("A replica set needs at least one DSN")
+        if routing not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError("Unknown replica routing: %s" % routing)
+        self.routing = routing
+        self.pin_after_write = pin_after_write
+        self.in_flight = [0] * len(self.dsns)
+        self.reads = [0] * len(self.dsns)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Choose the replica of a read, and return its index.
+        """
+        n = len(self.dsns)
+        with self._lock:
+            if self.routing == LEAST_LOADED:
+                # ties are broken in turn
+                index = min(range(n), key=lambda i: (
+                    self.in_flight[i], (i - self._next) % n))
+            else:
+                index = self._next % n
+            self._next = index + 1
+            self.in_flight[index] += 1
+            self.reads[index] += 1
+        return index
+
+    def release(self, index):
+        """
+        Record the end of a read on the replica ``index``.
+        """
+        with self._lock:
+            self.in_flight[index] -= 1
+
+    def pinned(self, last_write):
+        """
+        Whether reads after a write at ``last_write`` (a
+        :func:`~virtuoso.metrics.clock` time) must go to the primary.
+        """
+        if last_write is None:
+            return False
+        return (self.pin_after_write is None
+                or clock() - last_write < self.pin_after_write)
@@ -0,0 +1,99 @@
+"""
+Retry of writes aborted by deadlocks.
+
+Under concurrent writers, Virtuoso aborts one of the deadlocked
+transactions with SQLSTATE 40001. A store given a :class:`RetryPolicy`
+as ``Virtuoso(dsn, retry=RetryPolicy())`` runs its self-committed
+updates again after a jittered exponential backoff: those of ``add``,
+``addN`` batches, ``remove`` and ``removeN`` outside of a transaction,
+and any update run with ``commit=True``. Updates within a transaction
+are not retried, as the deadlock rolled back the whole transaction.
+"""
+from builtins import object
+from random import uniform
+import logging
+import time
+
+import pyodbc
+
+from virtuoso.metrics import Counter
+
+__all__ = ['RetryPolicy', 'is_deadlock']
+
+log = logging.getLogger(__name__)
+
+DEADLOCK_SQLSTATE = '40001'
+
+
+def is_deadlock(error):
+    """
+    Whether an error is Virtuoso aborting a deadlocked transaction.
+    """
+    return (isinstance(error, pyodbc.Error) and bool(error.args)
+            and error.args[0] == DEADLOCK_SQLSTATE)
+
+
+class RetryPolicy(object):
+    """
+    Runs an operation up to ``max_attempts`` times while it fails with an
+    error accepted by ``retry_on`` (deadlocks by default).
+
+    The delay before the n-th retry is drawn uniformly between 0 and
+    ``min(max_delay, base_delay * multiplier ** (n - 1))`` seconds, or is
+    that bound without ``jitter``.
+
+    ``retries`` and ``failures`` count the retries made and the
+    operations that still failed after them, over all the threads
+    sharing the policy.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=0.05, max_delay=2.0,
+                 multiplier=2.0, jitter=True, retry_on=is_deadlock):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retry_on = retry_on
+        self._retries = Counter("retries")
+        self._failures = Counter("failures")
+        self.sleep = time.sleep
+
+    @property
+    def retries(self):
+        return self._retries.value
+
+    @property
+    def failures(self):
+        return self._failures.value
+
+    def delay(self, retry):
+        """
+        The delay before the ``retry``-th retry (counting from 1).
+        """
+        bound = min(self.max_delay,
+                    self.base_delay * self.multiplier ** (retry - 1))
+        return uniform(0, bound) if self.jitter else bound
+
+    def run(self, operation, on_retry=None):
+        """
+        Call ``operation()`` until it succeeds, and return its result.
+        ``on_retry(retry, error, delay)`` is called before each retry.
+        """
+        attempt = 1
+        while True:
+            try:
+                return operation()
+            except Exception as e:
+                if not self.retry_on(e):
+                    raise
+                if attempt >= self.max_attempts:
+                    self._failures.inc()
+                    raise
+                delay = self.delay(attempt)
+                log.info("retrying in %.3fs after %r", delay, e)
+                self._retries.inc()
+                if on_retry is not None:
+                    on_retry(attempt, e, delay)
+                self.sleep(delay)
+                attempt += 1
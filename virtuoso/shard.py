@@ -0,0 +1,294 @@
+"""
+A store sharding named graphs across several Virtuoso instances.
+
+:class:`ShardedVirtuoso` holds one :class:`~virtuoso.vstore.Virtuoso`
+store per backend and keeps each named graph on a single backend,
+chosen by a consistent hash of its name or by an explicit map::
+
+    store = ShardedVirtuoso({"a": Virtuoso("DSN=a"), "b": Virtuoso("DSN=b")},
+                            shard_map={ontology_uri: "a"})
+    graph = ConjunctiveGraph(store)
+
+Operations on a graph go to its backend; those over all graphs, such as
+``triples()`` without a context, ``contexts()`` and ``len()``, run on
+all backends in parallel and merge their results; results streamed in
+parallel are read on clones of the backends, so that the caller can use
+the backends meanwhile. SPARQL queries are not distributed: run them on
+the backend of the graphs they read, see :meth:`ShardedVirtuoso.backend`.
+"""
+from builtins import object, range
+from bisect import bisect
+from hashlib import md5
+from itertools import islice
+from queue import Queue, Full
+import threading
+import logging
+
+from rdflib.graph import Graph
+from rdflib.store import Store, VALID_STORE
+
+__all__ = ['ShardedVirtuoso', 'HashRing']
+
+log = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    A consistent hash of keys to ``nodes``, each placed ``vnodes``
+    times on the ring: adding or removing a node only moves the keys
+    of that node.
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        ring = sorted((_hash(u"%s#%d" % (node, i)), node)
+                      for node in nodes for i in range(vnodes))
+        if not ring:
+            raise ValueError("A hash ring needs at least one node")
+        self._hashes = [h for (h, node) in ring]
+        self._nodes = [node for (h, node) in ring]
+
+    def node(self, key):
+        i = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+
+def _identifier(context):
+    return getattr(context, "identifier", context)
+
+
+class ShardedVirtuoso(Store):
+    """
+    A store over ``backends``, a mapping of names to stores (or a list,
+    named by position). A graph is on the backend named in
+    ``shard_map``, a mapping of graph names to backend names, or else
+    on the backend its name hashes to. ``max_workers`` threads, by
+    default one per backend, run the operations over all backends.
+
+    Like a :class:`~virtuoso.vstore.Virtuoso` store, a sharded store
+    must not be used by several threads at once.
+    """
+    context_aware = True
+    formula_aware = False
+    transaction_aware = False
+
+    def __init__(self, backends, shard_map=None, vnodes=64, max_workers=None,
+                 block_size=100):
+        super(ShardedVirtuoso, self).__init__()
+        if not isinstance(backends, dict):
+            backends = dict((str(i), store) for (i, store) in enumerate(backends))
+        self.backends = backends
+        self.shard_map = dict((_identifier(k), v)
+                              for (k, v) in (shard_map or {}).items())
+        self.ring = HashRing(sorted(backends), vnodes)
+        self.max_workers = max_workers or len(backends)
+        self.block_size = block_size
+
+    def open(self, configuration, create=False):
+        return VALID_STORE
+
+    def backend_name(self, context):
+        """
+        Return the name of the backend holding ``context``.
+        """
+        identifier = _identifier(context)
+        name = self.shard_map.get(identifier)
+        if name is None:
+            name = self.ring.node(u"%s" % identifier)
+        return name
+
+    def backend(self, context):
+        """
+        Return the store holding ``context``.
+        """
+        return self.backends[self.backend_name(context)]
+
+    def _map(self, function, items=None):
+        """
+        Call ``function(item)`` on each of ``items``, by default the
+        backend stores, in parallel, and return the results.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        if items is None:
+            items = list(self.backends.values())
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(min(self.max_workers, len(items))) as executor:
+            return list(executor.map(function, items))
+
+    def _merge(self, function):
+        """
+        Iterate over ``function(store)`` on each backend, yielding the
+        items in the order they come. Each backend is read in a thread
+        of its own, on a clone closed at the end, as the caller may use
+        the backend while iterating; backends that can not be cloned,
+        or whose pending transaction a clone would not see, are read
+        one after the other by the caller.
+        """
+        clones, local = [], []
+        try:
+            for store in self.backends.values():
+                if (getattr(store, "dsn", None) is not None
+                        and store._transaction is None):
+                    clones.append(store.clone())
+                else:
+                    local.append(store)
+        except:
+            for clone in clones:
+                clone.close()
+            raise
+        queue = Queue(2 * len(clones) or 1)
+        stop = threading.Event()
+        threads = []
+        for clone in clones:
+            thread = threading.Thread(target=_stream, args=(
+                function, clone, queue, stop, self.block_size))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for store in local:
+                for item in function(store):
+                    yield item
+            running = len(threads)
+            while running:
+                block, error = queue.get()
+                if block is None:
+                    running -= 1
+                    if error is not None:
+                        raise error
+                else:
+                    for item in block:
+                        yield item
+            # the threads are closing their clones
+            for thread in threads:
+                thread.join()
+        finally:
+            stop.set()
+
+    def _graph(self, graphs, context):
+        identifier = _identifier(context)
+        graph = graphs.get(identifier)
+        if graph is None:
+            graph = graphs[identifier] = Graph(self, identifier)
+        return graph
+
+    def add(self, triple, context, quoted=False):
+        assert not quoted, "No quoted graph support in Virtuoso store yet, sorry"
+        if context is None:
+            raise ValueError("A sharded store needs the context of a triple")
+        self.backend(context).add(triple, context)
+        super(ShardedVirtuoso, self).add(triple, context, quoted)
+
+    def addN(self, quads):
+        """
+        Add quads, as batches sent to each backend in parallel.
+        """
+        shards = {}
+        for s, p, o, g in quads:
+            if g is None:
+                raise ValueError("A sharded store needs the context of a triple")
+            shards.setdefault(self.backend_name(g), []).append((s, p, o, g))
+        self._map(lambda shard: self.backends[shard[0]].addN(shard[1]),
+                  list(shards.items()))
+        super_add = super(ShardedVirtuoso, self).add
+        for quads in shards.values():
+            for s, p, o, g in quads:
+                super_add((s, p, o), g)
+
+    def remove(self, triple, context=None):
+        if context is not None:
+            self.backend(context).remove(triple, context)
+        else:
+            self._map(lambda store: store.remove(triple))
+        super(ShardedVirtuoso, self).remove(triple, context)
+
+    def triples(self, triple, context=None):
+        graphs = {}
+        if context is not None:
+            triples = self.backend(context).triples(triple, context)
+        else:
+            triples = self._merge(lambda store: (
+                (t, [_identifier(c) for c in ctxs])
+                for (t, ctxs) in store.triples(triple)))
+        for t, ctxs in triples:
+            yield t, [self._graph(graphs, c) for c in ctxs]
+
+    def __len__(self, context=None):
+        if context is not None:
+            return self.backend(context).__len__(context)
+        return sum(self._map(len))
+
+    def contexts(self, triple=None):
+        seen = set()
+        for identifier in self._merge(lambda store: (
+                c.identifier for c in store.contexts(triple))):
+            if identifier not in seen:
+                seen.add(identifier)
+                yield Graph(self, identifier)
+
+    def bind(self, prefix, namespace, override=True):
+        for store in self.backends.values():
+            store.bind(prefix, namespace)
+
+    def namespace(self, prefix):
+        return self._first().namespace(prefix)
+
+    def prefix(self, namespace):
+        return self._first().prefix(namespace)
+
+    def namespaces(self):
+        return self._first().namespaces()
+
+    def _first(self):
+        return self.backends[sorted(self.backends)[0]]
+
+    def commit(self):
+        for store in self.backends.values():
+            store.commit()
+
+    def rollback(self):
+        for store in self.backends.values():
+            store.rollback()
+
+    def close(self, commit_pending_transaction=False):
+        for store in self.backends.values():
+            store.close(commit_pending_transaction)
+
+
+def _stream(function, store, queue, stop, block_size):
+    """
+    A thread of :meth:`ShardedVirtuoso._merge`: queues blocks of
+    ``function(store)``, then ``(None, None)`` or ``(None, error)``,
+    and closes ``store``.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+    iterator = iter(())
+    try:
+        iterator = iter(function(store))
+        while not stop.is_set():
+            block = list(islice(iterator, block_size))
+            if not block:
+                break
+            if not put((block, None)):
+                return
+        put((None, None))
+    except Exception as e:
+        put((None, e))
+    finally:
+        try:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        finally:
+            store.close()
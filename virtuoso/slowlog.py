@@ -0,0 +1,125 @@
+"""
+Slow-query log for the Virtuoso store.
+
+Queries are grouped by *fingerprint*, the text of the query with its
+IRIs, literals, numbers and VALUES blocks replaced by placeholders, so
+that all the executions of a query shape are aggregated together.
+"""
+from builtins import object
+from collections import OrderedDict, deque
+import threading
+import logging
+import re
+
+from virtuoso.metrics import percentile
+
+__all__ = ['fingerprint', 'SlowQueryLog']
+
+log = logging.getLogger(__name__)
+
+_long_string_re = re.compile(r'("""|\'\'\')(.*?)\1', re.DOTALL)
+_string_re = re.compile(r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'')
+_literal_suffix_re = re.compile(r'\?(@[a-zA-Z][-a-zA-Z0-9]*|\^\^(<\?>|[\w.-]*:[\w.-]*))')
+_iri_re = re.compile(r'<[^<>"{}|^`\\\s]*>')
+_comment_re = re.compile(r'#[^\n]*')
+_values_re = re.compile(
+    r'\bVALUES\s*(\?\w+|\(\s*(?:\?\w+\s*)*\))\s*\{[^{}]*\}', re.IGNORECASE)
+_number_re = re.compile(r'(?<![\w?$:.])[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\b')
+_ws_re = re.compile(r'\s+')
+
+
+def fingerprint(q):
+    """
+    Normalize a SPARQL query into its shape: IRIs become ``<?>``,
+    literals and numbers become ``?``, the rows of VALUES blocks are
+    dropped and whitespace and comments are collapsed.
+    """
+    q = _long_string_re.sub('?', q)
+    q = _string_re.sub('?', q)
+    q = _iri_re.sub('<?>', q)
+    q = _literal_suffix_re.sub('?', q)
+    q = _comment_re.sub(' ', q)
+    q = _values_re.sub(lambda m: 'VALUES %s { ? }' % m.group(1), q)
+    q = _number_re.sub('?', q)
+    return _ws_re.sub(' ', q).strip()
+
+
+class _Shape(object):
+    __slots__ = ('fingerprint', 'count', 'total_time', 'max_time',
+                 'rows', 'times', 'example')
+
+    def __init__(self, fingerprint, example, reservoir):
+        self.fingerprint = fingerprint
+        self.example = example
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.times = deque(maxlen=reservoir)
+
+    def as_dict(self):
+        return dict(fingerprint=self.fingerprint, example=self.example,
+                    count=self.count, total_time=self.total_time,
+                    mean_time=self.total_time / self.count,
+                    p95_time=percentile(sorted(self.times), 0.95),
+                    max_time=self.max_time, rows=self.rows)
+
+
+class SlowQueryLog(object):
+    """
+    Aggregates query latencies per fingerprint, and logs the full text
+    of any execution slower than ``threshold`` seconds.
+
+    It is an :class:`~virtuoso.metrics.Instrumentation` hook, and is
+    usually installed with ``Virtuoso(..., slow_query_log=SlowQueryLog())``.
+    At most ``max_fingerprints`` shapes are kept, the least recently
+    seen being forgotten first.
+    """
+
+    def __init__(self, threshold=1.0, logger=None, max_fingerprints=1000,
+                 reservoir=256):
+        self.threshold = threshold
+        self.logger = logger if logger is not None else log
+        self.max_fingerprints = max_fingerprints
+        self.reservoir = reservoir
+        self._shapes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, stats):
+        if stats.query is None or stats.kind == 'commit':
+            return
+        elapsed = stats.total_time
+        key = fingerprint(stats.query)
+        with self._lock:
+            shape = self._shapes.pop(key, None)
+            if shape is None:
+                shape = _Shape(key, stats.query, self.reservoir)
+                if len(self._shapes) >= self.max_fingerprints:
+                    self._shapes.popitem(last=False)
+            self._shapes[key] = shape
+            shape.count += 1
+            shape.total_time += elapsed
+            shape.rows += stats.rows
+            shape.times.append(elapsed)
+            if elapsed > shape.max_time:
+                shape.max_time = elapsed
+        if elapsed >= self.threshold:
+            self.logger.warning(
+                "slow %s query (%.3fs, %d rows%s): %s", stats.kind, elapsed,
+                stats.rows, ", failed" if stats.error is not None else "",
+                stats.query)
+
+    def report(self, limit=None, order_by='total_time'):
+        """
+        Return the aggregated shapes as dicts, slowest first according
+        to ``order_by`` (``total_time``, ``p95_time``, ``max_time``,
+        ``count`` or ``rows``).
+        """
+        with self._lock:
+            shapes = [shape.as_dict() for shape in self._shapes.values()]
+        shapes.sort(key=lambda s: s[order_by], reverse=True)
+        return shapes[:limit] if limit is not None else shapes
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
@@ -0,0 +1,189 @@
+"""
+Tests of the admission control of statements, on the offline stand-in.
+"""
+import threading
+import time
+import unittest
+
+from rdflib.graph import Graph
+from rdflib.namespace import RDFS
+from rdflib.term import URIRef, Literal
+
+import pyodbc
+
+from virtuoso.admission import AdmissionController, AdmissionTimeout
+from virtuoso.offline import OfflineServer
+from virtuoso.retry import RetryPolicy
+from virtuoso.vstore import Virtuoso
+
+ex = "http://example.org/admission/"
+
+
+def _in_thread(function, *args):
+    """
+    Call ``function`` in another thread, and return its result or
+    exception.
+    """
+    result = []
+
+    def run():
+        try:
+            result.append(function(*args))
+        except Exception as e:
+            result.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(5)
+    return result[0]
+
+
+class Test00Controller(unittest.TestCase):
+    def test_01_limits_and_timeout(self):
+        admission = AdmissionController(limits={"batch": 1}, timeout=0.05)
+        admission.acquire("batch")
+        assert isinstance(_in_thread(admission.acquire, "batch"),
+                          AdmissionTimeout)
+
+        # other classes are not affected
+        def interactive():
+            with admission.admit("interactive"):
+                return admission.snapshot()["interactive"]["in_flight"]
+        assert _in_thread(interactive) == 1
+        admission.release("batch")
+        with admission.admit("batch"):
+            pass
+        metrics = admission.registry.snapshot()
+        assert metrics["admission.batch.timeouts"] == 1, metrics
+        assert metrics["admission.batch.queue_depth"]["count"] == 1, metrics
+        self.assertRaises(ValueError, admission.acquire, "unknown")
+
+    def test_03_reentrant(self):
+        admission = AdmissionController(limits={"interactive": 1, "write": 1},
+                                        total=1, timeout=0.05)
+        assert admission.acquire("interactive")
+        # the thread rides on its slot of the class
+        assert admission.acquire("interactive") is False
+        # and takes one of another class, over the total it already counts in
+        with admission.admit("write"):
+            assert admission.in_flight == dict(interactive=1, batch=0, write=1)
+            assert admission.acquire("write") is False
+        assert isinstance(_in_thread(admission.acquire, "interactive"),
+                          AdmissionTimeout)
+        admission.release("interactive")
+        assert _in_thread(admission.acquire, "interactive") is True
+
+    def test_04_reentrant_within_class_limit(self):
+        admission = AdmissionController(limits={"write": 1}, timeout=0.05)
+        taken, done = threading.Event(), threading.Event()
+
+        def hold():
+            with admission.admit("write"):
+                taken.set()
+                done.wait(5)
+        holder = threading.Thread(target=hold)
+        holder.start()
+        taken.wait(5)
+        try:
+            # an interactive slot does not let the thread skip the writers
+            with admission.admit("interactive"):
+                self.assertRaises(AdmissionTimeout, admission.acquire, "write")
+            assert admission.in_flight == dict(interactive=0, batch=0, write=1)
+        finally:
+            done.set()
+            holder.join(5)
+
+    def test_02_priority(self):
+        admission = AdmissionController(total=1)
+        admission.acquire("batch")
+        admitted = []
+
+        def run(klass):
+            with admission.admit(klass, timeout=5):
+                admitted.append(klass)
+        threads = [threading.Thread(target=run, args=("batch",))]
+        threads[0].start()
+        while admission.snapshot()["batch"]["waiting"] < 1:
+            time.sleep(0.001)
+        threads.append(threading.Thread(target=run, args=("interactive",)))
+        threads[1].start()
+        while admission.snapshot()["interactive"]["waiting"] < 1:
+            time.sleep(0.001)
+        admission.release("batch")
+        for thread in threads:
+            thread.join(5)
+        assert admitted == ["interactive", "batch"], admitted
+
+
+class Test01Store(unittest.TestCase):
+    def setUp(self):
+        self.admission = AdmissionController(
+            limits={"interactive": 1, "write": 1}, timeout=0.05)
+        self.store = Virtuoso(connection=OfflineServer().connect(),
+                              admission=self.admission)
+        self.graph = Graph(self.store, identifier=URIRef(ex + "graph"))
+        self.graph.addN((URIRef(ex + str(i)), RDFS.label, Literal(i), self.graph)
+                        for i in range(5))
+
+    def test_01_select_holds_its_slot(self):
+        q = "SELECT ?s WHERE { ?s ?p ?o }"
+        result = iter(self.store.query(q))
+        next(result)
+        assert self.admission.in_flight["interactive"] == 1
+        assert isinstance(_in_thread(self.store.query, q), AdmissionTimeout)
+        # a batch query has its own slots
+        assert len(list(_in_thread(
+            lambda: list(self.store.query(q, priority="batch"))))) == 5
+        # a nested query of the same thread does not wait for a slot
+        assert len(list(self.store.query(q))) == 5
+        assert self.admission.in_flight["interactive"] == 1
+        list(result)
+        assert self.admission.in_flight["interactive"] == 0
+        assert self.store.query("ASK { ?s ?p ?o }")
+        assert self.admission.in_flight == dict(interactive=0, batch=0, write=0)
+
+    def test_02_writes(self):
+        taken, done = threading.Event(), threading.Event()
+
+        def hold():
+            with self.admission.admit("write"):
+                taken.set()
+                done.wait(5)
+        holder = threading.Thread(target=hold)
+        holder.start()
+        taken.wait(5)
+        self.assertRaises(AdmissionTimeout, self.graph.add,
+                          (URIRef(ex + "a"), RDFS.label, Literal("a")))
+        # reads go on
+        assert len(self.graph) == 5
+        done.set()
+        holder.join(5)
+        self.graph.remove((URIRef(ex + "0"), None, None))
+        assert len(self.graph) == 4
+        assert self.admission.in_flight["write"] == 0
+
+    def test_03_failed_statement_releases(self):
+        self.assertRaises(Exception, self.store.query, "SELECT WHERE {")
+        assert self.admission.in_flight["interactive"] == 0
+
+    def test_04_retry_releases(self):
+        policy = self.store.retry = RetryPolicy()
+        in_flight = []
+        policy.sleep = lambda delay: in_flight.append(
+            self.admission.in_flight["write"])
+        execute = self.store._sparql_ul_once
+        deadlocks = [2]
+
+        def deadlocking(*args):
+            if deadlocks[0]:
+                deadlocks[0] -= 1
+                raise pyodbc.Error('40001', 'deadlock')
+            return execute(*args)
+        self.store._sparql_ul_once = deadlocking
+        self.graph.add((URIRef(ex + "a"), RDFS.label, Literal("a")))
+        # the slot was given back during each backoff
+        assert in_flight == [0, 0], in_flight
+        assert self.admission.in_flight["write"] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+Tests of the asyncio front end and of the store pool, on the offline
+stand-in.
+"""
+import asyncio
+import threading
+import unittest
+
+from rdflib.graph import Graph
+from rdflib.namespace import RDFS
+from rdflib.term import URIRef, Literal
+
+from virtuoso.aio import AsyncVirtuoso
+from virtuoso.offline import OfflineServer
+from virtuoso.pool import StorePool, PoolTimeout
+from virtuoso.vstore import Virtuoso
+
+graph_uri = URIRef("http://example.org/aio")
+ex = "http://example.org/aio/"
+
+
+def make_server(n=25):
+    server = OfflineServer()
+    server.load("\n".join('<%s%d> <%s> "label %d" <%s> .' % (
+        ex, i, RDFS.label, i, graph_uri) for i in range(n)))
+    return server
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class Test00Pool(unittest.TestCase):
+    def setUp(self):
+        server = make_server()
+        self.pool = StorePool(
+            lambda: Virtuoso("offline", connect=server.connect), size=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_01_reuse(self):
+        with self.pool.store() as store:
+            pass
+        with self.pool.store() as store2:
+            assert store2 is store
+        assert self.pool.in_use == 0
+
+    def test_02_bounded(self):
+        a = self.pool.acquire()
+        b = self.pool.acquire()
+        assert a is not b
+        self.assertRaises(PoolTimeout, self.pool.acquire, 0.01)
+        threading.Timer(0.05, self.pool.release, (a,)).start()
+        assert self.pool.acquire(5) is a
+
+    def test_03_release_rolls_back(self):
+        store = self.pool.acquire()
+        store.transaction()
+        Graph(store, identifier=graph_uri).add(
+            (URIRef(ex + "new"), RDFS.label, Literal("new")))
+        self.pool.release(store)
+        assert store._transaction is None
+        assert not store.query("ASK { ?s ?p 'new' }")
+
+
+class Test01Async(unittest.TestCase):
+    def setUp(self):
+        server = make_server()
+        self.astore = AsyncVirtuoso("offline", pool_size=3, block_size=10,
+                                    connect=server.connect)
+
+    def tearDown(self):
+        run(self.astore.close())
+
+    def test_01_select_in_blocks(self):
+        async def go():
+            result = await self.astore.query(
+                "SELECT ?s ?o WHERE { GRAPH <%s> { ?s ?p ?o } }" % graph_uri)
+            assert [str(v) for v in result.vars] == ["s", "o"]
+            return [row async for row in result]
+        rows = run(go())
+        assert len(rows) == 25, len(rows)
+        assert self.astore.pool.in_use == 0
+
+    def test_02_concurrent_queries(self):
+        async def one(i):
+            result = await self.astore.query(
+                "SELECT ?o WHERE { <%s%d> ?p ?o }" % (ex, i))
+            return await result.fetchall()
+        async def go():
+            return await asyncio.gather(*[one(i) for i in range(20)])
+        results = run(go())
+        assert [str(r[0][0]) for r in results] == [
+            "label %d" % i for i in range(20)]
+
+    def test_03_ask_and_close(self):
+        async def go():
+            assert await self.astore.query("ASK { ?s ?p 'label 3' }")
+            result = await self.astore.query("SELECT ?s { ?s ?p ?o }")
+            async with result:
+                await result.__anext__()
+            assert self.astore.pool.in_use == 0
+        run(go())
+
+    def test_04_writes_and_transaction(self):
+        graph = Graph(identifier=graph_uri)
+        s = URIRef(ex + "written")
+
+        async def go():
+            await self.astore.add((s, RDFS.label, Literal("a")), graph)
+            async with self.astore.transaction() as tx:
+                await tx.addN([(s, RDFS.label, Literal("b"), graph)])
+                assert await tx.query("ASK { ?s ?p 'b' }")
+            assert not await self.astore.query("ASK { ?s ?p 'b' }")
+            async with self.astore.transaction() as tx:
+                await tx.addN([(s, RDFS.label, Literal("c"), graph)])
+                await tx.commit()
+            triples = await self.astore.triples((s, None, None), graph)
+            return sorted([str(t[2]) async for t, contexts in triples])
+        assert run(go()) == ["a", "c"]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Smoke tests of the micro-benchmarks of benchmarks/bench_vstore.py, on
+the offline stand-in.
+"""
+import inspect
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), "benchmarks"))
+
+import bench_vstore
+
+
+class Test01Benchmarks(unittest.TestCase):
+    def test_01_setups(self):
+        for name, setup in bench_vstore.BENCHMARKS:
+            kwargs = {}
+            parameters = inspect.signature(setup).parameters
+            if "n" in parameters:
+                kwargs["n"] = 20
+            if "workers" in parameters:
+                kwargs["workers"] = 2
+            run, ops = setup(**kwargs)
+            assert ops > 0, name
+            # the replayed traffic is the one recorded
+            run()
+
+    def test_02_measure(self):
+        result = bench_vstore.measure(bench_vstore.bench_bnode_roundtrip,
+                                      min_time=0.01, repeat=1)
+        assert set(result) == set(["ops_per_sec", "usec_per_op",
+                                   "peak_bytes_per_op"])
+        assert result["ops_per_sec"] > 0
+
+
+if __name__ == '__main__':
+    unittest.main()
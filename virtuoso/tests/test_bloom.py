@@ -0,0 +1,107 @@
+"""
+Tests of the Bloom filters, on the offline stand-in.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from rdflib.graph import Graph
+from rdflib.namespace import RDFS, XSD
+from rdflib.term import URIRef, BNode, Literal
+
+from virtuoso.bloom import BloomFilter, GraphFilters
+from virtuoso.metrics import Instrumentation
+from virtuoso.offline import OfflineServer
+from virtuoso.vstore import Virtuoso
+
+ex = "http://example.org/bloom/"
+
+
+class Test00BloomFilter(unittest.TestCase):
+    def test_01_membership(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(u"key%d" % i)
+        assert all(u"key%d" % i in bloom for i in range(1000))
+        false_positives = sum(u"other%d" % i in bloom for i in range(1000))
+        assert false_positives < 50
+
+    def test_02_save_load(self):
+        bloom = BloomFilter(capacity=100)
+        bloom.add(u"key")
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "bloom")
+            with open(path, "wb") as f:
+                bloom.save(f)
+            with open(path, "rb") as f:
+                loaded = BloomFilter.load(f)
+        finally:
+            shutil.rmtree(directory)
+        assert u"key" in loaded and u"other" not in loaded
+        assert (loaded.num_bits, loaded.num_hashes) == \
+            (bloom.num_bits, bloom.num_hashes)
+
+
+class Test01Store(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = Instrumentation()
+        self.filters = GraphFilters()
+        self.store = Virtuoso("offline", connect=OfflineServer().connect,
+                              bloom_filters=self.filters,
+                              instrumentation=self.instrumentation)
+        self.graph = Graph(self.store, identifier=URIRef(ex + "graph"))
+        self.triples = [(URIRef(ex + "s%d" % i), RDFS.label, Literal(i))
+                        for i in range(10)]
+        self.graph.addN(t + (self.graph,) for t in self.triples)
+        self.filters.build(self.store, self.graph)
+
+    def queries(self):
+        return sum(v for k, v in self.instrumentation.snapshot().items()
+                   if k.startswith("queries.") and isinstance(v, int))
+
+    def test_01_negatives(self):
+        before = self.queries()
+        assert (URIRef(ex + "s0"), RDFS.label, Literal(1)) not in self.graph
+        assert self.queries() == before
+        assert self.filters.registry.snapshot()["bloom.negatives"] == 1
+        assert self.triples[0] in self.graph
+
+    def test_02_addN_skips_present(self):
+        new = (URIRef(ex + "new"), RDFS.label, Literal("new"))
+        self.graph.addN(t + (self.graph,) for t in self.triples[:5] + [new])
+        assert self.filters.registry.snapshot()["bloom.skipped"] == 5
+        assert new in self.graph and len(self.graph) == 11
+        self.graph.add((URIRef(ex + "one"), RDFS.label, Literal("one")))
+        assert (URIRef(ex + "one"), RDFS.label, Literal("one")) in self.graph
+
+    def test_03_clear(self):
+        self.graph.remove((None, None, None))
+        assert self.triples[0] not in self.graph
+        assert self.filters.registry.snapshot()["bloom.negatives"] == 1
+        self.filters.discard()
+        assert self.filters.get(self.graph) is None
+
+    def test_04_widened_float(self):
+        weight = (URIRef(ex + "s0"), RDFS.comment,
+                  Literal("1.1", datatype=XSD.float))
+        self.graph.add(weight)
+        # the filter now holds the widened value Virtuoso returns
+        self.filters.build(self.store, self.graph)
+        assert weight in self.graph
+        assert (URIRef(ex + "s0"), RDFS.comment,
+                Literal("1.2", datatype=XSD.float)) not in self.graph
+        assert self.filters.registry.snapshot().get("bloom.negatives", 0) == 0
+
+    def test_05_long_bnode(self):
+        # stored under a nodeID made of the first 8 characters of its id
+        triple = (BNode("abcdefghij"), RDFS.label, Literal("b"))
+        self.graph.add(triple)
+        self.filters.build(self.store, self.graph)
+        assert triple in self.graph
+        assert self.filters.registry.snapshot().get("bloom.negatives", 0) == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+"""
+Tests of the entity cache, on the offline stand-in.
+"""
+import time
+import unittest
+
+from rdflib.graph import Graph
+from rdflib.namespace import RDF, RDFS, XSD
+from rdflib.term import URIRef, Literal
+
+from virtuoso.cache import EntityCache
+from virtuoso.metrics import Instrumentation
+from virtuoso.offline import OfflineServer
+from virtuoso.vstore import Virtuoso, _written_graphs
+
+ex = "http://example.org/cache/"
+
+
+class Test00EntityCache(unittest.TestCase):
+    def test_01_lru(self):
+        cache = EntityCache(max_entries=2)
+        cache.put("g", "a", [("p", 1)])
+        cache.put("g", "b", [("p", 2)])
+        assert cache.get("g", "a") == [("p", 1)]
+        cache.put("g", "c", [("p", 3)])
+        # b was the least recently used
+        assert cache.get("g", "b") is None
+        assert len(cache) == 2
+        assert cache.hit_rate == 0.5
+        assert cache.registry.snapshot()["cache.evictions"] == 1
+
+    def test_02_invalidate(self):
+        cache = EntityCache()
+        for g in ("g1", "g2"):
+            for s in ("a", "b"):
+                cache.put(g, s, [])
+        cache.invalidate("a", "g1")
+        assert cache.get("g1", "a") is None and cache.get("g2", "a") == []
+        cache.invalidate("a")
+        assert cache.get("g2", "a") is None
+        cache.invalidate(context="g1")
+        assert cache.get("g1", "b") is None and cache.get("g2", "b") == []
+        version = cache.version
+        cache.clear()
+        assert len(cache) == 0
+        # a read begun before an invalidation is not cached
+        cache.put("g1", "a", [], version)
+        assert len(cache) == 0
+
+    def test_03_ttl(self):
+        cache = EntityCache(ttl=0.01)
+        cache.put("g", "a", [])
+        time.sleep(0.02)
+        assert cache.get("g", "a") is None
+
+
+class Test01Store(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = Instrumentation()
+        self.cache = EntityCache()
+        self.store = Virtuoso("offline", connect=OfflineServer().connect,
+                              entity_cache=self.cache,
+                              instrumentation=self.instrumentation)
+        self.graph = Graph(self.store, identifier=URIRef(ex + "graph"))
+        self.subject = URIRef(ex + "s")
+        self.graph.addN([(self.subject, RDFS.label, Literal("s"), self.graph),
+                         (self.subject, RDF.type, RDFS.Class, self.graph)])
+
+    def selects(self):
+        return self.instrumentation.snapshot().get("queries.select", 0)
+
+    def test_01_reads(self):
+        assert self.graph.value(self.subject, RDFS.label) == Literal("s")
+        before = self.selects()
+        assert set(self.graph.predicate_objects(self.subject)) == set(
+            [(RDFS.label, Literal("s")), (RDF.type, RDFS.Class)])
+        assert (self.subject, RDF.type, RDFS.Class) in self.graph
+        assert self.graph.value(self.subject, RDFS.comment) is None
+        assert self.selects() == before
+        assert self.cache.hit_rate == 0.75
+
+    def test_02_writes_invalidate(self):
+        self.graph.value(self.subject, RDFS.label)
+        self.graph.add((self.subject, RDFS.comment, Literal("c")))
+        assert self.graph.value(self.subject, RDFS.comment) == Literal("c")
+        self.store.removeN([(self.subject, RDFS.comment, Literal("c"), self.graph)])
+        assert self.graph.value(self.subject, RDFS.comment) is None
+        # through a clone sharing the cache
+        clone = self.store.clone()
+        try:
+            Graph(clone, identifier=self.graph.identifier).remove(
+                (self.subject, RDFS.label, None))
+        finally:
+            clone.close()
+        assert self.graph.value(self.subject, RDFS.label) is None
+
+    def test_03_transaction(self):
+        self.graph.value(self.subject, RDFS.label)
+        self.store.transaction()
+        try:
+            self.graph.add((self.subject, RDFS.comment, Literal("c")))
+            assert self.graph.value(self.subject, RDFS.comment) == Literal("c")
+        finally:
+            self.store.rollback()
+        assert self.graph.value(self.subject, RDFS.comment) is None
+        assert len(self.cache) == 1
+
+    def test_04_update(self):
+        self.graph.value(self.subject, RDFS.label)
+        self.graph.update(u"DELETE WHERE { %s %s ?o }" % (
+            self.subject.n3(), RDFS.label.n3()))
+        assert self.graph.value(self.subject, RDFS.label) is None
+        assert (self.subject, RDF.type, RDFS.Class) in self.graph
+
+    def test_06_scoped_update(self):
+        self.graph.value(self.subject, RDFS.label)
+        insert = u'INSERT DATA { GRAPH %s { %s %s "c" } }'
+        self.store.update(insert % (URIRef(ex + "other").n3(),
+                                    self.subject.n3(), RDFS.comment.n3()))
+        # the cached entity is in another graph
+        before = self.selects()
+        assert self.graph.value(self.subject, RDFS.comment) is None
+        assert self.selects() == before
+        self.store.update(insert % (self.graph.identifier.n3(),
+                                    self.subject.n3(), RDFS.comment.n3()))
+        assert self.graph.value(self.subject, RDFS.comment) == Literal("c")
+        self.graph.value(self.subject, RDFS.label)
+        # a graph named by a variable may be any
+        self.store.update(u"DELETE { GRAPH ?g { %s %s ?o } } "
+                          u"WHERE { GRAPH ?g { %s %s ?o } }"
+                          % ((self.subject.n3(), RDFS.comment.n3()) * 2))
+        assert self.graph.value(self.subject, RDFS.comment) is None
+
+    def test_05_widened_float(self):
+        weight = Literal("1.1", datatype=XSD.float)
+        self.graph.add((self.subject, RDFS.comment, weight))
+        self.graph.value(self.subject, RDFS.label)
+        # the cached object is the widened value Virtuoso returned
+        assert (self.subject, RDFS.comment, weight) in self.graph
+        assert list(self.graph.triples((self.subject, None, weight)))
+        assert (self.subject, RDFS.comment, Literal(2)) not in self.graph
+        assert (self.subject, RDFS.comment, Literal(
+            "1", datatype=XSD.integer)) not in self.graph
+
+    def test_07_virtuoso_update_forms(self):
+        other = Graph(self.store, identifier=URIRef(ex + "other"))
+        g, s, p = other.identifier.n3(), self.subject.n3(), RDFS.comment.n3()
+        inserts = [u'INSERT INTO %s { %s %s "c" }',
+                   u'INSERT INTO GRAPH %s { %s %s "c" }',
+                   u'INSERT DATA INTO %s { %s %s "c" }']
+        deletes = [u'DELETE FROM %s { %s %s ?o } FROM %s WHERE { %s %s ?o }'
+                   % (g, s, p, g, s, p),
+                   # as removed by the store
+                   u'DELETE FROM GRAPH %s { %s %s "c" } FROM %s '
+                   u'WHERE { %s %s "c" }' % (g, s, p, g, s, p),
+                   u'DELETE DATA FROM %s { %s %s "c" }' % (g, s, p)]
+        for insert, delete in zip(inserts, deletes):
+            assert other.value(self.subject, RDFS.comment) is None
+            # run on another graph than the one written
+            self.graph.update(insert % (g, s, p))
+            assert other.value(self.subject, RDFS.comment) == Literal("c")
+            self.graph.update(delete)
+            assert other.value(self.subject, RDFS.comment) is None
+        # and everything is forgotten after updates of unknown forms
+        assert _written_graphs(u"MODIFY GRAPH %s INSERT { %s %s 1 } "
+                               u"WHERE { %s %s ?o }" % (g, s, p, s, p),
+                               self.graph.identifier) is None
+
+
+if __name__ == '__main__':
+    unittest.main()
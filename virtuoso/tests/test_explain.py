@@ -0,0 +1,60 @@
+import unittest
+
+from virtuoso.explain import QueryPlan, parse_report
+
+# as printed by profile() on Virtuoso 7.2
+profile_report = u"""
+{
+time   6.6e-05% fanout         1 input         1 rows
+time   1.5e-05% fanout         1 input         1 rows
+{ fork
+time   4.7e-05% fanout         1 input         1 rows
+{ fork
+time        24% fanout   1.5e+06 input         1 rows
+ORDERS   1.5e+06 rows(t2.O_ORDERKEY)
+
+time        76% fanout         4 input   1.5e+06 rows
+LINEITEM         4 rows(t1.L_ORDERKEY)
+ inlined  L_ORDERKEY = t2.O_ORDERKEY
+
+After code:
+      0: count = count + 1
+      5: BReturn 0
+}
+}
+time   4.2e-06% fanout         0 input         1 rows
+Select (count)
+}
+
+ 3187 msec 100% cpu,  1.5e+06 rnd     6e+06 seq   99.3% same seg   0.03% same pg
+Compilation: 1 msec 0 reads         0% read 0 messages         0% clw
+"""
+
+
+class Test01Profile(unittest.TestCase):
+    def test_01_operators(self):
+        operators = parse_report(profile_report.splitlines())
+        assert len(operators) == 6, operators
+        by_name = dict((op['operator'], op) for op in operators)
+        orders = by_name['ORDERS   1.5e+06 rows(t2.O_ORDERKEY)']
+        assert orders['time_pct'] == 24, orders
+        assert orders['fanout'] == 1.5e6, orders
+        assert orders['input_rows'] == 1, orders
+        lineitem = operators[4]
+        assert lineitem['operator'].startswith('LINEITEM'), lineitem
+        assert lineitem['time_pct'] == 76, lineitem
+        assert lineitem['input_rows'] == 1.5e6, lineitem
+        assert ' inlined  L_ORDERKEY = t2.O_ORDERKEY' in lineitem['detail']
+        select = operators[-1]
+        assert select['operator'] == 'Select (count)', select
+        assert select['detail'] == ['Select (count)'], select
+        assert operators[0]['operator'] is None, operators[0]
+        assert operators[1]['operator'] == 'fork', operators[1]
+
+    def test_02_plan(self):
+        plan = QueryPlan('SPARQL SELECT * { ?s ?p ?o }', b'select 1',
+                         [profile_report.encode('utf-8')], True)
+        assert plan.sql == 'select 1', plan.sql
+        assert plan.total_msec == 3187, plan.total_msec
+        assert len(plan.operators) == 6, plan.operators
+        assert 'Compilation' not in plan.operators[-1]['detail'][-1]
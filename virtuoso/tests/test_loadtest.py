@@ -0,0 +1,58 @@
+"""
+Smoke tests of the load generator of benchmarks/loadtest.py, on the
+offline stand-in.
+"""
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), "benchmarks"))
+
+import loadtest
+from virtuoso.offline import OfflineServer
+from virtuoso.pool import StoreFactory
+
+KEYS = set(["ops", "ops_per_sec", "p50", "p95", "p99", "max", "errors",
+            "deadlocks", "error_rate", "deadlock_rate"])
+
+
+class Test01LoadTest(unittest.TestCase):
+    def test_01_run(self):
+        factory = StoreFactory("offline", connect=OfflineServer().connect)
+        workload = loadtest.Workload(loadtest.EX.graph, keyspace=20, batch=5)
+        store = factory()
+        workload.populate(store)
+        store.close()
+        report = loadtest.run(factory, workload,
+                              loadtest.parse_mix(loadtest.DEFAULT_MIX),
+                              threads=2, duration=30, max_ops=15)
+        assert "total" in report
+        for name, r in report.items():
+            assert name in loadtest.OPERATIONS + ("total",), name
+            assert set(r) == KEYS, r
+        total = report["total"]
+        assert total["ops"] + total["errors"] + total["deadlocks"] == 30
+        assert total["errors"] == 0 and total["error_rate"] == 0.0
+        assert total["ops_per_sec"] > 0
+        assert total["p50"] <= total["p95"] <= total["p99"] <= total["max"]
+        assert sum(r["ops"] for name, r in report.items()
+                   if name != "total") == total["ops"]
+
+        out = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        loadtest.print_report(report, out)
+        lines = out.getvalue().splitlines()
+        assert lines[0].split()[0] == "op" and lines[-1].split()[0] == "total"
+
+    def test_02_main(self):
+        assert loadtest.main(["--offline", "--populate", "--keyspace", "10",
+                              "--threads", "1", "--duration", "0.2"]) == 0
+        self.assertRaises(SystemExit, loadtest.main,
+                          ["--offline", "--dsn", "DSN=VOS"])
+        self.assertRaises(SystemExit, loadtest.main,
+                          ["--offline", "--processes", "2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+"""
+Tests of the local copies of pinned graphs, on the offline stand-in.
+"""
+import threading
+import unittest
+
+from rdflib.graph import Graph
+from rdflib.namespace import RDF, RDFS, XSD
+from rdflib.term import URIRef, Literal
+
+from virtuoso.graph import VirtuosoGraph
+from virtuoso.local import LocalGraphs, count_fingerprint
+from virtuoso.metrics import Instrumentation
+from virtuoso.offline import OfflineServer
+from virtuoso.replica import ReplicaSet
+from virtuoso.vstore import Virtuoso
+
+ex = "http://example.org/local/"
+
+
+class Test01Store(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = Instrumentation()
+        self.local = LocalGraphs(refresh=3600)
+        self.server = OfflineServer()
+        self.store = Virtuoso("offline", connect=self.server.connect,
+                              local_graphs=self.local,
+                              instrumentation=self.instrumentation)
+        self.graph = VirtuosoGraph(self.store, identifier=URIRef(ex + "graph"))
+        self.graph.addN((URIRef(ex + "c%d" % i), RDFS.subClassOf,
+                         URIRef(ex + "c%d" % (i + 1)), self.graph)
+                        for i in range(5))
+        self.local.pin(self.store, self.graph)
+
+    def queries(self):
+        return sum(v for k, v in self.instrumentation.snapshot().items()
+                   if k.startswith("queries."))
+
+    def test_01_reads(self):
+        before = self.queries()
+        assert self.graph.value(URIRef(ex + "c0"), RDFS.subClassOf) == \
+            URIRef(ex + "c1")
+        assert len(list(self.graph.subjects(RDFS.subClassOf))) == 5
+        assert (URIRef(ex + "c4"), RDFS.subClassOf, URIRef(ex + "c5")) \
+            in self.graph
+        assert len(self.graph) == 5
+        assert self.queries() == before
+        assert self.local.registry.snapshot()["local.reads"] == 4
+
+    def test_02_writes(self):
+        triple = (URIRef(ex + "c5"), RDFS.subClassOf, URIRef(ex + "c6"))
+        self.graph.add(triple)
+        self.graph.remove((URIRef(ex + "c0"), None, None))
+        before = self.queries()
+        assert triple in self.graph and len(self.graph) == 5
+        assert self.queries() == before
+        self.store.transaction()
+        try:
+            self.graph.add((URIRef(ex + "c6"), RDF.type, RDFS.Class))
+        finally:
+            self.store.commit()
+        assert len(self.graph) == 6
+        assert self.local.registry.snapshot()["local.reloads"] == 2
+
+    def test_03_refresh(self):
+        other = Virtuoso("offline", connection=self.server.connect("offline"))
+        Graph(other, identifier=self.graph.identifier).add(
+            (URIRef(ex + "c5"), RDFS.label, Literal("c5")))
+        assert len(self.graph) == 5
+        self.local.refresh = 0
+        assert len(self.graph) == 6
+        self.local.unpin(self.graph)
+        assert self.graph.identifier not in self.local
+
+    def test_04_unlocked_reload(self):
+        free = []
+
+        def try_lock():
+            if self.local._lock.acquire(False):
+                self.local._lock.release()
+                free.append(True)
+
+        def fingerprint(store, context):
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            return count_fingerprint(store, context)
+        self.local.fingerprint = fingerprint
+        self.local.expire(self.graph)
+        assert len(self.graph) == 5
+        assert free == [True]
+
+    def test_05_written_while_loading(self):
+        load = self.local._load
+        triple = (URIRef(ex + "c5"), RDFS.subClassOf, URIRef(ex + "c6"))
+
+        def write_then_load(store, identifier):
+            self.local._load = load
+            self.graph.add(triple)
+            return load(store, identifier)
+        self.local._load = write_then_load
+        self.local.expire(self.graph)
+        before = self.queries()
+        # the graph loaded may miss the write: read from the server
+        assert triple in self.graph
+        assert self.queries() > before
+        reloads = self.local.registry.snapshot()["local.reloads"]
+        assert len(self.graph) == 6
+        assert self.local.registry.snapshot()["local.reloads"] == reloads + 1
+
+    def test_06_written_by_both(self):
+        other = Virtuoso("offline", connection=self.server.connect("offline"))
+        self.graph.add((URIRef(ex + "c5"), RDFS.label, Literal("mine")))
+        Graph(other, identifier=self.graph.identifier).add(
+            (URIRef(ex + "c5"), RDFS.label, Literal("theirs")))
+        self.local.refresh = 0
+        # the fingerprint is that of both writes, which the copy lacks
+        assert set(self.graph.objects(URIRef(ex + "c5"), RDFS.label)) == \
+            set([Literal("mine"), Literal("theirs")])
+
+    def test_07_widened_float(self):
+        weight = (URIRef(ex + "c0"), RDFS.comment,
+                  Literal("1.1", datatype=XSD.float))
+        other = Virtuoso("offline", connection=self.server.connect("offline"))
+        Graph(other, identifier=self.graph.identifier).add(weight)
+        self.local.expire(self.graph)
+        # the copy holds the widened value Virtuoso returns
+        assert weight in self.graph
+        assert len(list(self.graph.triples(weight))) == 1
+        assert list(self.graph.subjects(RDFS.comment, weight[2])) == \
+            [weight[0]]
+
+
+class Test02Replicas(unittest.TestCase):
+    def test_01_primary(self):
+        servers = dict((dsn, OfflineServer()) for dsn in ("primary", "r1"))
+        servers["primary"].load('<%sc0> <%s> <%sc1> <%sgraph> .'
+                                % (ex, RDFS.subClassOf, ex, ex))
+        local = LocalGraphs(refresh=0)
+        store = Virtuoso("primary", replicas=ReplicaSet(["r1"],
+                                                        pin_after_write=None),
+                         connect=lambda dsn: servers[dsn].connect(),
+                         local_graphs=local)
+        try:
+            graph = Graph(store, identifier=URIRef(ex + "graph"))
+            local.pin(store, graph)
+            # the replica is empty
+            assert len(graph) == 1
+            assert graph.value(URIRef(ex + "c0"), RDFS.subClassOf) == \
+                URIRef(ex + "c1")
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
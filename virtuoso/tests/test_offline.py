@@ -0,0 +1,232 @@
+"""
+Run the store tests against the offline stand-in, which needs no server.
+"""
+import io
+import unittest
+
+from rdflib.namespace import RDF, RDFS, XSD
+from rdflib.term import URIRef, Literal, BNode
+
+from virtuoso.vstore import (Virtuoso, PrefetchIterator, resolve,
+                             _term_primitive, _term_from_primitive)
+from virtuoso.offline import OfflineServer, encode_term
+from virtuoso.trace import TraceRecorder, load_trace
+from . import test_rdflib3
+
+server = OfflineServer()
+server.load('<http://example.org/offline> <%s> <%s> <http://example.org/fixture> .'
+            % (RDF.type, RDFS.Resource))
+
+
+def make_offline_store(**kwargs):
+    return Virtuoso("offline", connect=server.connect, **kwargs)
+
+
+class Test00OfflineOpen(test_rdflib3.Test00Open):
+    make_store = staticmethod(make_offline_store)
+
+
+class Test01OfflineStore(test_rdflib3.Test01Store):
+    make_store = staticmethod(make_offline_store)
+
+
+class Test02OfflineContexts(test_rdflib3.Test02Contexts):
+    make_store = staticmethod(make_offline_store)
+
+
+class Test03OfflineLongIri(test_rdflib3.Test01Store):
+    make_store = staticmethod(lambda **kw: make_offline_store(long_iri=True, **kw))
+
+
+class Test06OfflineDecodeWorkers(test_rdflib3.Test01Store):
+    make_store = staticmethod(lambda **kw: make_offline_store(
+        long_iri=True, decode_workers=2, fetch_block_size=3, **kw))
+
+
+class Test07OfflinePrefetch(test_rdflib3.Test01Store):
+    make_store = staticmethod(lambda **kw: make_offline_store(
+        prefetch_depth=2, fetch_block_size=3, **kw))
+
+
+class Test04Encoding(unittest.TestCase):
+    def test_01_round_trip(self):
+        cursor = server.connect().cursor()
+        for term in [s[2] for s in test_rdflib3.test_statements] + [BNode()]:
+            assert resolve(cursor, encode_term(term)) == term, term
+            assert resolve(cursor, encode_term(term, server.iri_id)) == term, term
+
+    def test_02_rollback(self):
+        connection = server.connect()
+        cursor = connection.cursor()
+        cursor.execute('SPARQL INSERT DATA { GRAPH <http://example.org/rb> '
+                       '{ <http://example.org/a> <http://example.org/b> "c" } }')
+        cursor.execute('SPARQL ASK { GRAPH <http://example.org/rb> { ?s ?p ?o } }')
+        assert cursor.fetchall()
+        cursor.execute('ROLLBACK WORK')
+        cursor.execute('SPARQL ASK { GRAPH <http://example.org/rb> { ?s ?p ?o } }')
+        assert not cursor.fetchall()
+
+    def test_03_decode_primitives(self):
+        # as decoded by the worker processes of decode_workers
+        cursor = server.connect().cursor()
+        terms = [s[2] for s in test_rdflib3.test_statements] + [
+            BNode(), Literal("2014-10-20T12:34:56Z", datatype=XSD.dateTime),
+            Literal("1.5", datatype=XSD.float), Literal("x", datatype=XSD.integer)]
+        for term in terms:
+            for cell in (encode_term(term), encode_term(term, server.iri_id)):
+                expected = resolve(cursor, cell)
+                term2 = _term_from_primitive(_term_primitive(cell), cursor, {})
+                assert term2 == expected and type(term2) is type(expected), term
+                if isinstance(term2, Literal):
+                    assert term2.eq(expected) and term2.value == expected.value, term
+                    assert hash(term2) == hash(expected), term
+
+
+class Test05QueryMany(unittest.TestCase):
+    def setUp(self):
+        self.store = make_offline_store()
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_01_in_order(self):
+        queries = ["SELECT ?s WHERE { ?s a <%s> }" % RDFS.Resource,
+                   "ASK { <http://example.org/offline> ?p ?o }",
+                   "SELECT ?s WHERE { ?s ?p",
+                   ("SELECT ?o WHERE { ?s a ?o }",
+                    dict(initBindings={"s": URIRef("http://example.org/offline")}))]
+        results = self.store.query_many(queries, max_workers=3)
+        assert [list(r) for r in (results[0], results[3])] == [
+            [(URIRef("http://example.org/offline"),)], [(RDFS.Resource,)]]
+        assert bool(results[1])
+        assert isinstance(results[2], Exception)
+
+    def test_02_as_completed(self):
+        queries = ["ASK { ?s ?p %d }" % i for i in range(10)]
+        results = list(self.store.query_many(queries, as_completed=True))
+        assert sorted(i for i, result in results) == list(range(10))
+        assert self.store._query_pool.in_use == 0
+
+    def test_03_batch(self):
+        results = self.store.query_batch(
+            ["SELECT ?s WHERE { ?s a <%s> }" % RDFS.Resource,
+             "ASK { <http://example.org/offline> ?p ?o }",
+             "ASK { <http://example.org/nothing> ?p ?o }",
+             "SELECT ?s WHERE { ?s ?p",
+             ("SELECT ?o WHERE { ?s a ?o }",
+              dict(initBindings={"s": URIRef("http://example.org/offline")}))])
+        assert list(results[0]) == [(URIRef("http://example.org/offline"),)]
+        assert [str(v) for v in results[0].vars] == ["s"]
+        assert bool(results[1]) and not bool(results[2])
+        assert isinstance(results[3], Exception)
+        assert list(results[4]) == [(RDFS.Resource,)]
+        self.assertRaises(ValueError, self.store.query_batch,
+                          ["CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o }"])
+
+    def test_04_prefetch_close(self):
+        store = make_offline_store(prefetch_depth=1, fetch_block_size=1)
+        try:
+            result = store.query("SELECT ?s ?p ?o WHERE { ?s ?p ?o }")
+            rows = result._eagerIterator.g
+            assert isinstance(rows, PrefetchIterator)
+            next(iter(result))
+            rows.close()
+            rows._thread.join(5)
+            assert not rows._thread.is_alive()
+        finally:
+            store.close()
+
+    def test_05_batch_procedure(self):
+        batch_server = OfflineServer()
+        def batch_statements(dsn):
+            trace = io.StringIO()
+            recorder = TraceRecorder(trace)
+            store = Virtuoso(dsn, connect=batch_server.connect, recorder=recorder)
+            store.query_batch(["ASK { ?s ?p ?o }"])
+            store.close()
+            trace.seek(0)
+            return [r["sql"] for r in load_trace(trace)
+                    if "PROCEDURE" in r["sql"].upper()]
+        created = batch_statements("offline-batch")
+        assert len(created) == 2 and created[1].startswith("CREATE"), created
+        # once per DSN
+        assert batch_statements("offline-batch") == []
+        # an existing procedure is not created again
+        created = batch_statements("offline-batch-2")
+        assert len(created) == 1 and "SYS_PROCEDURES" in created[0], created
+
+    def test_06_batch_bad_row(self):
+        class Cursor(object):
+            description = [("s", None, None, None, None, None, True)]
+            def fetchall(self):
+                # an IRI_ID the server does not know
+                return [(encode_term(RDFS.Resource),),
+                        (encode_term(RDFS.Class, lambda iri: 1),)]
+        result = Virtuoso._batch_result("SELECT ?s WHERE { ?s ?p ?o }",
+                                        Cursor(), server.connect().cursor(), None)
+        assert list(result) == [(RDFS.Resource,)]
+
+    def test_07_prefetch_connection(self):
+        connections = []
+        def connect(dsn):
+            connections.append(server.connect())
+            return connections[-1]
+        store = Virtuoso("offline", connect=connect, prefetch_depth=1,
+                         fetch_block_size=1)
+        try:
+            result = store.query("SELECT ?s ?p ?o WHERE { ?s ?p ?o }")
+            # the rows are fetched on a connection of their own
+            assert len(connections) == 2, connections
+            for row in result:
+                # while the store runs other statements
+                assert store.query("ASK { ?s ?p ?o }")
+            result._eagerIterator.g._thread.join(5)
+            assert store._prefetch_pool.in_use == 0
+            # which the next queries run on again
+            for i in range(3):
+                result = store.query("SELECT ?s ?p ?o WHERE { ?s ?p ?o }")
+                assert list(result)
+                result._eagerIterator.g._thread.join(5)
+            assert len(connections) == 2, connections
+            assert not connections[1].closed
+        finally:
+            store.close()
+        assert connections[1].closed
+
+    def test_08_prefetch_connections_in_use(self):
+        store = make_offline_store(prefetch_depth=1, prefetch_connections=1)
+        q = "SELECT ?s ?p ?o WHERE { ?s ?p ?o }"
+        try:
+            # as a query being prefetched
+            clone, cursor = store._prefetch_cursor()
+            result = store.query(q)
+            # runs on the connection of the store
+            assert not isinstance(result._eagerIterator.g, PrefetchIterator)
+            rows = list(result)
+            cursor.close()
+            store._prefetch_pool.release(clone)
+            result = store.query(q)
+            assert isinstance(result._eagerIterator.g, PrefetchIterator)
+            assert list(result) == rows
+            result._eagerIterator.g._thread.join(5)
+        finally:
+            store.close()
+
+
+class Test08GraphBase(unittest.TestCase):
+    def test_01_unique_before_rdflib6(self):
+        from virtuoso import graph
+        # a memory store has no projected scans
+        g = graph.VirtuosoGraph()
+        s = URIRef("http://example.org/s")
+        g.add((s, RDFS.label, Literal("a")))
+        g.add((s, RDFS.label, Literal("b")))
+        base_unique = graph._base_unique
+        graph._base_unique = False
+        try:
+            assert list(g.subjects(RDFS.label, unique=True)) == [s]
+            assert list(g.subjects(RDFS.label)) == [s, s]
+            assert len(set(g.predicate_objects(s, unique=True))) == 2
+        finally:
+            graph._base_unique = base_unique
+        assert list(g.subjects(RDFS.label, unique=True)) == [s]
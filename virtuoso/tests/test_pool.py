@@ -0,0 +1,195 @@
+"""
+Tests of the use of stores across processes, on the offline stand-in.
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+import unittest
+
+from rdflib.namespace import RDFS
+from rdflib.term import URIRef, Literal
+
+from virtuoso.offline import OfflineServer
+from virtuoso.pool import ProcessStoreExecutor, StoreFactory
+from virtuoso.vstore import Virtuoso, OperationalError
+
+ex = "http://example.org/pool/"
+
+server = OfflineServer()
+server.load("\n".join('<%s%d> <%s> "label %d" <%sgraph> .' % (
+    ex, i, RDFS.label, i, ex) for i in range(10)))
+
+
+def offline_connect(dsn):
+    # a module-level function, so that factories can be pickled
+    return server.connect()
+
+
+class _TrackedConnection(object):
+    """
+    An offline connection reporting its release by another process.
+    """
+
+    def __init__(self, connection, events):
+        self._connection = connection
+        self._events = events
+        self._pid = os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def _report(self, event):
+        if os.getpid() != self._pid:
+            self._events.put(event)
+
+    def rollback(self):
+        self._report("rollback")
+        return self._connection.rollback()
+
+    def close(self):
+        self._report("close")
+        return self._connection.close()
+
+    def __del__(self):
+        self._report("del")
+
+
+def _query_in_child(store, queue):
+    try:
+        # detached when forked (python >= 3.7) or else on first use
+        detached = (not hasattr(store, "_connection")
+                    or not hasattr(os, "register_at_fork"))
+        inherited = store._connection if hasattr(store, "_connection") else None
+        answer = bool(store.query("ASK { ?s ?p 'label 1' }"))
+        queue.put((detached and store._connection is not inherited, answer))
+    except Exception as e:
+        queue.put((repr(e), None))
+
+
+# forks, and reports the events of the inherited connection in the child,
+# which ends with the shutdown of the interpreter rather than os._exit
+_exit_script = """
+import os, sys
+from virtuoso.offline import OfflineServer
+from virtuoso.vstore import Virtuoso
+
+class Connection(object):
+    def __init__(self, connection, fd):
+        self._connection = connection
+        # kept, as the module globals may be gone by the time of __del__
+        self._fd, self._pid, self._getpid, self._write = (
+            fd, os.getpid(), os.getpid, os.write)
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+    def _report(self, event):
+        if self._getpid() != self._pid:
+            self._write(self._fd, event + b" ")
+    def rollback(self):
+        self._report(b"rollback")
+        return self._connection.rollback()
+    def close(self):
+        self._report(b"close")
+        return self._connection.close()
+    def __del__(self):
+        self._report(b"del")
+
+server = OfflineServer()
+r, w = os.pipe()
+store = Virtuoso("offline", connect=lambda dsn: Connection(server.connect(), w))
+store.transaction()
+if os.fork() == 0:
+    os.close(r)
+    store.query("ASK { ?s ?p ?o }")
+    del store
+    sys.exit(0)
+os.close(w)
+os.wait()
+events = b""
+while True:
+    data = os.read(r, 100)
+    if not data:
+        break
+    events += data
+store.commit()
+print(repr(events))
+"""
+
+
+def _labels(store, i):
+    return [str(row[0]) for row in store.query(
+        "SELECT ?l WHERE { <%s%d> ?p ?l }" % (ex, i))]
+
+
+class Test00Fork(unittest.TestCase):
+    def test_01_reconnect_after_fork(self):
+        store = Virtuoso("offline", connect=offline_connect)
+        connection = store.connection
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        child = context.Process(target=_query_in_child, args=(store, queue))
+        child.start()
+        reconnected, answer = queue.get(timeout=30)
+        child.join()
+        assert reconnected is True, reconnected
+        assert answer is True
+        assert store.connection is connection
+        store.close()
+
+    def test_02_parent_transaction_survives(self):
+        context = multiprocessing.get_context("fork")
+        events = context.Queue()
+        store = Virtuoso("offline", connect=lambda dsn: _TrackedConnection(
+            server.connect(), events))
+        store.transaction()
+        triple = (URIRef(ex + "forked"), RDFS.label, Literal("forked"))
+        store.add(triple, context=URIRef(ex + "graph"))
+        queue = context.Queue()
+        child = context.Process(target=_query_in_child, args=(store, queue))
+        child.start()
+        reconnected, answer = queue.get(timeout=30)
+        child.join()
+        assert reconnected is True and answer is True
+        # the child released nothing of the parent's session
+        assert events.empty()
+        store.commit()
+        assert store.__contains__(triple, URIRef(ex + "graph"))
+        store.remove(triple, URIRef(ex + "graph"))
+        store.close()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_03_child_exit(self):
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env["PYTHONPATH"] = os.pathsep.join(
+            [root] + [p for p in [env.get("PYTHONPATH")] if p])
+        out = subprocess.check_output([sys.executable, "-c", _exit_script],
+                                      env=env)
+        # the child released nothing of the parent's session, even when
+        # finalized
+        assert out.strip() in (b"''", b"b''"), out
+
+    def test_04_given_connection(self):
+        store = Virtuoso(connection=server.connect())
+        store._pid = -1  # as if forked
+        self.assertRaises(OperationalError, store.cursor)
+
+
+class Test01ProcessStoreExecutor(unittest.TestCase):
+    def test_01_tasks(self):
+        factory = StoreFactory("offline", connect=offline_connect)
+        with ProcessStoreExecutor(factory, max_workers=2) as executor:
+            rows = executor.query(
+                "SELECT ?l WHERE { <%s3> ?p ?l }" % ex).result(30)
+            assert rows == [(Literal("label 3"),)], rows
+            assert executor.query("ASK { ?s ?p 'label 4' }").result(30)
+            assert list(executor.map(_labels, range(3))) == [
+                ["label %d" % i] for i in range(3)]
+            loaded = executor.load('<%sa> <%s> "a" .' % (ex, RDFS.label),
+                                   context=URIRef(ex + "loaded"))
+            assert loaded.result(30) == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
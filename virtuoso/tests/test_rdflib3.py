@@ -50,18 +50,24 @@ test_statements = [
 ns_test = (URIRef("http://bnb.bibliographica.org/entry/GB8102507"), RDFS["label"], Literal("foo"))
 test_statements.append(ns_test)
 
+def make_store(**kwargs):
+    return Virtuoso(rdflib_connection, **kwargs)
+
 class Test00Open(unittest.TestCase):
+    make_store = staticmethod(make_store)
 
     def test_open(self):
-        store = Virtuoso(rdflib_connection)
+        store = self.make_store()
         graph = Graph(store)
         result = graph.query("ASK { ?s ?p ?o }")
         assert not result
 
 class Test01Store(unittest.TestCase):
+    make_store = staticmethod(make_store)
+
     @classmethod
     def setUp(cls):
-        cls.store = Virtuoso(rdflib_connection)
+        cls.store = cls.make_store()
         cls.identifier = URIRef("http://example2.org/")
         cls.graph = Graph(cls.store, identifier=cls.identifier)
         cls.graph.remove((None, None, None))
@@ -363,6 +369,212 @@ class Test01Store(unittest.TestCase):
         self.graph.addN(many_quads)
         assert len(self.graph) == how_many
 
+    def test_31_explain(self):
+        TST=Namespace('http://example.com/ns/')
+        self.graph.add((TST.a, TST.b, TST.c))
+        plan = self.store.explain("SELECT * { ?s tst:b ?o }",
+                                  initNs={ "tst": TST },
+                                  queryGraph=self.graph.identifier)
+        assert plan.query.startswith("SPARQL "), plan.query
+        assert "PREFIX tst:" in plan.query, plan.query
+        assert plan.sql, plan.sql
+        assert plan.lines, plan.lines
+        assert not plan.operators
+
+    def test_32_profile(self):
+        TST=Namespace('http://example.com/ns/')
+        self.graph.add((TST.a, TST.b, TST.c))
+        plan = self.store.profile("SELECT * { ?s ?p ?o }",
+                                  initBindings={ "p": TST.b },
+                                  queryGraph=self.graph.identifier)
+        assert plan.lines, plan.lines
+        assert plan.operators, plan.lines
+        assert all(op['time_pct'] >= 0 for op in plan.operators)
+
+    def test_33_instrumentation(self):
+        from virtuoso.metrics import Instrumentation
+        seen = []
+        instrumentation = Instrumentation(hooks=[seen.append])
+        store = self.make_store(instrumentation=instrumentation)
+        try:
+            quads = ( (s, p, o, self.graph) for s,p,o in test_statements )
+            store.addN(quads)
+            results = list(store.query(
+                "SELECT * { GRAPH %s { ?s ?p ?o } }" % self.identifier.n3()))
+        finally:
+            store.close()
+        assert [s.kind for s in seen] == ["update", "select"], seen
+        assert seen[0].batch_size == len(test_statements)
+        assert seen[1].rows == len(results)
+        snapshot = instrumentation.snapshot()
+        assert snapshot['queries.select'] == 1
+        assert snapshot['write.batch_size']['max'] == len(test_statements)
+
+    def test_34_triples_choices(self):
+        from virtuoso.metrics import Instrumentation
+        for statement in test_statements:
+            self.graph.add(statement)
+        instrumentation = Instrumentation()
+        store = self.make_store(instrumentation=instrumentation)
+        try:
+            graph = Graph(store, identifier=self.identifier)
+            labels = set(graph.triples_choices(
+                (ex_subject, [RDFS["label"], RDFS["comment"]], None)))
+            assert instrumentation.snapshot()['queries.select'] == 1
+            expected = set(t for t in test_statements if t[0] == ex_subject
+                           and t[1] in (RDFS["label"], RDFS["comment"]))
+            assert labels == expected, labels
+            types = list(graph.triples_choices(
+                ([ex_subject, ns_test[0]], RDF["type"], None)))
+            assert len(types) == 2, types
+        finally:
+            store.close()
+
+    def test_35_projection(self):
+        from virtuoso.graph import VirtuosoGraph, VirtuosoConjunctiveGraph
+        from virtuoso.metrics import Instrumentation
+        for statement in test_statements:
+            self.graph.add(statement)
+        seen = []
+        store = self.make_store(instrumentation=Instrumentation(hooks=[seen.append]))
+        try:
+            graph = VirtuosoGraph(store, identifier=self.identifier)
+            subjects = list(graph.subjects(RDFS["label"], unique=True))
+            assert sorted(subjects) == sorted([ex_subject, ns_test[0]]), subjects
+            assert seen[-1].query.endswith(
+                "SELECT DISTINCT ?S WHERE { GRAPH %s { ?S %s ?O } }" % (
+                    self.identifier.n3(), RDFS["label"].n3())), seen[-1].query
+            objects = list(graph.objects(ex_subject, RDFS["label"]))
+            assert len(objects) == len([t for t in test_statements if t[:2] == (
+                ex_subject, RDFS["label"])])
+            assert set(graph.predicate_objects(ex_subject)) == set(
+                t[1:] for t in test_statements if t[0] == ex_subject)
+            conjunctive = VirtuosoConjunctiveGraph(store)
+            assert ns_test[0] in set(conjunctive.subjects(unique=True))
+            assert set(conjunctive.subject_predicates(ns_test[2])) == set(
+                [ns_test[:2]])
+        finally:
+            store.close()
+
+    def test_36_describe_many(self):
+        for statement in test_statements:
+            self.graph.add(statement)
+        missing = URIRef("http://example.org/missing")
+        local = Graph()
+        described = self.store.describe_many(
+            [ex_subject, ns_test[0], missing], context=self.graph, graph=local)
+        assert set(described[ex_subject]) == set(
+            t[1:] for t in test_statements if t[0] == ex_subject)
+        assert described[ns_test[0]] == [ns_test[1:]]
+        assert described[missing] == []
+        assert len(local) == len(described[ex_subject]) + 1
+        labels = self.store.describe_many([ex_subject], [RDF["type"]])
+        assert len(labels[ex_subject]) == 2, labels
+
+    def test_37_property_paths(self):
+        from virtuoso.graph import VirtuosoGraph
+        from virtuoso.metrics import Instrumentation
+        chain = [URIRef("http://example.org/class%d" % i) for i in range(4)]
+        for sub, sup in zip(chain, chain[1:]):
+            self.graph.add((sub, RDFS["subClassOf"], sup))
+        self.graph.add((chain[3], RDFS["label"], Literal("top")))
+        seen = []
+        store = self.make_store(instrumentation=Instrumentation(hooks=[seen.append]))
+        try:
+            graph = VirtuosoGraph(store, identifier=self.identifier)
+            ancestors = set(graph.objects(chain[0], RDFS["subClassOf"] * "+"))
+            assert ancestors == set(chain[1:]), ancestors
+            assert len(seen) == 1, [stats.query for stats in seen]
+            assert set(graph.transitive_subjects(RDFS["subClassOf"], chain[2])) \
+                == set(chain[:3])
+            assert list(graph.transitive_objects(chain[2], RDFS["subClassOf"])) \
+                == chain[2:]
+            path = (RDFS["subClassOf"] | RDFS["seeAlso"]) * "*" / RDFS["label"]
+            assert graph.value(chain[1], path) == Literal("top")
+            assert (chain[0], RDFS["subClassOf"] * "+", chain[3]) in graph
+            assert (chain[3], RDFS["subClassOf"] * "+", chain[0]) not in graph
+            assert len(seen) == 6, [stats.query for stats in seen]
+        finally:
+            store.close()
+
+    def test_38_update(self):
+        from virtuoso.metrics import Instrumentation
+        for statement in test_statements:
+            self.graph.add(statement)
+        seen = []
+        store = self.make_store(instrumentation=Instrumentation(hooks=[seen.append]))
+        try:
+            graph = Graph(store, identifier=self.identifier)
+            graph.update(u"INSERT { ?s rdfs:seeAlso ?o } WHERE { ?s rdfs:label ?o }",
+                         initNs={"rdfs": RDFS})
+            assert len(seen) == 1, [stats.query for stats in seen]
+            labels = set(graph.subject_objects(RDFS["label"]))
+            assert set(graph.subject_objects(RDFS["seeAlso"])) == labels
+            graph.update(u"DELETE { ?s rdfs:seeAlso ?o } WHERE { ?s rdfs:seeAlso ?o }",
+                         initNs={"rdfs": RDFS}, initBindings={"s": ns_test[0]})
+            assert set(graph.subject_objects(RDFS["seeAlso"])) == set(
+                (s, o) for (s, o) in labels if s != ns_test[0])
+            # no WHERE clause to bind ?s in
+            self.assertRaises(ValueError, graph.update,
+                              u"INSERT DATA { <%s> rdfs:label \"}\" }" % ns_test[0],
+                              initNs={"rdfs": RDFS},
+                              initBindings={"s": ns_test[0]})
+        finally:
+            store.close()
+
+    def test_39_unbound_transitive_path(self):
+        from virtuoso.graph import VirtuosoGraph
+        from virtuoso.metrics import Instrumentation
+        chain = [URIRef("http://example.org/class%d" % i) for i in range(3)]
+        for sub, sup in zip(chain, chain[1:]):
+            self.graph.add((sub, RDFS["subClassOf"], sup))
+        seen = []
+        store = self.make_store(instrumentation=Instrumentation(hooks=[seen.append]))
+        try:
+            graph = VirtuosoGraph(store, identifier=self.identifier)
+            # neither end bound: evaluated hop by hop rather than refused
+            pairs = set(graph.subject_objects(RDFS["subClassOf"] * "+"))
+            assert pairs == set([(chain[0], chain[1]), (chain[0], chain[2]),
+                                 (chain[1], chain[2])]), pairs
+            assert not any("subClassOf>+" in stats.query for stats in seen), \
+                [stats.query for stats in seen]
+            # one end bound: a single query
+            del seen[:]
+            assert set(graph.objects(chain[0], RDFS["subClassOf"] * "+")) \
+                == set(chain[1:])
+            assert len(seen) == 1, [stats.query for stats in seen]
+        finally:
+            store.close()
+
+    def test_40_plan_admission(self):
+        import threading
+        from virtuoso.admission import AdmissionController, AdmissionTimeout
+        from virtuoso.metrics import Instrumentation
+        seen = []
+        admission = AdmissionController(limits={"batch": 1}, timeout=0.05)
+        store = self.make_store(instrumentation=Instrumentation(hooks=[seen.append]),
+                                admission=admission)
+        try:
+            connection = store.connection
+            # as if used in a forked process
+            store._pid = os.getpid() + 1
+            plan = store.explain("SELECT * { ?s ?p ?o }", priority="batch")
+            assert plan.sql, plan.sql
+            assert store.connection is not connection
+            store.profile("SELECT * { ?s ?p ?o }")
+            assert [stats.kind for stats in seen] == ["explain", "profile"], seen
+            assert all(stats.rows for stats in seen)
+            assert admission.in_flight == dict(interactive=0, batch=0, write=0)
+            # waits for a slot of its class
+            holder = threading.Thread(target=admission.acquire, args=("batch",))
+            holder.start()
+            holder.join(5)
+            self.assertRaises(AdmissionTimeout, store.explain,
+                              "SELECT * { ?s ?p ?o }", priority="batch")
+            store.explain("SELECT * { ?s ?p ?o }")
+        finally:
+            store.close()
+
     def test_99_deadlock(self):
         os.environ["VSTORE_DEBUG"] = "TRUE"
         dirname = os.path.dirname(__file__)
@@ -390,9 +602,11 @@ class Test01Store(unittest.TestCase):
         assert statement not in self.graph, "%s found" % (statement,)
 
 class Test02Contexts(unittest.TestCase):
+    make_store = staticmethod(make_store)
+
     @classmethod
     def setUp(cls):
-        cls.store = Virtuoso(rdflib_connection)
+        cls.store = cls.make_store()
         cls.id1 = URIRef("http://example2.org/g1")
         cls.g1 = Graph(cls.store, identifier=cls.id1)
         cls.g1.remove((None, None, None))
@@ -0,0 +1,94 @@
+"""
+Tests of the routing of reads to replicas, on offline stand-ins.
+"""
+import unittest
+
+from rdflib.graph import Graph
+from rdflib.namespace import RDFS
+from rdflib.term import URIRef, Literal
+
+from virtuoso.offline import OfflineServer
+from virtuoso.replica import ReplicaSet, LEAST_LOADED
+from virtuoso.vstore import Virtuoso
+
+ex = "http://example.org/replica/"
+
+
+class Test00ReplicaSet(unittest.TestCase):
+    def test_01_routing(self):
+        replicas = ReplicaSet(["a", "b", "c"])
+        assert [replicas.acquire() for i in range(4)] == [0, 1, 2, 0]
+        replicas = ReplicaSet(["a", "b", "c"], routing=LEAST_LOADED)
+        assert replicas.acquire() == 0
+        assert replicas.acquire() == 1
+        replicas.release(0)
+        assert replicas.acquire() == 2
+        assert replicas.acquire() == 0
+        assert replicas.in_flight == [1, 1, 1]
+        self.assertRaises(ValueError, ReplicaSet, [])
+        self.assertRaises(ValueError, ReplicaSet, ["a"], routing="random")
+
+    def test_02_pinning(self):
+        replicas = ReplicaSet(["a"], pin_after_write=0)
+        assert not replicas.pinned(None)
+        assert not replicas.pinned(0)
+        replicas.pin_after_write = None
+        assert replicas.pinned(0)
+
+
+class Test01Store(unittest.TestCase):
+    def setUp(self):
+        # each server has its own data, to tell where a read ran
+        self.servers = dict((dsn, OfflineServer())
+                            for dsn in ("primary", "r1", "r2"))
+        for dsn, server in self.servers.items():
+            server.load('<%s%s> <%s> "%s" <%sgraph> .'
+                        % (ex, dsn, RDFS.label, dsn, ex))
+        self.replicas = ReplicaSet(["r1", "r2"], pin_after_write=None)
+        self.store = Virtuoso("primary", replicas=self.replicas,
+                              connect=lambda dsn: self.servers[dsn].connect())
+        self.graph = Graph(self.store, identifier=URIRef(ex + "graph"))
+
+    def tearDown(self):
+        self.store.close()
+
+    def labels(self):
+        return [str(o) for o in self.graph.objects(None, RDFS.label)]
+
+    def test_01_reads_on_replicas(self):
+        assert self.labels() == ["r1"]
+        assert self.labels() == ["r2"]
+        assert len(self.graph) == 1
+        assert [c.identifier for c in self.store.contexts()] == [URIRef(ex + "graph")]
+        assert self.replicas.reads == [2, 2]
+        assert self.replicas.in_flight == [0, 0]
+
+    def test_02_read_your_writes(self):
+        self.graph.add((URIRef(ex + "new"), RDFS.label, Literal("new")))
+        assert sorted(self.labels()) == ["new", "primary"]
+        assert self.replicas.reads == [0, 0]
+        # other sessions still read from the replicas
+        clone = self.store.clone()
+        try:
+            graph = Graph(clone, identifier=self.graph.identifier)
+            assert list(graph.objects(None, RDFS.label)) == [Literal("r1")]
+        finally:
+            clone.close()
+
+    def test_03_transaction(self):
+        self.store.transaction()
+        try:
+            assert self.labels() == ["primary"]
+        finally:
+            self.store.rollback()
+        assert self.labels() == ["r1"]
+
+    def test_04_select_held_until_read(self):
+        result = iter(self.store.query("SELECT ?o WHERE { ?s ?p ?o }"))
+        assert self.replicas.in_flight == [1, 0]
+        assert list(result) == [(Literal("r1"),)]
+        assert self.replicas.in_flight == [0, 0]
+
+
+if __name__ == '__main__':
+    unittest.main()
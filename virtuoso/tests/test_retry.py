@@ -0,0 +1,141 @@
+"""
+Tests of the retry of deadlocked writes, on the offline stand-in.
+"""
+import threading
+import unittest
+
+import pyodbc
+from rdflib.graph import Graph
+from rdflib.namespace import RDFS
+from rdflib.term import URIRef, Literal
+
+from virtuoso.metrics import Instrumentation
+from virtuoso.offline import OfflineServer
+from virtuoso.retry import RetryPolicy, is_deadlock
+from virtuoso.vstore import Virtuoso
+
+ex = "http://example.org/retry/"
+
+
+class DeadlockingCursor(object):
+    def __init__(self, cursor, connection):
+        self._cursor = cursor
+        self._deadlocking = connection
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return self._cursor.__exit__(*exc)
+
+    def execute(self, sql, *params):
+        if (self._deadlocking.deadlocks and sql.startswith("SPARQL")
+                and ("INSERT" in sql or "DELETE" in sql)):
+            self._deadlocking.deadlocks -= 1
+            raise pyodbc.Error('40001', 'SR172: Transaction deadlocked')
+        self._cursor.execute(sql, *params)
+        return self
+
+
+class DeadlockingConnection(object):
+    """
+    A connection whose next ``deadlocks`` updates fail as deadlocked.
+    """
+
+    def __init__(self, connection, deadlocks=0):
+        self._connection = connection
+        self.deadlocks = deadlocks
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self):
+        return DeadlockingCursor(self._connection.cursor(), self)
+
+
+class Test00RetryPolicy(unittest.TestCase):
+    def test_01_delays(self):
+        policy = RetryPolicy(base_delay=0.1, max_delay=0.3, jitter=False)
+        assert [policy.delay(n) for n in (1, 2, 3, 4)] == [0.1, 0.2, 0.3, 0.3]
+        policy.jitter = True
+        assert all(0 <= policy.delay(3) <= 0.3 for i in range(100))
+
+    def test_02_run(self):
+        policy = RetryPolicy(max_attempts=3)
+        policy.sleep = lambda delay: None
+        calls = []
+
+        def deadlocking():
+            calls.append(1)
+            raise pyodbc.Error('40001', 'deadlock')
+        self.assertRaises(pyodbc.Error, policy.run, deadlocking)
+        assert len(calls) == 3
+        assert (policy.retries, policy.failures) == (2, 1)
+
+        def failing():
+            calls.append(1)
+            raise pyodbc.Error('42000', 'syntax error')
+        self.assertRaises(pyodbc.Error, policy.run, failing)
+        assert len(calls) == 4
+        assert not is_deadlock(ValueError('40001'))
+
+    def test_03_shared(self):
+        policy = RetryPolicy(max_attempts=2)
+        policy.sleep = lambda delay: None
+
+        def deadlocking():
+            raise pyodbc.Error('40001', 'deadlock')
+
+        def run():
+            for i in range(500):
+                self.assertRaises(pyodbc.Error, policy.run, deadlocking)
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert (policy.retries, policy.failures) == (4000, 4000)
+
+
+class Test01StoreRetry(unittest.TestCase):
+    def setUp(self):
+        self.connection = DeadlockingConnection(OfflineServer().connect())
+        self.policy = RetryPolicy()
+        self.policy.sleep = lambda delay: None
+        self.store = Virtuoso(connection=self.connection, retry=self.policy,
+                              instrumentation=Instrumentation())
+        self.graph = Graph(self.store, identifier=URIRef(ex + "graph"))
+
+    def test_01_addN_and_removeN(self):
+        quads = [(URIRef(ex + str(i)), RDFS.label, Literal(i), self.graph)
+                 for i in range(10)]
+        self.connection.deadlocks = 2
+        self.store.addN(quads)
+        assert len(self.graph) == 10
+        self.connection.deadlocks = 1
+        self.store.removeN(quads[:6] + [(URIRef(ex + "7"), None, None, self.graph)])
+        assert len(self.graph) == 3
+        assert self.policy.retries == 3
+        metrics = self.store.instrumentation.snapshot()
+        assert metrics['write.retries'] == 3, metrics
+        assert metrics['write.retried'] == 2, metrics
+
+    def test_02_transaction_not_retried(self):
+        self.store.transaction()
+        self.connection.deadlocks = 1
+        try:
+            self.assertRaises(pyodbc.Error, self.graph.add,
+                              (URIRef(ex + "a"), RDFS.label, Literal("a")))
+        finally:
+            self.store.rollback()
+        assert self.policy.retries == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
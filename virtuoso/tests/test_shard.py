@@ -0,0 +1,121 @@
+"""
+Tests of the sharded store, on offline stand-ins.
+"""
+import unittest
+
+from rdflib.graph import ConjunctiveGraph, Graph
+from rdflib.namespace import RDFS
+from rdflib.term import URIRef, Literal
+
+from virtuoso.offline import OfflineServer
+from virtuoso.shard import ShardedVirtuoso, HashRing
+from virtuoso.vstore import Virtuoso
+
+ex = "http://example.org/shard/"
+
+
+class Test00HashRing(unittest.TestCase):
+    def test_01_consistent(self):
+        keys = [ex + str(i) for i in range(1000)]
+        ring = HashRing(["a", "b", "c"])
+        before = dict((k, ring.node(k)) for k in keys)
+        assert set(before.values()) == set("abc")
+        after = HashRing(["a", "b", "c", "d"])
+        moved = [k for k in keys if after.node(k) != before[k]]
+        # only keys going to the new node move
+        assert all(after.node(k) == "d" for k in moved)
+        assert 100 < len(moved) < 450, len(moved)
+        self.assertRaises(ValueError, HashRing, [])
+
+
+class Test01ShardedStore(unittest.TestCase):
+    def setUp(self):
+        self.backends = dict((name, Virtuoso(connection=OfflineServer().connect()))
+                             for name in "abc")
+        self.contexts = [URIRef(ex + "graph%d" % i) for i in range(12)]
+        self.store = ShardedVirtuoso(self.backends,
+                                     shard_map={self.contexts[0]: "c"})
+        self.graph = ConjunctiveGraph(self.store)
+        self.graph.addN((URIRef(ex + "s%d" % i), RDFS.label, Literal(i),
+                         Graph(self.store, c))
+                        for (i, c) in enumerate(self.contexts))
+
+    def test_01_routing(self):
+        assert self.store.backend_name(self.contexts[0]) == "c"
+        for c in self.contexts:
+            backend = self.store.backend(c)
+            assert len(Graph(backend, c)) == 1
+            assert len(self.graph.get_context(c)) == 1
+        assert len(set(self.store.backend_name(c) for c in self.contexts)) == 3
+        self.assertRaises(ValueError, self.store.add,
+                          (URIRef(ex + "s"), RDFS.label, Literal("s")), None)
+
+    def test_02_fan_out(self):
+        assert len(self.store) == 12
+        assert sorted(c.identifier for c in self.store.contexts()) == sorted(
+            self.contexts)
+        quads = list(self.graph.quads((None, RDFS.label, None)))
+        assert len(quads) == 12
+        assert sorted(int(o) for (s, p, o, g) in quads) == list(range(12))
+        assert all(g.store is self.store for (s, p, o, g) in quads)
+        # stop reading early
+        for quad in self.graph.quads((None, None, None)):
+            break
+
+    def test_03_remove(self):
+        self.graph.get_context(self.contexts[1]).remove(
+            (None, RDFS.label, None))
+        assert len(self.store) == 11
+        self.graph.remove((URIRef(ex + "s2"), None, None))
+        assert len(self.store) == 10
+        assert (URIRef(ex + "s3"), RDFS.label, Literal(3)) in self.graph
+
+
+class Test02ClonedBackends(unittest.TestCase):
+    def setUp(self):
+        self.servers = dict((name, OfflineServer()) for name in "ab")
+        self.connections = []
+        self.backends = dict(
+            (name, Virtuoso(name, connect=self._connect(server)))
+            for (name, server) in self.servers.items())
+        self.store = ShardedVirtuoso(self.backends)
+        self.graph = ConjunctiveGraph(self.store)
+        self.graph.addN((URIRef(ex + "s%d" % i), RDFS.label, Literal(i),
+                         Graph(self.store, URIRef(ex + "graph%d" % i)))
+                        for i in range(6))
+
+    def _connect(self, server):
+        def connect(dsn):
+            self.connections.append(server.connect())
+            return self.connections[-1]
+        return connect
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_01_streams_on_clones(self):
+        opened = len(self.connections)
+        triples = [t for (t, ctxs) in self.store.triples((None, None, None))]
+        assert len(triples) == 6
+        # one clone per backend, closed at the end
+        clones = self.connections[opened:]
+        assert len(clones) == 2 and all(c.closed for c in clones), clones
+        # the backends remain usable while iterating
+        for t, ctxs in self.store.triples((None, RDFS.label, None)):
+            assert len(self.store.backend(ctxs[0])) > 0
+
+    def test_02_pending_transaction(self):
+        backend = self.backends["a"]
+        backend.transaction()
+        context = next(c for c in (URIRef(ex + "new%d" % i) for i in range(10))
+                       if self.store.backend_name(c) == "a")
+        self.store.add((URIRef(ex + "new"), RDFS.label, Literal("new")),
+                       context)
+        # read by the caller, on the backend, rather than on a clone
+        assert (URIRef(ex + "new"), RDFS.label, Literal("new")) in set(
+            t for (t, ctxs) in self.store.triples((None, None, None)))
+        backend.rollback()
+
+
+if __name__ == '__main__':
+    unittest.main()
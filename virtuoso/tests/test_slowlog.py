@@ -0,0 +1,68 @@
+import logging
+import unittest
+
+from virtuoso.metrics import QueryStats
+from virtuoso.slowlog import fingerprint, SlowQueryLog
+
+
+class Test01Fingerprint(unittest.TestCase):
+    def test_01_terms(self):
+        q1 = 'SELECT * { <http://example.com/a> ?p "foo"@en ; ?q 42 }'
+        q2 = 'SELECT * { <http://example.com/b> ?p "bar"^^xsd:string ; ?q -3.5e2 }'
+        assert fingerprint(q1) == fingerprint(q2), (fingerprint(q1), fingerprint(q2))
+        assert fingerprint(q1) == 'SELECT * { <?> ?p ? ; ?q ? }', fingerprint(q1)
+
+    def test_02_values(self):
+        q1 = 'SELECT * { ?s ?p ?o VALUES ?s { <http://a> <http://b> } }'
+        q2 = 'SELECT * { ?s ?p ?o VALUES ?s { <http://c> } }'
+        assert fingerprint(q1) == fingerprint(q2)
+        q3 = 'SELECT * { ?s ?p ?o VALUES (?s ?o) { (<http://a> 1) (UNDEF "x") } }'
+        assert fingerprint(q3) == 'SELECT * { ?s ?p ?o VALUES (?s ?o) { ? } }', fingerprint(q3)
+
+    def test_03_variables_and_comments(self):
+        q1 = 'SELECT ?x1 {\n  ?x1 ex:p2 ?o # first\n}'
+        q2 = 'SELECT ?x1 { ?x1 ex:p2 ?o }'
+        assert fingerprint(q1) == fingerprint(q2) == q2, fingerprint(q1)
+
+
+class Test02SlowQueryLog(unittest.TestCase):
+    def make_stats(self, q, elapsed, rows=1):
+        stats = QueryStats(q, 'select')
+        stats.execute_time = elapsed
+        stats.rows = rows
+        return stats
+
+    def test_01_aggregate(self):
+        slow_log = SlowQueryLog(threshold=10)
+        for i in range(10):
+            slow_log(self.make_stats('SELECT * { <http://a/%d> ?p ?o }' % i, 0.1 * i))
+        slow_log(self.make_stats('ASK { ?s ?p ?o }', 0.01))
+        report = slow_log.report()
+        assert len(report) == 2, report
+        assert report[0]['count'] == 10
+        assert report[0]['rows'] == 10
+        assert abs(report[0]['max_time'] - 0.9) < 1e-9
+        assert slow_log.report(order_by='count', limit=1)[0]['count'] == 10
+
+    def test_02_threshold(self):
+        logger = logging.getLogger('test_slowlog')
+        logged = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                logged.append(record.getMessage())
+        handler = Handler()
+        logger.addHandler(handler)
+        try:
+            slow_log = SlowQueryLog(threshold=0.5, logger=logger)
+            slow_log(self.make_stats('SELECT * { <http://fast> ?p ?o }', 0.1))
+            slow_log(self.make_stats('SELECT * { <http://slow> ?p ?o }', 1.0))
+        finally:
+            logger.removeHandler(handler)
+        assert len(logged) == 1, logged
+        assert '<http://slow>' in logged[0], logged
+
+    def test_03_bounded(self):
+        slow_log = SlowQueryLog(threshold=10, max_fingerprints=2)
+        for q in ['ASK { ?a ?b ?c }', 'ASK { ?d ?e ?f }', 'ASK { ?g ?h ?i }']:
+            slow_log(self.make_stats(q, 0.1))
+        assert len(slow_log.report()) == 2
@@ -0,0 +1,137 @@
+import io
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from rdflib.graph import Graph
+from rdflib.namespace import RDF, RDFS
+from rdflib.term import URIRef, Literal
+
+from virtuoso.vstore import Virtuoso
+from virtuoso.offline import OfflineServer
+from virtuoso.trace import (
+    TraceRecorder, ReplayConnection, ReplayError, load_trace, replay)
+from . import rdflib_connection
+
+
+class Test01Trace(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.buffer = io.StringIO()
+        cls.recorder = TraceRecorder(cls.buffer)
+        cls.store = Virtuoso(rdflib_connection, recorder=cls.recorder)
+        cls.identifier = URIRef("http://example2.org/trace")
+        cls.graph = Graph(cls.store, identifier=cls.identifier)
+        cls.graph.remove((None, None, None))
+
+    @classmethod
+    def tearDown(cls):
+        cls.graph.remove((None, None, None))
+        cls.store.close()
+
+    def records(self):
+        self.recorder.flush()
+        return load_trace(io.StringIO(self.buffer.getvalue()))
+
+    def test_01_record(self):
+        self.graph.add((self.identifier, RDF.type, RDFS.Resource))
+        result = list(self.graph.triples((None, None, None)))
+        assert len(result) == 1
+        records = self.records()
+        sparql = [r for r in records if r["sql"].startswith("SPARQL")]
+        assert any("INSERT DATA" in r["sql"] for r in sparql), sparql
+        select = [r for r in sparql if "SELECT" in r["sql"]][-1]
+        assert len(select["rows"]) == 1, select
+        assert all(isinstance(cell, tuple) for cell in select["rows"][0])
+
+    def test_02_replay(self):
+        self.graph.add((self.identifier, RDFS.label, Literal("traced", lang="en")))
+        q = "SELECT ?s ?o { GRAPH %s { ?s ?p ?o } }" % self.identifier.n3()
+        expected = list(self.store.query(q))
+        records = self.records()
+        replayed = Virtuoso(connection=ReplayConnection(records))
+        assert list(replayed.query(q)) == expected
+        report = replay(records)
+        assert report["missing"] == 0, report
+        assert report["rows"] >= 1, report
+
+    def test_03_strict(self):
+        connection = ReplayConnection(self.records(), strict=True)
+        self.assertRaises(ReplayError, connection.execute, "SPARQL ASK { ?s ?p ?o }")
+
+
+class Test02OfflineTrace(unittest.TestCase):
+    def setUp(self):
+        self.buffer = io.StringIO()
+        self.recorder = TraceRecorder(self.buffer)
+        self.server = OfflineServer()
+        self.identifier = URIRef("http://example.org/offline-trace")
+        store = Virtuoso("offline-trace", connect=self.server.connect)
+        graph = Graph(store, identifier=self.identifier)
+        graph.addN([(URIRef("http://example.org/offline-trace/%d" % i),
+                     RDFS.label, Literal(i), graph) for i in range(3)])
+        store.commit()
+        store.close()
+
+    def records(self):
+        self.recorder.close()
+        return load_trace(io.StringIO(self.buffer.getvalue()))
+
+    def test_01_batch(self):
+        queries = ["SELECT ?s WHERE { GRAPH ?g { ?s ?p ?o } }",
+                   "ASK { GRAPH ?g { ?s ?p 1 } }",
+                   "SELECT ?o WHERE { GRAPH ?g { ?s ?p ?o } }"]
+        store = Virtuoso("offline-trace", connect=self.server.connect,
+                         recorder=self.recorder)
+        expected = [list(r) if r.type == "SELECT" else bool(r)
+                    for r in store.query_batch(queries)]
+        store.close()
+        records = self.records()
+        sets = [r for r in records if "of" in r]
+        assert [r["set"] for r in sets] == [1, 2], sets
+        batch = [r for r in records if r.get("id") == sets[0]["of"]]
+        assert len(batch) == 1 and len(batch[0]["rows"]) == 3, batch
+        assert len(sets[0]["rows"]) == 1 and len(sets[1]["rows"]) == 3
+        replayed = Virtuoso(connection=ReplayConnection(records, strict=True))
+        replayed._batch_procedure_created = True
+        assert [list(r) if r.type == "SELECT" else bool(r)
+                for r in replayed.query_batch(queries)] == expected
+        assert replay(records)["missing"] == 0
+
+    def test_02_flush(self):
+        store = Virtuoso("offline-trace", connect=self.server.connect,
+                         recorder=self.recorder)
+        cursor = store.cursor()
+        cursor.execute("SPARQL SELECT ?s WHERE { GRAPH ?g { ?s ?p ?o } }")
+        assert cursor.fetchone() is not None
+        # partly fetched, and never closed
+        records = self.records()
+        assert [len(r["rows"]) for r in records
+                if r["sql"].startswith("SPARQL")] == [1]
+        buffer = io.StringIO()
+        recorder = TraceRecorder(buffer)
+        cursor = Virtuoso("offline-trace", connect=self.server.connect,
+                          recorder=recorder).cursor()
+        cursor.execute("SPARQL SELECT ?s WHERE { GRAPH ?g { ?s ?p ?o } }")
+        assert len(cursor.fetchall()) == 3
+        # written as soon as exhausted
+        assert '"rows"' in buffer.getvalue()
+
+    def test_03_sqlalchemy(self):
+        try:
+            from virtuoso.alchemy import VirtuosoDialect
+            from sqlalchemy.connectors.pyodbc import PyODBCConnector
+        except ImportError as e:
+            self.skipTest(str(e))
+        dialect = VirtuosoDialect(trace_recorder=self.recorder)
+        with mock.patch.object(PyODBCConnector, "connect",
+                               side_effect=self.server.connect, create=True):
+            connection = dialect.connect()
+        cursor = connection.cursor()
+        cursor.execute("SPARQL SELECT ?s WHERE { GRAPH ?g { ?s ?p ?o } }")
+        rows = cursor.fetchmany(10)
+        assert len(rows) == 3
+        records = [r for r in self.records() if r["sql"].startswith("SPARQL")]
+        assert len(records) == 1 and len(records[0]["rows"]) == 3, records
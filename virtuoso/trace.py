@@ -0,0 +1,512 @@
+"""
+Recording and replay of the traffic between the store and pyodbc.
+
+A :class:`TraceRecorder` given to the store as
+``Virtuoso(dsn, recorder=TraceRecorder("trace.jsonl.gz"))``, or to the
+SQLAlchemy dialect as ``create_engine(url, trace_recorder=...)``,
+writes every statement executed on the connection, with its parameters,
+timings and the raw rows fetched, to a trace file (JSON lines, gzipped
+if the name ends in ``.gz``).
+
+A :class:`ReplayConnection` serves a trace back as a fake connection,
+and :func:`replay` runs the recorded SPARQL statements through the
+store's decoding code on such a connection, so the client-side cost of
+real traffic can be measured offline and compared across versions::
+
+    python -m virtuoso.trace trace.jsonl.gz
+"""
+from __future__ import print_function
+from builtins import object
+from collections import defaultdict, deque
+from base64 import b64encode, b64decode
+from decimal import Decimal
+import datetime
+import gzip
+import io
+import json
+import threading
+import logging
+import sys
+import weakref
+
+from past.builtins import basestring
+
+from virtuoso.metrics import clock
+
+__all__ = ['TraceRecorder', 'RecordingConnection', 'RecordingCursor',
+           'ReplayConnection', 'ReplayCursor', 'ReplayError',
+           'load_trace', 'replay']
+
+log = logging.getLogger(__name__)
+
+TRACE_VERSION = 1
+
+
+def _encode(value):
+    """
+    Encode a cell of a row as JSON. SPASQL tuples, binary values,
+    decimals and dates are tagged so that they decode to the same types.
+    """
+    if isinstance(value, bytearray):
+        return {"ba": b64encode(bytes(value)).decode("ascii")}
+    if isinstance(value, bytes):
+        return {"b": b64encode(value).decode("ascii")}
+    if value is None or isinstance(value, (bool, int, float, basestring)):
+        return value
+    if isinstance(value, tuple):
+        return {"t": [_encode(v) for v in value]}
+    if isinstance(value, Decimal):
+        return {"dec": str(value)}
+    if isinstance(value, datetime.datetime):
+        return {"dt": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"d": value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {"tm": value.isoformat()}
+    return {"s": str(value)}
+
+
+def _decode(value):
+    if not isinstance(value, dict):
+        return value
+    (tag, v), = value.items()
+    if tag == "t":
+        return tuple(_decode(x) for x in v)
+    if tag == "ba":
+        return bytearray(b64decode(v))
+    if tag == "b":
+        return b64decode(v)
+    if tag == "dec":
+        return Decimal(v)
+    if tag == "dt":
+        return datetime.datetime.strptime(
+            v, "%Y-%m-%dT%H:%M:%S.%f" if "." in v else "%Y-%m-%dT%H:%M:%S")
+    if tag == "d":
+        return datetime.datetime.strptime(v, "%Y-%m-%d").date()
+    if tag == "tm":
+        return datetime.datetime.strptime(
+            v, "%H:%M:%S.%f" if "." in v else "%H:%M:%S").time()
+    return v
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, mode + "b"), encoding="utf-8")
+    return io.open(path, mode, encoding="utf-8")
+
+
+class TraceRecorder(object):
+    """
+    Writes executed statements to a trace file, one JSON object per
+    line. ``target`` is a file name or a text file object.
+
+    Each record holds the statement (``sql``), its number (``id``), its
+    ``params``, the start time relative to the recorder creation
+    (``at``), the execution and fetch times (``execute``, ``fetch``),
+    the column names (``columns``), the ``rows`` actually fetched by the
+    client and the ``error`` raised, if any. The result sets after the
+    first one each have a record of their own, with the ``id`` of the
+    statement as ``of`` and their position as ``set``.
+
+    A record is written once the rows of its result set are exhausted,
+    or when its cursor moves on to the next result set or statement, or
+    is closed; :meth:`close` writes those of the cursors still open.
+    """
+
+    def __init__(self, target):
+        if isinstance(target, basestring):
+            self._file = _open(target, "w")
+            self._owns_file = True
+        else:
+            self._file = target
+            self._owns_file = False
+        self._lock = threading.Lock()
+        self._start = clock()
+        self.statements = 0
+        # the cursors that may hold a record not written yet
+        self._cursors = weakref.WeakSet()
+        self._write(dict(trace=TRACE_VERSION))
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def now(self):
+        return clock() - self._start
+
+    def next_id(self):
+        with self._lock:
+            self.statements += 1
+            return self.statements
+
+    def record(self, sql, params, at, execute, fetch, columns, rows, error=None,
+               id=None, of=None, set=None):
+        record = dict(sql=sql, at=round(at, 6), execute=round(execute, 6),
+                      fetch=round(fetch, 6))
+        if id is not None:
+            record["id"] = id
+        if of is not None:
+            record["of"], record["set"] = of, set
+        if params:
+            record["params"] = [_encode(p) for p in params]
+        if columns is not None:
+            record["columns"] = columns
+            record["rows"] = [[_encode(v) for v in row] for row in rows]
+        if error is not None:
+            record["error"] = error
+        self._write(record)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        for cursor in list(self._cursors):
+            cursor._flush()
+        with self._lock:
+            if self._owns_file:
+                self._file.close()
+            else:
+                self._file.flush()
+
+
+class RecordingCursor(object):
+    """
+    Wraps a pyodbc cursor, recording each result set of each statement
+    with the rows fetched from it, once they are exhausted or the cursor
+    moves on.
+    """
+
+    def __init__(self, cursor, recorder):
+        self._cursor = cursor
+        self._recorder = recorder
+        self._pending = None
+        # the statement of the current result set, and its position
+        self._id = self._sql = None
+        self._set = 0
+        recorder._cursors.add(self)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _flush(self):
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            self._recorder.record(**pending)
+
+    def _columns(self):
+        description = self._cursor.description
+        return [col[0] for col in description] if description else None
+
+    def execute(self, sql, *params):
+        self._flush()
+        self._id = self._recorder.next_id()
+        self._sql, self._set = sql, 0
+        at = self._recorder.now()
+        start = clock()
+        try:
+            self._cursor.execute(sql, *params)
+        except Exception as e:
+            self._recorder.record(sql, params, at, clock() - start, 0,
+                                  None, (), error=repr(e), id=self._id)
+            raise
+        execute = clock() - start
+        self._pending = dict(
+            sql=sql, params=params, at=at, execute=execute, fetch=0.0,
+            columns=self._columns(), rows=[], id=self._id)
+        return self
+
+    def nextset(self):
+        self._flush()
+        at = self._recorder.now()
+        start = clock()
+        more = self._cursor.nextset()
+        if more and self._id is not None:
+            self._set += 1
+            self._pending = dict(
+                sql=self._sql, params=(), at=at, execute=clock() - start,
+                fetch=0.0, columns=self._columns(), rows=[],
+                of=self._id, set=self._set)
+        return more
+
+    def _fetched(self, start, rows, exhausted):
+        if self._pending is not None:
+            self._pending["fetch"] += clock() - start
+            self._pending["rows"].extend(tuple(row) for row in rows)
+            if exhausted:
+                self._flush()
+
+    def fetchone(self):
+        start = clock()
+        row = self._cursor.fetchone()
+        self._fetched(start, () if row is None else (row,), row is None)
+        return row
+
+    def fetchmany(self, *args):
+        start = clock()
+        rows = self._cursor.fetchmany(*args)
+        # a short batch ends the result set, the default size may not be known
+        self._fetched(start, rows, not rows or bool(args) and len(rows) < args[0])
+        return rows
+
+    def fetchall(self):
+        start = clock()
+        rows = self._cursor.fetchall()
+        self._fetched(start, rows, True)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        self._flush()
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._flush()
+        return self._cursor.__exit__(*exc)
+
+
+class RecordingConnection(object):
+    """
+    Wraps a pyodbc connection so that its cursors are recorded.
+    """
+
+    def __init__(self, connection, recorder):
+        self._connection = connection
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self):
+        return RecordingCursor(self._connection.cursor(), self.recorder)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+
+def load_trace(trace):
+    """
+    Read the records of a trace, decoding the rows. ``trace`` is a file
+    name or a text file object; an already loaded list of records is
+    returned as is.
+    """
+    if isinstance(trace, basestring):
+        with _open(trace, "r") as f:
+            return load_trace(f)
+    if not hasattr(trace, "readline"):
+        return trace
+    header = json.loads(trace.readline())
+    if header.get("trace") != TRACE_VERSION:
+        raise ValueError("Not a version %d trace" % TRACE_VERSION)
+    records = []
+    for line in trace:
+        record = json.loads(line)
+        if "rows" in record:
+            record["rows"] = [tuple(_decode(v) for v in row)
+                              for row in record["rows"]]
+        if "params" in record:
+            record["params"] = [_decode(p) for p in record["params"]]
+        records.append(record)
+    return records
+
+
+class ReplayError(Exception):
+    """
+    Raised by a strict :class:`ReplayConnection` for a statement that is
+    not in the trace, and for statements that failed when recorded.
+    """
+
+
+class ReplayCursor(object):
+    """
+    A cursor answering statements from the records of a trace.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self._rows = deque()
+        self._sets = deque()
+
+    def _serve(self, record):
+        if self.connection.simulate_latency:
+            self.connection._sleep(record["execute"] + record["fetch"])
+        columns = record.get("columns")
+        self.description = [(c, None, None, None, None, None, True)
+                            for c in columns] if columns is not None else None
+        self._rows = deque(record.get("rows", ()))
+
+    def execute(self, sql, *params):
+        record = self.connection._next_record(sql)
+        if record is None:
+            self.description = None
+            self._rows = deque()
+            self._sets = deque()
+            return self
+        if "error" in record:
+            raise ReplayError(record["error"])
+        self._serve(record)
+        self._sets = deque(self.connection._sets.get(record.get("id"), ()))
+        return self
+
+    def nextset(self):
+        if not self._sets:
+            self.description = None
+            self._rows = deque()
+            return False
+        self._serve(self._sets.popleft())
+        return True
+
+    def fetchone(self):
+        return self._rows.popleft() if self._rows else None
+
+    def fetchmany(self, size=1):
+        return [self._rows.popleft() for i in range(min(size, len(self._rows)))]
+
+    def fetchall(self):
+        rows, self._rows = list(self._rows), deque()
+        return rows
+
+    def __iter__(self):
+        while self._rows:
+            yield self._rows.popleft()
+
+    def close(self):
+        self._rows = deque()
+        self._sets = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReplayConnection(object):
+    """
+    A fake pyodbc connection serving the records of a trace. Each
+    execution of a statement consumes the next record with the same
+    text. Statements that are not (or no longer) in the trace return no
+    rows and are counted in :attr:`missing`, unless ``strict`` is set,
+    in which case they raise :class:`ReplayError`.
+
+    The further result sets of a statement are served by
+    :meth:`ReplayCursor.nextset` in their recorded order.
+
+    With ``simulate_latency``, each statement sleeps for the execution
+    and fetch time that was recorded for it.
+    """
+
+    def __init__(self, trace, strict=False, simulate_latency=False):
+        self.records = load_trace(trace)
+        self.strict = strict
+        self.simulate_latency = simulate_latency
+        self.missing = 0
+        self._by_sql = defaultdict(deque)
+        # the further result sets, by statement
+        self._sets = defaultdict(list)
+        for record in self.records:
+            if "of" in record:
+                self._sets[record["of"]].append(record)
+            else:
+                self._by_sql[record["sql"]].append(record)
+        for sets in self._sets.values():
+            sets.sort(key=lambda r: r["set"])
+        self._lock = threading.Lock()
+
+    def _next_record(self, sql):
+        with self._lock:
+            queue = self._by_sql.get(sql)
+            if queue:
+                return queue.popleft()
+            self.missing += 1
+        if self.strict:
+            raise ReplayError("Statement not in trace: %s" % sql)
+        log.debug("statement not in trace: %s", sql)
+        return None
+
+    def _sleep(self, seconds):
+        from time import sleep
+        sleep(seconds)
+
+    def cursor(self):
+        return ReplayCursor(self)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+    def setdecoding(self, *args, **kwargs):
+        pass
+
+    def setencoding(self, *args, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay(trace, repeat=1, **store_kwargs):
+    """
+    Run the SPARQL statements of a trace through the decoding code of a
+    :class:`~virtuoso.vstore.Virtuoso` store on a
+    :class:`ReplayConnection`, consuming every result, ``repeat`` times.
+
+    Returns a dict with the number of ``statements`` and ``rows``
+    replayed, the best client-side ``elapsed`` time over the runs, the
+    ``recorded`` server time (execute and fetch) of the trace and the
+    number of ``missing`` statements of the last run.
+    """
+    from virtuoso.vstore import Virtuoso
+    records = load_trace(trace)
+    statements = [r["sql"] for r in records
+                  if r["sql"].startswith(u"SPARQL")
+                  and "error" not in r and "of" not in r]
+    best, rows = None, 0
+    for i in range(repeat):
+        connection = ReplayConnection(records)
+        store = Virtuoso(connection=connection, **store_kwargs)
+        rows = 0
+        start = clock()
+        for q in statements:
+            result = store._execute_sparql(q)
+            if result is not None and not isinstance(result, bool):
+                for row in result:
+                    rows += 1
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return dict(statements=len(statements), rows=rows, elapsed=best,
+                recorded=sum(r["execute"] + r["fetch"] for r in records),
+                missing=connection.missing)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Replay a trace recorded by virtuoso.trace.TraceRecorder")
+    parser.add_argument("trace")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    report = replay(args.trace, repeat=args.repeat)
+    for key in ("statements", "rows", "elapsed", "recorded", "missing"):
+        print("%-10s %s" % (key, report[key]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,12 +10,20 @@ import threading
 from io import StringIO
 import os
 import sys
+import weakref
 from struct import unpack
+from decimal import Decimal
+import datetime
+import multiprocessing
 from itertools import islice
+from collections import deque
+from queue import Queue, Full
 
-from rdflib.graph import Graph
+from rdflib.graph import Graph, ConjunctiveGraph
 from rdflib.term import URIRef, BNode, Literal, Variable
 from rdflib.namespace import XSD, Namespace, NamespaceManager
+from rdflib.paths import (Path, AlternativePath, InvPath, MulPath,
+                          NegatedPath, SequencePath, ZeroOrOne)
 from rdflib.plugins.sparql.sparql import FrozenBindings
 from rdflib.query import Result, ResultRow
 from rdflib.store import Store, VALID_STORE
@@ -26,7 +34,13 @@ __all__ = ['Virtuoso', 'OperationalError', 'resolve', 'VirtRDF']
 
 VirtRDF = Namespace('http://www.openlinksw.com/schemas/virtrdf#')
 
+from virtuoso.admission import INTERACTIVE, WRITE
+from virtuoso.bloom import triple_key
 from virtuoso.common import READ_COMMITTED
+from virtuoso.explain import QueryPlan
+from virtuoso.metrics import Instrumentation, QueryStats, clock
+from virtuoso.pool import StorePool, PoolTimeout
+from virtuoso.trace import RecordingConnection
 import logging
 log = logging.getLogger(__name__)
 
@@ -62,12 +76,270 @@ _select_re = re.compile(_start_re + r'SELECT\b', re.IGNORECASE + re.MULTILINE)
 
 _base_re = re.compile(r'(BASE[ \t]+<[^>]*>\s+)?', re.IGNORECASE + re.MULTILINE)
 
+# the tokens of a SPARQL Update request that tell the graphs it writes:
+# strings, IRIs and comments, which may hold braces, are whole tokens
+_update_token_re = re.compile(
+    r'"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^\'\\]|\\.|\'(?!\'\'))*\'\'\''
+    r'|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\''
+    r'|<[^<>"{}|^`\\\s]*>|#[^\n]*|[{};]|[^\s{};<"\'#]+|\S')
+_graph_operations = ('LOAD', 'CLEAR', 'DROP', 'CREATE', 'COPY', 'MOVE', 'ADD')
+
+#: The procedure used by :meth:`Virtuoso.query_batch`: it runs each
+#: statement of a vector and returns one result set per statement, or a
+#: result set describing the error the statement raised.
+BATCH_PROCEDURE = u'DB.DBA.VIRTUOSO_PYTHON_BATCH'
+_batch_procedure = u"""CREATE PROCEDURE %s (IN statements ANY)
+{
+  DECLARE i, j INTEGER;
+  DECLARE state, message, meta, rows ANY;
+  FOR (i := 0; i < length (statements); i := i + 1)
+    {
+      state := '00000';
+      message := '';
+      exec (statements[i], state, message, vector (), 0, meta, rows);
+      IF (state <> '00000')
+        {
+          exec_result_names (vector (vector ('__error_state', 182, 0, 5, 1),
+                                     vector ('__error_message', 182, 0, 1000, 1)));
+          exec_result (vector (state, message));
+        }
+      ELSE
+        {
+          exec_result_names (meta[0]);
+          FOR (j := 0; j < length (rows); j := j + 1)
+            exec_result (rows[j]);
+        }
+      end_result ();
+    }
+}""" % BATCH_PROCEDURE
+_batch_error_columns = ['__error_state', '__error_message']
+_batch_procedure_exists = (u"SELECT COUNT(*) FROM DB.DBA.SYS_PROCEDURES "
+                           u"WHERE P_NAME = ?")
+# the DSNs on which the batch procedure is known to exist
+_batch_procedure_dsns = set()
+
+# the connections, cursors and pools a forked process inherited from its
+# parent: they are kept alive and never closed, as releasing them would
+# roll back and disconnect the session of the parent
+_inherited = []
+# the daemon thread also holding them
+_keeper = None
+
+# the stores of this process, detached from their connections in a child
+# as soon as it is forked
+_live_stores = weakref.WeakSet()
+
+
+def _keep_alive(obj):
+    """
+    Keep ``obj`` alive until the process exits, interpreter shutdown
+    included: the module globals are cleared then, but not what a daemon
+    thread still references.
+    """
+    global _keeper
+    _inherited.append(obj)
+    if _keeper is None or not _keeper.is_alive():
+        # none yet, or that of the parent, which was not forked
+        _keeper = threading.Thread(target=_hold, name="virtuoso-inherited",
+                                   args=(_inherited, threading.Event()))
+        _keeper.daemon = True
+        _keeper.start()
+
+
+def _hold(objects, forever):
+    forever.wait()
+
+
+def _detach_all():
+    for store in list(_live_stores):
+        try:
+            store._detach()
+        except Exception:
+            log.exception("detaching a store after a fork failed")
+
+
+if hasattr(os, "register_at_fork"):
+    # python >= 3.7; before, stores detach on their next use
+    os.register_at_fork(after_in_child=_detach_all)
+
 
 class OperationalError(Exception):
     """
     Raised when transactions are mis-managed
     """
 
+def _once(*functions):
+    """
+    Return a function calling each of ``functions`` that is not None,
+    on its first call only.
+    """
+    called = []
+
+    def call():
+        if not called:
+            called.append(True)
+            for function in functions:
+                if function is not None:
+                    function()
+    return call
+
+
+def _is_read(q):
+    """
+    Whether a SPASQL statement is a query rather than an update.
+    """
+    return bool(_construct_re.match(q) or _ask_re.match(q)
+                or _select_re.match(q))
+
+
+def _update_tokens(q):
+    return [t for t in _update_token_re.findall(q) if not t.startswith('#')]
+
+
+def _default_graph(queryGraph):
+    """
+    The graph an update run on ``queryGraph`` writes by default, or
+    None if unknown.
+    """
+    if queryGraph == '__UNION__':
+        return None
+    return getattr(queryGraph, "identifier", queryGraph)
+
+
+def _graph_iri(token):
+    """
+    The graph named by ``token``, if an absolute IRI, or None.
+    """
+    if token.startswith('<') and ':' in token:
+        return URIRef(token[1:-1])
+    return None
+
+
+def _written_graphs(q, default=None):
+    """
+    Return the set of the graphs the SPARQL Update request ``q`` may
+    write, or None if some are not named by an absolute IRI: graphs
+    given by a variable or a prefixed name, all or the named graphs,
+    the default graph when ``default``, the graph the request runs on,
+    is None, or any graph of a form not recognized.
+
+    Besides SPARQL 1.1, Virtuoso's ``INSERT INTO <g> {...}`` and
+    ``DELETE FROM <g> {...}``, with an optional GRAPH keyword, name
+    the graph of their template.
+    """
+    graphs = set()
+    tokens = _update_tokens(q)
+    depth = 0
+    # the first keyword and WITH graph of the current operation, the
+    # depth of the template being read, if any, its INTO or FROM graph,
+    # and whether the next group is a template
+    operation = with_graph = template = target = None
+    pending = into = False
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        word = token.upper()
+        if token == '{':
+            depth += 1
+            if pending:
+                template, pending = depth, False
+        elif token == '}':
+            depth -= 1
+            if template is not None and depth < template:
+                template = target = None
+        elif template is not None and depth == template:
+            if word == 'GRAPH':
+                i += 1
+                graph = _graph_iri(tokens[i]) if i < len(tokens) else None
+                if graph is None:
+                    return None
+                graphs.add(graph)
+            elif token != '.':
+                # a triple of the default graph of the operation
+                graph = target or with_graph or default
+                if graph is None:
+                    return None
+                graphs.add(graph)
+        elif depth == 0:
+            if token == ';':
+                if operation == 'LOAD' and not into:
+                    if default is None:
+                        return None
+                    graphs.add(default)
+                operation = with_graph = target = None
+                pending = into = False
+            elif operation in _graph_operations:
+                graph = _graph_iri(token)
+                if graph is not None:
+                    graphs.add(graph)
+                elif word == 'DEFAULT' and default is not None:
+                    graphs.add(default)
+                elif word == 'INTO':
+                    into = True
+                elif word not in ('SILENT', 'GRAPH', 'TO'):
+                    return None
+            elif operation is None and word in _graph_operations:
+                operation = word
+            elif word == 'WITH' and operation is None:
+                operation = 'MODIFY'
+                i += 1
+                with_graph = _graph_iri(tokens[i]) if i < len(tokens) else None
+                if with_graph is None:
+                    return None
+            elif word in ('INSERT', 'DELETE'):
+                operation = 'MODIFY'
+                pending = True
+            elif operation is None:
+                # the prologue, and the DEFINEs of a prepared statement
+                if token.isalpha() and word not in ('PREFIX', 'BASE', 'DEFINE'):
+                    return None
+            elif word in ('INTO', 'FROM'):
+                i += 1
+                if i < len(tokens) and tokens[i].upper() == 'GRAPH':
+                    i += 1
+                graph = _graph_iri(tokens[i]) if i < len(tokens) else None
+                if graph is None:
+                    return None
+                if pending:
+                    # rather than a FROM of the WHERE clause
+                    target = graph
+                    graphs.add(graph)
+            elif word == 'WHERE':
+                if tokens[i - 1].upper() != 'DELETE':
+                    pending = False
+            elif not (word in ('DATA', 'USING', 'NAMED')
+                      or _graph_iri(token) is not None):
+                return None
+        i += 1
+    if operation == 'LOAD' and not into:
+        if default is None:
+            return None
+        graphs.add(default)
+    return graphs
+
+
+def _binds_where(q):
+    """
+    Whether the last operation of the SPARQL Update request ``q`` ends
+    with a WHERE clause, the group ``initBindings`` are appended to.
+    """
+    tokens = _update_tokens(q)
+    depth = 0
+    where = False
+    for i, token in enumerate(tokens):
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        elif depth == 0:
+            if token == ';':
+                where = False
+            elif token.upper() == 'WHERE':
+                # the pattern of DELETE WHERE does not take VALUES
+                where = i == 0 or tokens[i - 1].upper() != 'DELETE'
+    return where and tokens[-1] == '}'
+
+
 def _all_none(binding):
     """
     Return True if binding contains only None values.
@@ -115,6 +387,101 @@ class EagerIterator(object):
 EagerIterator.__next__ = EagerIterator.next
 
 
+class PrefetchIterator(object):
+    """An iterator consuming another one by blocks of ``block_size`` items
+    in a background thread, at most ``depth`` blocks ahead, so that
+    fetching and decoding rows overlap with the work of the consumer.
+    Closing it, or dropping it, stops the thread and closes the inner
+    iterator."""
+    def __init__(self, iterable, depth=2, block_size=1000):
+        self._queue = Queue(depth)
+        self._stop = threading.Event()
+        self._block = deque()
+        self._finished = False
+        # the thread must not refer to self, so that dropping the
+        # iterator stops it
+        thread = threading.Thread(target=_prefetch, args=(
+            iter(iterable), self._queue, self._stop, block_size))
+        thread.daemon = True
+        thread.start()
+        self._thread = thread
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self._block:
+            if self._finished:
+                raise StopIteration()
+            block, error = self._queue.get()
+            if block is None:
+                self._finished = True
+                if error is not None:
+                    raise error
+            else:
+                self._block.extend(block)
+        return self._block.popleft()
+
+    def close(self):
+        self._stop.set()
+
+    __del__ = close
+
+
+PrefetchIterator.__next__ = PrefetchIterator.next
+
+
+def _prefetch(iterator, queue, stop, block_size):
+    """
+    The thread of a :class:`PrefetchIterator`: queues ``(block, None)``
+    items, then ``(None, None)`` at the end or ``(None, error)``.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+    try:
+        while not stop.is_set():
+            block = list(islice(iterator, block_size))
+            if not block:
+                put((None, None))
+                return
+            if not put((block, None)):
+                return
+    except Exception as e:
+        put((None, e))
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+class LazyResolver(object):
+    """A cursor for the IRI lookups of :func:`resolve`, opened on first
+    use. Executing them on the cursor of a result being iterated would
+    discard the rest of that result."""
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursor = None
+
+    def execute(self, q, *params):
+        if self._cursor is None:
+            self._cursor = self._connection.cursor()
+        return self._cursor.execute(q, *params)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+
 class VirtuosoResultRow(ResultRow):
     """
     Subclass of ResultRow which is more efficiently created
@@ -198,7 +565,14 @@ class Virtuoso(Store):
 
     .. automethod:: virtuoso.vstore.Virtuoso.cursor
     .. automethod:: virtuoso.vstore.Virtuoso.query
+    .. automethod:: virtuoso.vstore.Virtuoso.query_many
+    .. automethod:: virtuoso.vstore.Virtuoso.query_batch
     .. automethod:: virtuoso.vstore.Virtuoso.sparql_query
+    .. automethod:: virtuoso.vstore.Virtuoso.update
+    .. automethod:: virtuoso.vstore.Virtuoso.scan
+    .. automethod:: virtuoso.vstore.Virtuoso.describe_many
+    .. automethod:: virtuoso.vstore.Virtuoso.explain
+    .. automethod:: virtuoso.vstore.Virtuoso.profile
     .. automethod:: virtuoso.vstore.Virtuoso.transaction
     .. automethod:: virtuoso.vstore.Virtuoso.commit
     .. automethod:: virtuoso.vstore.Virtuoso.rollback
@@ -208,10 +582,53 @@ class Virtuoso(Store):
     formula_aware = True   # Not sure whether this is true; needed to read N3.
 
     def __init__(self, *av, **kw):
+        self.__dsn = None
+        # the process that established the connection
+        self._pid = None
         self.long_iri = kw.pop('long_iri', False)
         self.inference = kw.pop('inference', None)
         self.quad_storage = kw.pop('quad_storage', None)
         self.signal_void = kw.pop('signal_void', None)
+        self.instrumentation = kw.pop('instrumentation', None)
+        self.slow_query_log = kw.pop('slow_query_log', None)
+        if self.slow_query_log is not None:
+            if self.instrumentation is None:
+                self.instrumentation = Instrumentation()
+            self.instrumentation.add_hook(self.slow_query_log)
+        self.recorder = kw.pop('recorder', None)
+        # a virtuoso.retry.RetryPolicy for self-committed updates
+        self.retry = kw.pop('retry', None)
+        # a virtuoso.admission.AdmissionController limiting the statements
+        # in flight by priority class
+        self.admission = kw.pop('admission', None)
+        # a virtuoso.replica.ReplicaSet receiving the reads, with the
+        # stores on its replicas and the time of the last write
+        self.replicas = kw.pop('replicas', None)
+        self._replica_stores = {}
+        self._last_write = None
+        # a virtuoso.cache.EntityCache, and the (subject, context) pairs
+        # written by the pending transaction
+        self.entity_cache = kw.pop('entity_cache', None)
+        self._touched = set()
+        # a virtuoso.bloom.GraphFilters of the graphs written through
+        # this store
+        self.bloom_filters = kw.pop('bloom_filters', None)
+        # a virtuoso.local.LocalGraphs serving the reads of hot graphs
+        self.local_graphs = kw.pop('local_graphs', None)
+        # decode the rows of SELECTs in a pool of processes, and/or fetch
+        # them in a background thread, by blocks
+        self.decode_workers = kw.pop('decode_workers', None)
+        self.prefetch_depth = kw.pop('prefetch_depth', None)
+        self.prefetch_connections = kw.pop('prefetch_connections', 4)
+        self.fetch_block_size = kw.pop('fetch_block_size', 1000)
+        self._decode_pool = None
+        # the prefetching threads may start the decoding processes
+        self._decode_lock = threading.Lock()
+        # clones whose connections prefetched queries run on
+        self._prefetch_pool = None
+        # called with the DSN to establish the connection, e.g.
+        # virtuoso.offline.OfflineServer().connect
+        self._connect = kw.pop('connect', None) or pyodbc.connect
         connection = kw.pop('connection', None)
         if connection is not None:
             if not isinstance(connection, pyodbc.Connection):
@@ -219,11 +636,19 @@ class Virtuoso(Store):
                 if isinstance(connection, Connection):
                     # extract the pyodbc connection
                     connection = connection._Connection__connection.connection
-            assert isinstance(connection, pyodbc.Connection)
+            # any DB-API connection returning SPASQL tuples will do,
+            # e.g. the stand-ins used by the benchmarks
+            assert hasattr(connection, "cursor"), connection
+            if self.recorder is not None:
+                connection = RecordingConnection(connection, self.recorder)
             self._connection = connection
+            self._pid = os.getpid()
             self.initialize_connection()
         super(Virtuoso, self).__init__(*av, **kw)
         self._transaction = None
+        self._query_pool = None
+        self._batch_procedure_created = False
+        _live_stores.add(self)
 
     def initialize_connection(self):
         connection = self._connection
@@ -258,9 +683,14 @@ class Virtuoso(Store):
 
     @property
     def connection(self):
+        self._check_fork()
         if not hasattr(self, "_connection"):
             try:
-                self._connection = pyodbc.connect(self.__dsn)
+                self._pid = os.getpid()
+                self._connection = self._connect(self.__dsn)
+                if self.recorder is not None:
+                    self._connection = RecordingConnection(
+                        self._connection, self.recorder)
                 log.info("Virtuoso Store Connected: %s" % self.__dsn)
                 self.initialize_connection()
             except:
@@ -268,6 +698,44 @@ class Virtuoso(Store):
                 raise
         return self._connection
 
+    def _check_fork(self):
+        """
+        Detach the store from what it inherited from the parent process
+        after a fork, unless that was done when the process was forked;
+        the connection is then established again by this process.
+        """
+        if self._pid is None or self._pid == os.getpid():
+            return
+        self._detach()
+        if self.__dsn is None:
+            raise OperationalError(
+                "A store given a connection can not reconnect after a fork")
+
+    def _detach(self):
+        """
+        Set aside the connection, transaction and pools inherited from
+        the parent process after a fork, without closing or even
+        releasing them, which would end the session of the parent.
+        """
+        if self._pid is None or self._pid == os.getpid():
+            return
+        if hasattr(self, "_connection"):
+            log.info("Virtuoso store used in a forked process, reconnecting")
+            _keep_alive((self._connection, self._transaction,
+                         self._query_pool, self._prefetch_pool,
+                         self._decode_pool, self._replica_stores))
+            del self._connection
+        self._transaction = None
+        self._query_pool = None
+        self._prefetch_pool = None
+        self._decode_pool = None
+        # possibly held by a thread of the parent when it forked
+        self._decode_lock = threading.Lock()
+        self._replica_stores = {}
+        if self.__dsn is not None:
+            # a store given a connection keeps failing
+            self._pid = None
+
     def cursor(self, isolation=READ_COMMITTED):
         """
         Acquire a cursor, setting the isolation level.
@@ -277,21 +745,189 @@ class Virtuoso(Store):
         return cursor
 
     def close(self, commit_pending_transaction=False):
+        self._check_fork()
+        if self._query_pool is not None:
+            self._query_pool.close()
+            self._query_pool = None
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.close()
+            self._prefetch_pool = None
+        if self._decode_pool is not None:
+            self._decode_pool.shutdown()
+            self._decode_pool = None
+        replica_stores, self._replica_stores = self._replica_stores, {}
+        for store in replica_stores.values():
+            store.close()
         if commit_pending_transaction:
             self.commit()
         else:
             self.rollback()
-        self._connection.close()
-        del self._connection
+        if hasattr(self, "_connection"):
+            self._connection.close()
+            del self._connection
+
+    def _decode_executor(self):
+        with self._decode_lock:
+            if self._decode_pool is None:
+                self._decode_pool = self._new_decode_executor()
+            return self._decode_pool
+
+    def _new_decode_executor(self):
+        from concurrent.futures import ProcessPoolExecutor
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            # workers forked from this process would inherit its
+            # ODBC handles; a fork server has none
+            methods = multiprocessing.get_all_start_methods()
+            kwargs["mp_context"] = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(self.decode_workers, **kwargs)
+
+    @property
+    def dsn(self):
+        """
+        The DSN of the store, None for a store given a connection.
+        """
+        return self.__dsn
 
-    def clone(self):
-        return Virtuoso(self.__dsn)
+    def clone(self, dsn=None):
+        """
+        Return a new store with the same options, on its own connection
+        to the same DSN, or to ``dsn``.
+        """
+        store = Virtuoso(dsn or self.__dsn, long_iri=self.long_iri,
+                         inference=self.inference,
+                         quad_storage=self.quad_storage,
+                         signal_void=self.signal_void,
+                         instrumentation=self.instrumentation,
+                         recorder=self.recorder, retry=self.retry,
+                         admission=self.admission, replicas=self.replicas,
+                         entity_cache=self.entity_cache,
+                         bloom_filters=self.bloom_filters,
+                         local_graphs=self.local_graphs,
+                         connect=self._connect,
+                         decode_workers=self.decode_workers,
+                         prefetch_depth=self.prefetch_depth,
+                         prefetch_connections=self.prefetch_connections,
+                         fetch_block_size=self.fetch_block_size)
+        # the hook is already on the shared instrumentation
+        store.slow_query_log = self.slow_query_log
+        return store
+
+    def query_many(self, queries, max_workers=4, as_completed=False):
+        """
+        Run independent queries concurrently, each on a store of a pool
+        of clones of this store, kept for later calls until
+        :meth:`close`. The queries do not see the pending work of a
+        transaction of this store.
+
+        ``queries`` holds query strings or ``(query, kwargs)`` pairs,
+        where ``kwargs`` are keyword arguments of :meth:`query`. The
+        rows of SELECT results are all fetched. A query that fails
+        gives its exception in place of its result.
+
+        Returns the list of results in the order of ``queries``, or,
+        with ``as_completed``, an iterator of ``(index, result)`` pairs
+        in the order the queries finish.
+        """
+        self._check_fork()
+        from concurrent import futures
+        if self._query_pool is None:
+            self._query_pool = StorePool(self.clone, max_workers)
+        pool = self._query_pool
+        pool.size = max(pool.size, max_workers)
+        queries = list(queries)
+        executor = futures.ThreadPoolExecutor(max_workers)
+        submitted = [executor.submit(self._query_one, pool, query)
+                     for query in queries]
+        executor.shutdown(wait=False)
+        if not as_completed:
+            return [f.result() for f in submitted]
+        index = dict((f, i) for (i, f) in enumerate(submitted))
+        return ((index[f], f.result()) for f in futures.as_completed(submitted))
+
+    @staticmethod
+    def _query_one(pool, query):
+        q, kwargs = query if isinstance(query, tuple) else (query, {})
+        try:
+            with pool.store() as store:
+                result = store.query(q, **kwargs)
+                if result.type == "SELECT":
+                    list(result)
+                return result
+        except Exception as e:
+            log.debug("query_many: %s failed: %r", q, e)
+            return e
 
     def query(self, q, initNs={}, initBindings={}, queryGraph=None, **kwargs):
         """
         Run a SPARQL query on the connection. Returns a Graph in case of
         DESCRIBE or CONSTRUCT, a bool in case of Ask and a generator over
         the results otherwise.
+
+        ``priority`` (``"interactive"`` by default, ``"batch"`` or
+        ``"write"``) is the class of the query for the admission
+        controller of the store, if any.
+        """
+        self._check_fork()
+        base = kwargs.pop("base", None)
+        if self.instrumentation is None:
+            q = self._prepare_query(q, initNs, initBindings, queryGraph, base)
+            result = self._query(q, **kwargs)
+        else:
+            start = clock()
+            q = self._prepare_query(q, initNs, initBindings, queryGraph, base)
+            stats = kwargs['stats'] = QueryStats()
+            stats.rewrite_time = clock() - start
+            result = self._query(q, **kwargs)
+        if not _is_read(u'SPARQL ' + q):
+            self._updated(_written_graphs(q, _default_graph(queryGraph)))
+        return VirtuosoResult(result)
+
+    def update(self, update, initNs={}, initBindings={}, queryGraph=None,
+               **kwargs):
+        """
+        Run a SPARQL Update request on the server, in a single statement
+        rewritten as by :meth:`query` and committed unless a transaction
+        is pending, rather than having ``Graph.update`` evaluate it with
+        rdflib, triple by triple. Requests already parsed by rdflib are
+        left to it.
+
+        ``initBindings`` are given as a VALUES block at the end of the
+        WHERE clause of the last operation; a request whose last
+        operation has none, such as INSERT DATA, raises ValueError.
+        """
+        self._check_fork()
+        if hasattr(update, "algebra"):
+            # Graph.update catches it and evaluates the request itself
+            raise NotImplementedError
+        base = kwargs.pop("base", None)
+        start = clock()
+        q = self._prepare_query(update, initNs, initBindings, queryGraph, base)
+        if self.instrumentation is not None:
+            stats = kwargs['stats'] = QueryStats()
+            stats.rewrite_time = clock() - start
+        self._query(q, commit=self._transaction is None, **kwargs)
+        self._updated(_written_graphs(q, _default_graph(queryGraph)))
+
+    def _updated(self, graphs=None):
+        """
+        Forget what an update writing ``graphs`` may have made stale:
+        their cached entities, Bloom filters and local copies, or those
+        of all the graphs if ``graphs`` is None.
+        """
+        for graph in [None] if graphs is None else graphs:
+            self._invalidate(None, graph)
+            if self.bloom_filters is not None:
+                self.bloom_filters.discard(graph)
+            if self.local_graphs is not None:
+                self.local_graphs.expire(graph)
+
+    def _prepare_query(self, q, initNs={}, initBindings={}, queryGraph=None,
+                       base=None):
+        """
+        Apply the prefixes, bindings, base and graph of a :meth:`query`
+        call to the query text.
         """
         prepared_base = None
         if hasattr(q, "_original_args"):
@@ -303,7 +939,7 @@ class Virtuoso(Store):
                 prepared_ns.update(initNs)
                 initNs = prepared_ns
 
-        base = kwargs.pop("base", None) or prepared_base
+        base = base or prepared_base
 
         if initNs:
             splitpoint = _base_re.match(q).end()
@@ -313,6 +949,9 @@ class Virtuoso(Store):
                           + [ qright ])
 
         if initBindings:
+            if not _is_read(u'SPARQL ' + q) and not _binds_where(q):
+                raise ValueError("initBindings need the last operation of an "
+                                 "update to end with a WHERE clause")
             qleft, qright = q.rsplit("}", 1)
             q = "\n".join([ qleft, "#BEGIN of VALUES inserted by initBindings" ]
                           + [ "VALUES ?%s { %s }" % (var, val.n3())
@@ -325,16 +964,20 @@ class Virtuoso(Store):
             if splitpoint == 0:
                 q = u'BASE <%s>\n%s' % (base, q)
 
-        if queryGraph is not None and queryGraph is not '__UNION__':
+        if queryGraph is not None and queryGraph != '__UNION__':
             if isinstance(queryGraph, BNode):
                 queryGraph = _bnode_to_nodeid(queryGraph)
             qgn3 = queryGraph.n3()
             q = (u'DEFINE input:default-graph-uri %s '
                  u'DEFINE input:named-graph-uri %s '
                  u'%s') % (qgn3, qgn3, q)
-        return VirtuosoResult(self._query(q, **kwargs))
+        return q
 
-    def _query(self, q, cursor=None, commit=False):
+    def _add_defines(self, q):
+        """
+        Prefix a SPARQL query with the store-wide DEFINEs and the
+        ``SPARQL`` keyword, giving the statement sent to Virtuoso.
+        """
         if self.quad_storage:
             q = u'DEFINE input:storage %s %s' % (self.quad_storage.n3(), q)
         if self.long_iri:
@@ -343,79 +986,488 @@ class Virtuoso(Store):
             q = u'DEFINE input:inference %s %s' % (self.inference.n3(), q)
         if self.signal_void:
             q = u'define sql:signal-void-variables 1 ' + q
-        q = u'SPARQL ' + q
+        return u'SPARQL ' + q
+
+    def explain(self, q, initNs={}, initBindings={}, queryGraph=None, **kwargs):
+        """
+        Compile a SPARQL query without running it, and return the
+        :class:`~virtuoso.explain.QueryPlan` chosen by Virtuoso along
+        with the generated SQL. The query is rewritten as by :meth:`query`,
+        and takes a ``priority`` slot of the admission controller.
+        """
+        self._check_fork()
+        q = self._prepare_query(q, initNs, initBindings, queryGraph,
+                                kwargs.pop("base", None))
+        return self._plan(u"explain", q, **kwargs)
+
+    def profile(self, q, initNs={}, initBindings={}, queryGraph=None, **kwargs):
+        """
+        Run a SPARQL query under Virtuoso's profiler, and return the
+        :class:`~virtuoso.explain.QueryPlan` annotated with the time and
+        fanout of each operator. The results of the query are discarded.
+        The query takes a ``priority`` slot of the admission controller.
+        """
+        self._check_fork()
+        q = self._prepare_query(q, initNs, initBindings, queryGraph,
+                                kwargs.pop("base", None))
+        return self._plan(u"profile", q, **kwargs)
+
+    def _plan(self, procedure, q, cursor=None, priority=INTERACTIVE):
+        """
+        Run ``q`` through the ``explain`` or ``profile`` procedure, in a
+        ``priority`` slot of the admission controller.
+        """
+        stats = None
+        if self.instrumentation is not None:
+            stats = QueryStats(kind=procedure)
+            start = clock()
+        q = self._add_defines(q)
+        if stats is not None:
+            stats.rewrite_time = clock() - start
+            stats.query = q
+        if self.admission is not None:
+            with self.admission.admit(priority):
+                return self._run_plan(procedure, q, cursor, stats)
+        return self._run_plan(procedure, q, cursor, stats)
+
+    def _run_plan(self, procedure, q, cursor, stats):
         must_close = False
         if cursor is None:
             cursor = self.cursor()
             must_close = True
+        try:
+            log.log(9, "%s: \n%s" % (procedure, q))
+            if stats is not None:
+                start = clock()
+            # the SQL translation is given the query without the SPARQL keyword
+            cursor.execute(u"SELECT sparql_to_sql_text(?)", q[len(u'SPARQL '):])
+            sql, = cursor.fetchone()
+            report = [row[0] for row in cursor.execute(
+                u"%s(?)" % procedure, q).fetchall()]
+            if stats is not None:
+                stats.execute_time = clock() - start
+                stats.rows = len(report)
+            return QueryPlan(q, sql, report, procedure == u"profile")
+        except Exception as e:
+            if stats is not None:
+                stats.error = e
+            raise
+        finally:
+            if must_close:
+                cursor.close()
+            if stats is not None:
+                self.instrumentation.query_done(stats)
+
+    def query_batch(self, queries, cursor=None, priority=INTERACTIVE):
+        """
+        Run several SELECT and ASK queries in a single round trip, and
+        return their results in order. The queries go through the
+        procedure :data:`BATCH_PROCEDURE`, which returns a result set per
+        query. Its existence is checked once per DSN; if it is missing,
+        it is created, which requires DBA rights and, being DDL, commits
+        the pending transaction of the store.
+
+        ``queries`` holds query strings or ``(query, kwargs)`` pairs, as
+        for :meth:`query_many`. A query that fails on the server gives a
+        :class:`pyodbc.Error` in place of its result. The batch takes a
+        single ``priority`` slot of the admission controller.
+        """
+        self._check_fork()
+        statements = []
+        for query in queries:
+            q, kwargs = query if isinstance(query, tuple) else (query, {})
+            kwargs = dict(kwargs)
+            base = kwargs.pop("base", None)
+            q = self._add_defines(self._prepare_query(q, base=base, **kwargs))
+            if not (_select_re.match(q) or _ask_re.match(q)):
+                raise ValueError("Only SELECT and ASK queries can be batched: %s" % q)
+            statements.append(q)
+        if not statements:
+            return []
+        if self.admission is not None:
+            with self.admission.admit(priority):
+                return self._run_batch(statements, cursor)
+        return self._run_batch(statements, cursor)
+
+    def _run_batch(self, statements, cursor=None):
+        must_close = False
+        if cursor is None:
+            cursor = self.cursor()
+            must_close = True
+        stats = None
+        if self.instrumentation is not None:
+            stats = QueryStats(kind="batch", batch_size=len(statements))
+        resolver = LazyResolver(self.connection)
+        try:
+            if not self._batch_procedure_created:
+                self._create_batch_procedure(cursor)
+            batch = u"%s(vector(%s))" % (
+                BATCH_PROCEDURE, u", ".join(u"?" * len(statements)))
+            log.log(9, "batch: \n" + u"\n".join(statements))
+            if stats is not None:
+                stats.query = batch
+                start = clock()
+            cursor.execute(batch, *statements)
+            if stats is not None:
+                stats.execute_time = clock() - start
+            results = []
+            for q in statements:
+                results.append(self._batch_result(q, cursor, resolver, stats))
+                if len(results) < len(statements) and not cursor.nextset():
+                    raise OperationalError(
+                        "The batch returned %d result sets for %d statements"
+                        % (len(results), len(statements)))
+            return results
+        except Exception as e:
+            if stats is not None:
+                stats.error = e
+            raise
+        finally:
+            resolver.close()
+            if must_close:
+                cursor.close()
+            if stats is not None:
+                self.instrumentation.query_done(stats)
+
+    def _create_batch_procedure(self, cursor):
+        """
+        Create the procedure of :meth:`query_batch` unless the server
+        already has it, which is only checked once per DSN.
+        """
+        dsn = self.__dsn
+        if dsn is None or dsn not in _batch_procedure_dsns:
+            cursor.execute(_batch_procedure_exists, BATCH_PROCEDURE)
+            if not cursor.fetchone()[0]:
+                log.info("Creating the procedure %s", BATCH_PROCEDURE)
+                cursor.execute(_batch_procedure)
+            if dsn is not None:
+                _batch_procedure_dsns.add(dsn)
+        self._batch_procedure_created = True
+
+    @staticmethod
+    def _batch_result(q, cursor, resolver, stats):
+        """
+        Decode the current result set of a batch as the result of ``q``.
+        """
+        columns = [col[0] for col in cursor.description]
+        if columns == _batch_error_columns:
+            state, message = [x[0] if isinstance(x, tuple) else x
+                              for x in cursor.fetchone()]
+            return pyodbc.Error(state, message)
+        if stats is not None:
+            rows = list(_measured_rows(cursor, resolver, stats, True))
+        else:
+            rows = []
+            for r in cursor.fetchall():
+                try:
+                    rows.append([resolve(resolver, x) for x in r])
+                except Exception as e:
+                    log.debug("skip row, because of %s", e)
+        if _ask_re.match(q):
+            # a false ASK gives no row
+            return VirtuosoResult(bool(rows) and bool(rows[0][0]))
+        vars = [Variable(c) for c in columns]
+        var_dict = VirtuosoResultRow.prepare_var_dict(vars)
+        e = EagerIterator(iter([VirtuosoResultRow(row, var_dict) for row in rows]))
+        e.vars = vars
+        e.selectionF = e.vars
+        return VirtuosoResult(e)
+
+    def _query(self, q, cursor=None, commit=False, stats=None, priority=None):
+        if stats is None and self.instrumentation is not None:
+            stats = QueryStats()
+        if stats is not None:
+            start = clock()
+            q = self._add_defines(q)
+            stats.rewrite_time += clock() - start
+            stats.query = q
+        else:
+            q = self._add_defines(q)
+        return self._execute_sparql(q, cursor, commit, stats, priority)
+
+    def _execute_sparql(self, q, cursor=None, commit=False, stats=None,
+                        priority=None, done=None):
+        """
+        Run a complete SPASQL statement, as built by :meth:`_add_defines`,
+        and decode its results according to the query form.
+
+        With an admission controller, the statement first waits for a
+        slot of its ``priority`` class, by default ``interactive`` for
+        queries and ``write`` for updates. With replicas, a query without
+        a ``cursor`` may run on a replica. ``done`` is called once the
+        statement is over, for a SELECT at the end of its rows. The slot
+        is given back while a deadlocked update waits to be retried.
+
+        With ``prefetch_depth``, a SELECT without a ``cursor`` nor a
+        pending transaction runs on the connection of a clone of the
+        store, taken from a pool of ``prefetch_connections`` clones,
+        which its prefetching thread uses alone and gives back at the
+        end of the rows; when all are in use, the SELECT is not
+        prefetched.
+        """
+        reading = _is_read(q)
+        slot = admitted = None
+        if self.admission is not None:
+            if priority is None:
+                priority = INTERACTIVE if reading else WRITE
+            slot = self.admission.slot(priority)
+            slot.acquire()
+            admitted = slot.release
+        release = _once(admitted, done)
+        must_close = False
+        try:
+            if reading and cursor is None:
+                index = self._route_read()
+                if index is not None:
+                    replicas = self.replicas
+                    release = _once(admitted, done,
+                                    lambda: replicas.release(index))
+                    return self._replica_store(index)._execute_sparql(
+                        q, stats=stats, priority=priority, done=release)
+            prefetch = None
+            if (self.prefetch_depth and cursor is None
+                    and self._transaction is None and self.__dsn is not None
+                    and _select_re.match(q)):
+                taken = self._prefetch_cursor()
+                if taken is not None:
+                    clone, cursor = taken
+                    pool = self._prefetch_pool
+                    release = _once(admitted, done,
+                                    lambda: pool.release(clone))
+                    prefetch = clone.connection
+                    must_close = True
+            if cursor is None:
+                cursor = self.cursor()
+                must_close = True
+        except:
+            release()
+            raise
 
         try:
             log.log(9, "query: \n" + str(q))
             if _construct_re.match(q):
-                return self._sparql_construct(q, cursor)
+                ret = self._sparql_construct(q, cursor, stats)
             elif _ask_re.match(q):
-                return self._sparql_ask(q, cursor)
+                ret = self._sparql_ask(q, cursor, stats)
             elif _select_re.match(q):
-                ret = self._sparql_select(q, cursor, must_close)
+                ret = self._sparql_select(q, cursor, must_close, stats, release,
+                                          prefetch)
                 must_close = False
+                release = None
                 # will be closed at the end of the generator returned by _sparql_select
+                # and reported to the instrumentation there, which also
+                # releases the admission slot
                 return ret
             else:
-                return self._sparql_ul(q, cursor, commit=commit)
-        except:
+                ret = self._sparql_ul(q, cursor, commit=commit, stats=stats,
+                                      slot=slot)
+            if stats is not None:
+                self.instrumentation.query_done(stats)
+            return ret
+        except Exception as e:
             log.error("Exception running: " + q)
+            # a select that got past its execution reports itself
+            if stats is not None and stats.kind != "select":
+                stats.error = e
+                self.instrumentation.query_done(stats)
             raise
         finally:
             if must_close:
                 cursor.close()
+            if release is not None:
+                release()
+            if not reading:
+                self._last_write = clock()
 
-    def _sparql_construct(self, q, cursor):
+    def _prefetch_cursor(self):
+        """
+        Return a clone of the store from the pool of prefetching
+        connections and a cursor of it, or None if all are in use.
+        """
+        if self._prefetch_pool is None:
+            self._prefetch_pool = StorePool(self.clone,
+                                            self.prefetch_connections)
+        pool = self._prefetch_pool
+        try:
+            clone = pool.acquire(timeout=0)
+        except PoolTimeout:
+            return None
+        try:
+            return clone, clone.cursor()
+        except:
+            pool.release(clone, discard=True)
+            raise
+
+    def _route_read(self):
+        """
+        Return the index of the replica a read should run on, or None
+        to run it on the primary.
+        """
+        if (self.replicas is None or self._transaction is not None
+                or self.replicas.pinned(self._last_write)):
+            return None
+        return self.replicas.acquire()
+
+    def _replica_store(self, index):
+        """
+        Return the store of this store on the replica ``index``.
+        """
+        store = self._replica_stores.get(index)
+        if store is None:
+            store = self.clone(self.replicas.dsns[index])
+            # the primary admits and retries the statements
+            store.replicas = store.admission = store.retry = None
+            self._replica_stores[index] = store
+        return store
+
+    def _sparql_construct(self, q, cursor, stats=None):
         log.debug("_sparql_construct")
         g = Graph()
-        results = cursor.execute(q)
-        for result in results:
-            g.add(resolve(cursor, x) for x in result)
-        return g
+        resolver = LazyResolver(self.connection)
+        try:
+            if stats is None:
+                results = cursor.execute(q)
+                for result in results:
+                    g.add(resolve(resolver, x) for x in result)
+                return g
+            stats.kind = "construct"
+            start = clock()
+            results = cursor.execute(q)
+            stats.execute_time = clock() - start
+            for row in _measured_rows(results, resolver, stats):
+                g.add(tuple(row))
+            return g
+        finally:
+            resolver.close()
 
-    def _sparql_ask(self, q, cursor):
+    def _sparql_ask(self, q, cursor, stats=None):
         log.debug("_sparql_ask")
         # seems like ask -> false returns an empty result set
         # and ask -> true returns an single row
+        if stats is None:
+            results = cursor.execute(q)
+            return len(results.fetchall()) != 0
+        stats.kind = "ask"
+        start = clock()
         results = cursor.execute(q)
-        return len(results.fetchall()) != 0
+        fetched = clock()
+        rows = results.fetchall()
+        stats.fetch_time = clock() - fetched
+        stats.execute_time = fetched - start
+        stats.rows = len(rows)
+        return len(rows) != 0
         # result = results.next()
         # result = resolve(None, result[0])
         # return result != 0
 
-    def _sparql_select(self, q, cursor, must_close):
+    def _sparql_select(self, q, cursor, must_close, stats=None, release=None,
+                       prefetch=None):
+        """
+        Run a SELECT on ``cursor`` and return an iterator of its rows.
+        With ``prefetch``, the connection of ``cursor``, used by no other
+        thread, the rows are fetched and decoded in a background thread.
+        """
         log.debug("_sparql_select")
-        results = cursor.execute(q)
+        if stats is not None:
+            start = clock()
+            results = cursor.execute(q)
+            stats.execute_time = clock() - start
+            stats.kind = "select"
+        else:
+            results = cursor.execute(q)
         vars = [Variable(col[0]) for col in results.description]
         var_dict = VirtuosoResultRow.prepare_var_dict(vars)
+        resolver = LazyResolver(prefetch or self.connection)
         def f():
             try:
                 for r in results:
                     try:
-                        yield VirtuosoResultRow([resolve(cursor, x) for x in r],
+                        yield VirtuosoResultRow([resolve(resolver, x) for x in r],
                                                 var_dict)
                     except Exception as e:
                         log.debug("skip row, because of %s", e)
                         pass
             finally:
+                resolver.close()
                 if must_close:
                     cursor.close()
-        e = EagerIterator(f())
+                if release is not None:
+                    release()
+        def measured():
+            try:
+                for row in _measured_rows(results, resolver, stats, True):
+                    yield VirtuosoResultRow(row, var_dict)
+            except Exception as e:
+                stats.error = e
+                raise
+            finally:
+                resolver.close()
+                if must_close:
+                    cursor.close()
+                if release is not None:
+                    release()
+                self.instrumentation.query_done(stats)
+        def pooled():
+            try:
+                for row in _pooled_rows(results, self._decode_executor(),
+                                        resolver, self.fetch_block_size,
+                                        2 * self.decode_workers, stats):
+                    yield VirtuosoResultRow(row, var_dict)
+            except Exception as e:
+                if stats is not None:
+                    stats.error = e
+                raise
+            finally:
+                resolver.close()
+                if must_close:
+                    cursor.close()
+                if release is not None:
+                    release()
+                if stats is not None:
+                    self.instrumentation.query_done(stats)
+        if self.decode_workers:
+            rows = pooled()
+        else:
+            rows = f() if stats is None else measured()
+        if prefetch is not None:
+            rows = PrefetchIterator(rows, self.prefetch_depth,
+                                    self.fetch_block_size)
+        e = EagerIterator(rows)
         e.vars = vars
         e.selectionF = e.vars
         return e
 
-    def _sparql_ul(self, q, cursor, commit):
+    def _sparql_ul(self, q, cursor, commit, stats=None, slot=None):
         log.debug("_sparql_ul")
+        if commit and self.retry is not None:
+            # the statement was rolled back as a whole, so it can run again
+            def on_retry(retry, error, delay):
+                if stats is not None:
+                    stats.retries += 1
+                # other statements may use the admission slot meanwhile
+                if slot is not None:
+                    slot.release()
+            def attempt():
+                if slot is not None:
+                    slot.acquire()
+                return self._sparql_ul_once(q, cursor, commit, stats)
+            return self.retry.run(attempt, on_retry)
+        return self._sparql_ul_once(q, cursor, commit, stats)
+
+    def _sparql_ul_once(self, q, cursor, commit, stats=None):
+        if stats is not None:
+            stats.kind = "update"
+            start = clock()
         try:
             cursor.execute(q)
+            if stats is not None:
+                committed = clock()
+                stats.execute_time += committed - start
             if commit:
                 log.debug("_sparql_ul commit")
                 cursor.execute("COMMIT WORK")
+                if stats is not None:
+                    stats.commit_time += clock() - committed
         except:
             if commit:
                 log.debug("_sparql_ul rollback")
@@ -429,6 +1481,7 @@ class Virtuoso(Store):
         methods must be called
         """
         log.debug("transaction")
+        self._check_fork()
         if self._transaction is not None:
             raise OperationalError("Transaction already in progress")
         self._transaction = self.cursor()
@@ -439,22 +1492,93 @@ class Virtuoso(Store):
         Commit any pending work. Also releases the cached cursor.
         """
         log.debug("commit")
+        self._check_fork()
         if self._transaction is not None:
-            self._transaction.execute("COMMIT WORK")
+            if self.instrumentation is not None:
+                stats = QueryStats(kind="commit")
+                start = clock()
+                self._transaction.execute("COMMIT WORK")
+                stats.commit_time = clock() - start
+                self.instrumentation.query_done(stats)
+            else:
+                self._transaction.execute("COMMIT WORK")
             self._transaction.close()
             self._transaction = None
+            self._invalidate_touched()
 
     def rollback(self):
         """
         Roll back any pending work. Also releases the cached cursor.
         """
         log.debug("rollback")
+        self._check_fork()
         if self._transaction is not None:
             self._transaction.execute("ROLLBACK WORK")
             self._transaction.close()
             self._transaction = None
+            self._invalidate_touched()
+
+    def _invalidate(self, subject, context):
+        """
+        Drop the cached entities a write on ``subject`` in ``context``
+        may have changed, a None subject or context matching any.
+        Within a transaction, also reload the local copy of
+        ``context`` once the transaction is over.
+        """
+        context = getattr(context, "identifier", context)
+        if self.entity_cache is not None:
+            self.entity_cache.invalidate(subject, context)
+        if self._transaction is not None and (
+                self.entity_cache is not None or self.local_graphs is not None):
+            # another store may cache the old entity until the commit
+            self._touched.add((subject, context))
+
+    def _invalidate_touched(self):
+        touched, self._touched = self._touched, set()
+        for subject, context in touched:
+            if self.entity_cache is not None:
+                self.entity_cache.invalidate(subject, context)
+            if self.local_graphs is not None:
+                self.local_graphs.expire(context)
+
+    def _is_local(self, context):
+        """
+        Whether the reads of ``context`` are served by its local copy.
+        """
+        return (self.local_graphs is not None and context is not None
+                and self._transaction is None and context in self.local_graphs)
+
+    def _write_local(self, quads, removed=False):
+        """
+        Apply writes done outside a transaction to the local graphs.
+        """
+        if self.local_graphs is None or self._transaction is not None:
+            return
+        if removed:
+            self.local_graphs.removed(quads)
+        else:
+            self.local_graphs.added(quads)
+
+    def _cached_pairs(self, subject, context):
+        """
+        Return the ``(predicate, object)`` pairs of ``subject`` in
+        ``context`` from the entity cache, fetching them on a miss, or
+        None when the cache does not apply.
+        """
+        cache = self.entity_cache
+        if (cache is None or subject is None or context is None
+                or self._transaction is not None):
+            return None
+        identifier = getattr(context, "identifier", context)
+        pairs = cache.get(identifier, subject)
+        if pairs is None:
+            version = cache.version
+            pairs = self.describe_many([subject], context=context)[subject]
+            cache.put(identifier, subject, pairs, version)
+        return pairs
 
     def contexts(self, statement=None):
+        self._check_fork()
         if statement is None and self.quad_storage is None:
             q = u'SELECT DISTINCT __ro2sq(G) FROM RDF_QUAD'
         else:
@@ -465,9 +1589,15 @@ class Virtuoso(Store):
             if self.quad_storage:
                 q = 'DEFINE input:storage %s %s' % (self.quad_storage.n3(), q)
             q = 'SPARQL '+q
-        with self.cursor() as c:
-            for uri, in c.execute(q):
-                yield Graph(self, URIRef(uri))
+        index = self._route_read()
+        try:
+            store = self if index is None else self._replica_store(index)
+            with store.cursor() as c:
+                for uri, in c.execute(q):
+                    yield Graph(self, URIRef(uri))
+        finally:
+            if index is not None:
+                self.replicas.release(index)
 
     def triples(self, statement, context=None):
         """
@@ -481,8 +1611,28 @@ class Virtuoso(Store):
         but the same triple may be yielded several times
         (with a different context in the corresponding generator).
         """
+        self._check_fork()
         s, p, o = statement
-        if s is not None and p is not None and o is not None and context is not None:
+        # the local copies hold the terms read from Virtuoso
+        if self._is_local(context) and all(map(_round_trips, statement)):
+            triples = self.local_graphs.triples(self, statement, context)
+            if triples is not None:
+                for triple in triples:
+                    yield triple, [context]
+                return
+        if isinstance(p, Path):
+            for x in self._triples_path(statement, context):
+                yield x
+            return
+        pairs = None
+        if o is None or _round_trips(o):
+            # the cached objects were read from Virtuoso
+            pairs = self._cached_pairs(s, context)
+        if pairs is not None:
+            for p1, o1 in pairs:
+                if (p is None or p == p1) and (o is None or o == o1):
+                    yield (s, p1, o1), [context]
+        elif s is not None and p is not None and o is not None and context is not None:
            if self._triples_ask(statement, context):
                yield statement, [context]
         else:
@@ -490,14 +1640,183 @@ class Virtuoso(Store):
                yield x
 
     def _triples_ask(self, statement, context=None):
+        # the keys of a filter built from the graph are those of the
+        # terms read from Virtuoso
+        if (self.bloom_filters is not None and context is not None
+                and all(map(_round_trips, statement))):
+            bloom = self.bloom_filters.get(context)
+            if bloom is not None and triple_key(statement) not in bloom:
+                self.bloom_filters.registry.counter('bloom.negatives').inc()
+                return False
         query_bindings = _query_bindings(statement, context)
         q = (u'ASK WHERE { GRAPH %(G)s { %(S)s %(P)s %(O)s } }' % query_bindings)
         return self._query(q)
 
+    def _triples_path(self, statement, context=None):
+        """
+        Yield the matches of a pattern whose predicate is a property
+        path, as evaluated by Virtuoso in a single query, each once.
+        Without a context, the path spans all the graphs.
+
+        Virtuoso refuses transitive paths with neither end bound; those
+        are evaluated by rdflib, hop by hop, on this store.
+        """
+        s, path, o = statement
+        if s is None and o is None and _transitive_path(path):
+            if context is None:
+                graph = ConjunctiveGraph(self)
+            elif isinstance(context, Graph):
+                graph = Graph(self, identifier=context.identifier)
+            else:
+                graph = Graph(self, identifier=context)
+            seen = set()
+            for s1, o1 in path.eval(graph, None, None):
+                if (s1, o1) not in seen:
+                    seen.add((s1, o1))
+                    yield (s1, path, o1), [context]
+            return
+        bindings = _query_bindings((s, None, o), context)
+        pattern = u'%s %s %s' % (bindings['S'], _path_n3(path), bindings['O'])
+        if context is not None:
+            pattern = u'GRAPH %s { %s }' % (bindings['G'], pattern)
+        if s is not None and o is not None:
+            if self._query(u'ASK WHERE { %s }' % pattern):
+                yield statement, [context]
+            return
+        projection = u' '.join(
+            v for v, term in ((u'?S', s), (u'?O', o)) if term is None)
+        q = u'SELECT DISTINCT %s WHERE { %s }' % (projection, pattern)
+        for row in self._query(q):
+            row = iter(row)
+            s1 = next(row) if s is None else s
+            o1 = next(row) if o is None else o
+            yield (s1, path, o1), [context]
+
     def __contains__(self, statement, context=None):
+        if isinstance(statement[1], Path) or self._is_local(context):
+            for x in self.triples(statement, context):
+                return True
+            return False
         return self._triples_ask(statement, context)
 
-    def _triples_pattern(self, statement, context=None):
+    def triples_choices(self, statement, context=None):
+        """
+        Like :meth:`triples`, with a list of terms in one position of
+        the statement (an empty list matching any term). The terms are
+        given to a single query as a VALUES block, by chunks of 1000,
+        rather than each to its own query.
+        """
+        self._check_fork()
+        for i, choices in enumerate(statement):
+            if isinstance(choices, list):
+                break
+        else:
+            for x in self.triples(statement, context):
+                yield x
+            return
+        statement = list(statement)
+        statement[i] = None
+        statement = tuple(statement)
+        if not choices or (self._is_local(context)
+                           and all(map(_round_trips, choices))):
+            choices = set(choices)
+            for x in self.triples(statement, context):
+                if not choices or x[0][i] in choices:
+                    yield x
+            return
+        max_batch = 1000
+        for start in range(0, len(choices), max_batch):
+            values = ("SPO"[i], choices[start:start + max_batch])
+            for x in self._triples_pattern(statement, context, values):
+                yield x
+
+    def describe_many(self, subjects, predicates=None, context=None, graph=None):
+        """
+        Fetch the ``(predicate, object)`` pairs of many subjects, in
+        ``context`` or else in any graph, limited to ``predicates`` if
+        given, by chunks of 1000 subjects per query.
+
+        Returns a dict mapping each subject to the list of its pairs
+        (empty for a subject without any). With ``graph``, the triples
+        are also added to that (e.g. in-memory) graph.
+        """
+        self._check_fork()
+        subjects = list(subjects)
+        described = dict((s, []) for s in subjects)
+        g = Variable("G") if context is None else getattr(
+            context, "identifier", context)
+        if isinstance(g, BNode):
+            g = _bnode_to_nodeid(g)
+        restriction = u''
+        if predicates is not None:
+            restriction = u'VALUES ?P { %s } ' % u' '.join(
+                _term_n3(p) for p in predicates)
+        max_batch = 1000
+        for start in range(0, len(subjects), max_batch):
+            chunk = subjects[start:start + max_batch]
+            q = (u'SELECT %s?S ?P ?O WHERE { VALUES ?S { %s } %s'
+                 u'GRAPH %s { ?S ?P ?O } }' % (
+                     # the same pair may be in several graphs
+                     u'DISTINCT ' if context is None else u'',
+                     u' '.join(_term_n3(s) for s in chunk), restriction,
+                     g.n3()))
+            for s, p, o in self._query(q):
+                described.setdefault(s, []).append((p, o))
+                if graph is not None:
+                    graph.add((s, p, o))
+        return described
+
+    def scan(self, statement, columns="SPO", context=None, distinct=False):
+        """
+        Yield, for each quad matching a pattern as in :meth:`triples`, the
+        tuple of its terms in ``columns``, a string of letters among
+        ``"SPOG"``; only the unbound columns are fetched. With
+        ``distinct``, each tuple is yielded once, as deduplicated by
+        Virtuoso.
+        """
+        self._check_fork()
+        bindings = _query_bindings(statement, context, False)
+        constants = dict(zip("SPO", statement))
+        constants["G"] = getattr(context, "identifier", context)
+        fetched = [c for c in columns if constants[c] is None]
+        if isinstance(statement[1], Path) or (
+                "G" not in fetched and self._is_local(context)) or (
+                self.entity_cache is not None and "G" not in fetched
+                and constants["S"] is not None and context is not None
+                and self._transaction is None):
+            seen = set()
+            for (s, p, o), ctxs in self.triples(statement, context):
+                row = tuple(dict(S=s, P=p, O=o, G=constants["G"])[c]
+                            for c in columns)
+                if distinct:
+                    if row in seen:
+                        continue
+                    seen.add(row)
+                yield row
+            return
+        if not fetched:
+            # nothing to project: one tuple per match
+            for x in self.triples(statement, context):
+                yield tuple(constants[c] for c in columns)
+                if distinct:
+                    break
+            return
+        q = (u'SELECT %s%s WHERE { GRAPH %s { %s %s %s } }' % (
+            u'DISTINCT ' if distinct else u'',
+            u' '.join(bindings[c].n3() for c in fetched),
+            bindings["G"].n3(), bindings["S"].n3(), bindings["P"].n3(),
+            bindings["O"].n3()))
+        for row in self._query(q):
+            row = iter(row)
+            yield tuple(next(row) if constants[c] is None else constants[c]
+                        for c in columns)
+
+    def _triples_pattern(self, statement, context=None, values=None):
+        """
+        Yield the matches of a pattern, as :meth:`triples`. ``values``
+        is an optional ``(column, terms)`` pair, giving the terms of an
+        unbound column (``"S"``, ``"P"`` or ``"O"``).
+        """
         query_bindings_terms = _query_bindings(statement, context, False)
         query_bindings = {}
         query_constants = {}
@@ -509,8 +1828,13 @@ class Virtuoso(Store):
             else:
                 query_bindings[k + "v"] = ""
                 query_constants[k] = query_bindings_terms[k]
+        query_bindings["values"] = u""
+        if values is not None:
+            column, terms = values
+            query_bindings["values"] = u"VALUES %s { %s } " % (
+                query_bindings[column], u" ".join(_term_n3(t) for t in terms))
         q = (u'SELECT %(Sv)s %(Pv)s %(Ov)s %(Gv)s '
-             u'WHERE { GRAPH %(G)s { %(S)s %(P)s %(O)s } }')
+             u'WHERE { %(values)sGRAPH %(G)s { %(S)s %(P)s %(O)s } }')
         q = q % query_bindings
 
         ctxs_cache = {}
@@ -528,6 +1852,7 @@ class Virtuoso(Store):
             yield tuple(result[:3]), ctxs
 
     def add(self, statement, context=None, quoted=False):
+        self._check_fork()
         assert not quoted, "No quoted graph support in Virtuoso store yet, sorry"
         query_bindings = _query_bindings(statement, context)
         q = u'INSERT DATA '
@@ -537,19 +1862,33 @@ class Virtuoso(Store):
         if context is not None:
             q += u'}'
         self._query(q, commit=self._transaction is None)
+        self._invalidate(statement[0], context)
+        self._write_local([statement + (context,)])
+        if self.bloom_filters is not None:
+            self.bloom_filters.added(statement, context)
         super(Virtuoso, self).add(statement, context, quoted)
 
     def addN(self, quads):
+        self._check_fork()
         quads = iter(quads)
         max_batch = 1000
         while True:
             parts = [ u'INSERT DATA {' ]
-            evens = []
             old_g = None
+            batch_size = 0
+            written = set()
             super_add = super(Virtuoso, self).add
-            for s, p, o, g in islice(quads, max_batch):
+            chunk = list(islice(quads, max_batch))
+            if not chunk:
+                break
+            if self.bloom_filters is not None:
+                chunk = self._absent_quads(chunk)
+            for s, p, o, g in chunk:
+                batch_size += 1
                 triple = (s, p, o)
                 super_add(triple, g)
+                if self.entity_cache is not None or self.local_graphs is not None:
+                    written.add((s, getattr(g, "identifier", g)))
                 query_bindings = _query_bindings(triple, g)
                 gid = query_bindings['G']
                 if gid != old_g:
@@ -561,13 +1900,89 @@ class Virtuoso(Store):
             if old_g is not None:
                 parts.append("}}")
                 q = "".join(parts)
-                self._query(q, commit=self._transaction is None)
+                stats = None
+                if self.instrumentation is not None:
+                    stats = QueryStats(batch_size=batch_size)
+                self._query(q, commit=self._transaction is None, stats=stats)
+                for s, g in written:
+                    self._invalidate(s, g)
+                self._write_local(chunk)
+                if self.bloom_filters is not None:
+                    for s, p, o, g in chunk:
+                        self.bloom_filters.added((s, p, o), g)
+
+    def _absent_quads(self, quads):
+        """
+        Return the quads of a batch that are not in their graph yet, as
+        told by the Bloom filters of their graphs and, for the quads the
+        filters may have seen, by a single query.
+        """
+        filters = self.bloom_filters
+        absent, maybe = [], []
+        for quad in quads:
+            bloom = filters.get(quad[3]) if quad[3] is not None else None
+            if bloom is not None and triple_key(quad[:3]) in bloom:
+                maybe.append(quad)
             else:
+                absent.append(quad)
+        if not maybe:
+            return absent
+        q = (u'SELECT ?g ?s ?p ?o WHERE { VALUES (?g ?s ?p ?o) { %s } '
+             u'GRAPH ?g { ?s ?p ?o } }' % u' '.join(
+                 u'(%(G)s %(S)s %(P)s %(O)s)' % _query_bindings(quad[:3], quad[3])
+                 for quad in maybe))
+        present = set((g, s, p, o) for (g, s, p, o) in self._query(q))
+        for s, p, o, g in maybe:
+            if (getattr(g, "identifier", g), s, p, o) not in present:
+                absent.append((s, p, o, g))
+        skipped = len(quads) - len(absent)
+        if skipped:
+            filters.registry.counter('bloom.skipped').inc(skipped)
+        return absent
+
+    def removeN(self, quads):
+        """
+        Remove quads ``(s, p, o, context)``, by batches of fully bound
+        quads deleted in a single statement. Quads with a ``None`` term
+        or context are removed one by one, as by :meth:`remove`.
+        """
+        self._check_fork()
+        quads = iter(quads)
+        max_batch = 1000
+        super_remove = super(Virtuoso, self).remove
+        while True:
+            rows = []
+            written = set()
+            deleted = []
+            seen = 0
+            for s, p, o, g in islice(quads, max_batch):
+                seen += 1
+                triple = (s, p, o)
+                if g is None or None in triple:
+                    self.remove(triple, g)
+                    continue
+                super_remove(triple, g)
+                rows.append(u'(%(G)s %(S)s %(P)s %(O)s)'
+                            % _query_bindings(triple, g))
+                deleted.append((s, p, o, g))
+                if self.entity_cache is not None or self.local_graphs is not None:
+                    written.add((s, getattr(g, "identifier", g)))
+            if not seen:
                 break
-
-
+            if rows:
+                q = (u'DELETE { GRAPH ?g { ?s ?p ?o } } WHERE { '
+                     u'VALUES (?g ?s ?p ?o) { %s } GRAPH ?g { ?s ?p ?o } }'
+                     % u' '.join(rows))
+                stats = None
+                if self.instrumentation is not None:
+                    stats = QueryStats(batch_size=len(rows))
+                self._query(q, commit=self._transaction is None, stats=stats)
+                for s, g in written:
+                    self._invalidate(s, g)
+                self._write_local(deleted, removed=True)
 
     def remove(self, statement, context=None):
+        self._check_fork()
         if statement == (None, None, None):
             if context is not None:
                 ctx_id = context.identifier
@@ -587,9 +2002,18 @@ class Virtuoso(Store):
                 q = u'DELETE FROM GRAPH %(G)s { %(S)s %(P)s %(O)s } FROM %(G)s WHERE { %(S)s %(P)s %(O)s }'
             q = q % query_bindings
         self._query(q, commit=self._transaction is None)
+        self._invalidate(statement[0], context)
+        self._write_local([statement + (context,)], removed=True)
+        if self.bloom_filters is not None and statement == (None, None, None):
+            self.bloom_filters.cleared(context)
         super(Virtuoso, self).remove(statement, context)
 
     def __len__(self, context=None):
+        self._check_fork()
+        if self._is_local(context):
+            count = self.local_graphs.count(self, context)
+            if count is not None:
+                return count
         q = "{?s ?p ?o}"
         if context is not None:
             gid = context.identifier
@@ -645,6 +2069,37 @@ def _nodeid_to_bnode(iri):
     return BNode(bnode)
 
 
+# the datatypes of the literals Virtuoso stores as native values, which it
+# may give back in another lexical form (floats widened to double
+# precision, normalized decimals and dates) or datatype (integer subtypes)
+_native_datatypes = frozenset(XSD[t] for t in (
+    "float", "double", "decimal", "dateTime", "date", "time", "integer",
+    "int", "long", "short", "byte", "nonNegativeInteger",
+    "nonPositiveInteger", "negativeInteger", "positiveInteger",
+    "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte"))
+
+
+def _round_trips(term):
+    """
+    Whether Virtuoso gives ``term`` back as an equal term, so that it can
+    be compared with the terms read from Virtuoso; integers only do in
+    their canonical form, and blank nodes if :func:`_bnode_to_nodeid`
+    does not truncate their id.
+    """
+    if isinstance(term, BNode):
+        return (term.isalnum() and len(term) == 8
+                or not any(c in ascii_letters for c in term[1:]))
+    datatype = getattr(term, "datatype", None)
+    if datatype is None or datatype not in _native_datatypes:
+        return True
+    if datatype == XSD.integer:
+        try:
+            return str(int(term)) == str(term)
+        except ValueError:
+            return False
+    return False
+
+
 def resolve(resolver, args):
     """
     Takes the Virtuoso representation of an RDF node and returns
@@ -727,6 +2182,214 @@ def resolve(resolver, args):
     return Literal(value)
 
 
+def _measured_rows(results, resolver, stats, skip_errors=False):
+    """
+    Iterate over the rows of an executed SPASQL statement, yielding lists
+    of rdflib Terms and accumulating fetch and decode times, row, byte and
+    IRI lookup counts in ``stats``.
+    """
+    rows = iter(results)
+    while True:
+        start = clock()
+        try:
+            r = next(rows)
+        except StopIteration:
+            stats.fetch_time += clock() - start
+            return
+        fetched = clock()
+        stats.fetch_time += fetched - start
+        stats.rows += 1
+        for x in r:
+            if isinstance(x, tuple):
+                if x[1] == pyodbc.VIRTUOSO_DV_IRI_ID:
+                    stats.iri_lookups += 1
+                x = x[0]
+            if isinstance(x, (str, bytes, bytearray)):
+                stats.bytes += len(x)
+        try:
+            row = [resolve(resolver, x) for x in r]
+        except Exception as e:
+            if not skip_errors:
+                raise
+            log.debug("skip row, because of %s", e)
+            continue
+        finally:
+            stats.decode_time += clock() - fetched
+        yield row
+
+
+# the slots of Literal a worker process can send back, so that the
+# parent rebuilds terms without parsing their values again
+_literal_slots = set(getattr(Literal, "__slots__", ()))
+_fast_literals = set(["_language", "_datatype", "_value"]) <= _literal_slots
+_has_ill_typed = "_ill_typed" in _literal_slots
+# python values of literals that are cheap to pickle
+_plain_values = (bool, int, float, Decimal, str, bytes, datetime.date,
+                 datetime.time, datetime.datetime)
+
+# kinds of the primitive terms of _decode_block
+_BNODE, _LITERAL, _LEXICAL, _IRI_ID = range(4)
+
+
+def _term_primitive(cell):
+    """
+    Decode a SPASQL cell in a worker process into a picklable primitive:
+    the string of an IRI, None for a NULL, else a tuple ``(kind, value,
+    datatype, lang, python, ill_typed)``. A literal whose python value
+    is not plain (e.g. has a time zone) is sent as its lexical form
+    only. IRI_IDs, which need a database lookup, are sent as is.
+    """
+    if isinstance(cell, tuple) and cell[1] == pyodbc.VIRTUOSO_DV_IRI_ID:
+        return (_IRI_ID, cell)
+    term = resolve(None, cell)
+    if term is None:
+        return None
+    if isinstance(term, BNode):
+        return (_BNODE, str(term))
+    if isinstance(term, URIRef):
+        return str(term)
+    datatype = term.datatype and str(term.datatype)
+    value = term.value
+    if (_fast_literals and (value is None or type(value) in _plain_values)
+            and getattr(value, "tzinfo", None) is None):
+        return (_LITERAL, str(term), datatype, term.language, value,
+                getattr(term, "ill_typed", None))
+    return (_LEXICAL, str(term), datatype, term.language)
+
+
+def _term_from_primitive(primitive, resolver, datatypes):
+    """
+    Build the rdflib term of a :func:`_term_primitive` primitive,
+    without running the checks and conversions of the constructors
+    again when possible. ``datatypes`` caches the datatype URIRefs.
+    """
+    if primitive is None:
+        return None
+    if type(primitive) is not tuple:
+        # an IRI, already checked by the worker
+        return str.__new__(URIRef, primitive)
+    kind = primitive[0]
+    if kind == _LITERAL:
+        kind, value, datatype, lang, python, ill_typed = primitive
+        literal = str.__new__(Literal, value)
+        literal._language = lang
+        if datatype is not None:
+            uri = datatypes.get(datatype)
+            if uri is None:
+                uri = datatypes[datatype] = URIRef(datatype)
+            datatype = uri
+        literal._datatype = datatype
+        literal._value = python
+        if _has_ill_typed:
+            literal._ill_typed = ill_typed
+        return literal
+    if kind == _BNODE:
+        return str.__new__(BNode, primitive[1])
+    if kind == _LEXICAL:
+        kind, value, datatype, lang = primitive
+        return Literal(value, lang=lang, datatype=datatype)
+    return resolve(resolver, primitive[1])
+
+
+def _decode_block(rows):
+    """
+    Decode a block of rows in a worker process, into rows of
+    :func:`_term_primitive` tuples; rows that cannot be decoded are
+    dropped, as when decoding in process.
+    """
+    decoded = []
+    for r in rows:
+        try:
+            decoded.append([_term_primitive(x) for x in r])
+        except Exception as e:
+            log.debug("skip row, because of %s", e)
+    return decoded
+
+
+def _pooled_rows(results, executor, resolver, block_size, max_pending,
+                 stats=None):
+    """
+    Iterate over the rows of an executed SPASQL statement, decoded by
+    blocks of ``block_size`` rows in ``executor``, in order, the terms
+    being rebuilt from what :func:`_decode_block` returns. At most
+    ``max_pending`` blocks are fetched ahead of the consumer.
+    """
+    pending = deque()
+    exhausted = False
+    datatypes = {}
+    while True:
+        start = clock()
+        while not exhausted and len(pending) < max_pending:
+            block = results.fetchmany(block_size)
+            if not block:
+                exhausted = True
+                break
+            pending.append(executor.submit(
+                _decode_block, [tuple(r) for r in block]))
+        if not pending:
+            if stats is not None:
+                stats.fetch_time += clock() - start
+            return
+        waited = clock()
+        rows = pending.popleft().result()
+        if stats is not None:
+            stats.fetch_time += waited - start
+            stats.rows += len(rows)
+        decoded = []
+        for row in rows:
+            try:
+                if stats is not None:
+                    stats.iri_lookups += sum(
+                        1 for x in row if type(x) is tuple and x[0] == _IRI_ID)
+                decoded.append([_term_from_primitive(x, resolver, datatypes)
+                                for x in row])
+            except Exception as e:
+                log.debug("skip row, because of %s", e)
+        if stats is not None:
+            stats.decode_time += clock() - waited
+        for row in decoded:
+            yield row
+
+
+def _term_n3(term):
+    if isinstance(term, BNode):
+        term = _bnode_to_nodeid(term)
+    return term.n3()
+
+
+def _path_n3(path):
+    """
+    The SPARQL form of a property path. Unlike ``path.n3()``, it keeps
+    the parentheses of nested paths, e.g. in ``(a|b)/c``.
+    """
+    def operand(arg):
+        if isinstance(arg, Path) and not isinstance(arg, NegatedPath):
+            return u'(%s)' % _path_n3(arg)
+        return _path_n3(arg)
+    if isinstance(path, SequencePath):
+        return u'/'.join(operand(arg) for arg in path.args)
+    if isinstance(path, AlternativePath):
+        return u'|'.join(operand(arg) for arg in path.args)
+    if isinstance(path, MulPath):
+        return operand(path.path) + path.mod
+    if isinstance(path, InvPath):
+        return u'^' + operand(path.arg)
+    return path.n3()
+
+
+def _transitive_path(path):
+    """
+    Whether a property path repeats a step, with ``*`` or ``+``.
+    """
+    if isinstance(path, MulPath):
+        return path.mod != ZeroOrOne or _transitive_path(path.path)
+    if isinstance(path, (SequencePath, AlternativePath)):
+        return any(_transitive_path(arg) for arg in path.args)
+    if isinstance(path, InvPath):
+        return _transitive_path(path.arg)
+    return False
+
+
 def _query_bindings(triple, g=None, to_n3=True):
     (s, p, o) = triple
     if isinstance(g, Graph):